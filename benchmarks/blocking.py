@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long the blocking steps hold up the reactor, with the thread pool
+disabled (as before the executor was introduced) and enabled.
+
+Each step is run while a probe on the reactor ticks every millisecond; the time by
+which the ticks are late is the time for which the reactor could not serve other
+requests. The steps are rebuilding a large domain block list, fsyncing a batch of
+records to the session journal, and expiring a large number of sqlite sessions.
+
+Run with `python -m benchmarks.blocking [--pool-size N] [--output FILE]`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall, deferLater
+
+from matrix_synapse_saml_mozilla._executor import Executor
+from matrix_synapse_saml_mozilla._session_stores import (
+    JournalSessionStore,
+    SqliteSessionStore,
+)
+from matrix_synapse_saml_mozilla._sessions import UsernameMappingSession
+from matrix_synapse_saml_mozilla.mapping_provider import build_domain_block_list
+
+PROBE_INTERVAL = 0.001
+
+BLOCK_LIST_SIZE = 200000
+JOURNAL_RECORDS = 20000
+EXPIRED_SESSIONS = 100000
+
+
+def _make_session(expiry_time_ms: int) -> UsernameMappingSession:
+    return UsernameMappingSession(
+        remote_user_id="remote",
+        displayname="Bench User",
+        client_redirect_url="https://client/",
+        expiry_time_ms=expiry_time_ms,
+    )
+
+
+class ReactorProbe:
+    """Records how late each tick of a LoopingCall on the reactor is"""
+
+    def __init__(self):
+        self._last = 0.0
+        self.lateness: List[float] = []
+        self._looping_call = LoopingCall(self._tick)
+
+    def _tick(self):
+        now = time.perf_counter()
+        if self._last:
+            self.lateness.append(max(0.0, now - self._last - PROBE_INTERVAL))
+        self._last = now
+
+    def start(self):
+        self._looping_call.start(PROBE_INTERVAL)
+
+    def stop(self):
+        self._looping_call.stop()
+
+
+def _setup_steps(directory: str) -> Dict[str, Callable[[], Callable[[], object]]]:
+    """Returns, for each step, a function which prepares it and returns the step"""
+
+    def reload_block_list():
+        path = os.path.join(directory, "block_list.txt")
+        with open(path, "w") as fh:
+            fh.writelines(
+                "domain%i.example.com\n" % (i,) for i in range(BLOCK_LIST_SIZE)
+            )
+        return lambda: build_domain_block_list([], path)
+
+    def flush_session_journal():
+        path = os.path.join(directory, "sessions-%f.journal" % (time.time(),))
+        store = JournalSessionStore(path, executor=Executor(pool_size=0))
+        expiry_time_ms = int(time.time() * 1000) + 3600 * 1000
+        for i in range(JOURNAL_RECORDS):
+            store.add("session%i" % (i,), _make_session(expiry_time_ms))
+        return store.flush
+
+    def expire_sessions():
+        path = os.path.join(directory, "sessions-%f.db" % (time.time(),))
+        store = SqliteSessionStore(path)
+        store.add_many(
+            ("session%i" % (i,), _make_session(1)) for i in range(EXPIRED_SESSIONS)
+        )
+        return store.expire
+
+    return {
+        "reload_block_list": reload_block_list,
+        "flush_session_journal": flush_session_journal,
+        "expire_sessions": expire_sessions,
+    }
+
+
+async def _measure(executor: Executor, name: str, step: Callable[[], object]):
+    probe = ReactorProbe()
+    probe.start()
+    # let the probe settle
+    await deferLater(reactor, 0.05, lambda: None)
+
+    start = time.perf_counter()
+    await executor.run(name, step)
+    duration = time.perf_counter() - start
+
+    await deferLater(reactor, 0.01, lambda: None)
+    probe.stop()
+    return {
+        "step": name,
+        "pool_size": executor.pool_size,
+        "duration_ms": duration * 1000,
+        "reactor_blocked_ms": sum(probe.lateness) * 1000,
+        "max_stall_ms": max(probe.lateness, default=0) * 1000,
+    }
+
+
+async def run(executors: List[Executor]) -> List[Dict[str, object]]:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, setup in _setup_steps(directory).items():
+            for executor in executors:
+                results.append(await _measure(executor, name, setup()))
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark how long blocking steps hold up the reactor"
+    )
+    parser.add_argument(
+        "--pool-size", type=int, default=4, help="threads in the enabled thread pool"
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    # the pool is started when the reactor starts
+    executors = [Executor(pool_size=0), Executor(pool_size=parsed.pool_size)]
+
+    results = []
+
+    async def run_and_stop():
+        try:
+            results.extend(await run(executors))
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(lambda: defer.ensureDeferred(run_and_stop()))
+    reactor.run()
+
+    json.dump(
+        {"python": platform.python_version(), "results": results},
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the memory use, load time and lookup latency of DomainBlockList, with and
+without a compiled block list file, against the plain set of domains which it
+replaced.
+
+Run with `python -m benchmarks.domains [--domains 1000000] [--output FILE]`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from matrix_synapse_saml_mozilla._domains import DomainBlockList, load_domain_block_file
+
+LOOKUPS = 100000
+
+
+def _random_domain(rng: random.Random) -> str:
+    label = "".join(
+        rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 15))
+    )
+    return "%s.%s" % (label, rng.choice(["com", "net", "org", "io", "co.uk"]))
+
+
+def _load_set(path):
+    # this is how parse_config used to load the block list
+    with open(path, encoding="ascii") as fh:
+        return {line.strip().lower() for line in fh.readlines()}
+
+
+def _load_block_list(path):
+    block_list = DomainBlockList()
+    load_domain_block_file(path, block_list)
+    return block_list
+
+
+def _measure(load, path, queries):
+    tracemalloc.start()
+    start = time.perf_counter()
+    matcher = load(path)
+    load_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for query in queries:
+        query in matcher
+    elapsed = time.perf_counter() - start
+
+    return memory, load_time, elapsed / len(queries) * 1e9
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the memory use, load time and lookup latency of the"
+        " domain block list"
+    )
+    parser.add_argument(
+        "--domains",
+        type=int,
+        default=1000000,
+        help="number of domains in the block list (default: 1000000)",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    count = parsed.domains
+    rng = random.Random(0)
+    domains = [_random_domain(rng) for _ in range(count)]
+
+    # a mix of blocked domains, subdomains of blocked domains and unblocked domains
+    queries = []
+    for _ in range(LOOKUPS):
+        choice = rng.random()
+        if choice < 0.3:
+            queries.append(rng.choice(domains))
+        elif choice < 0.6:
+            queries.append("mail." + rng.choice(domains))
+        else:
+            queries.append(_random_domain(rng))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        text_path = os.path.join(tempdir, "domains.txt")
+        with open(text_path, "w") as fh:
+            fh.writelines(domain + "\n" for domain in domains)
+
+        compiled_path = os.path.join(tempdir, "domains.bin")
+        DomainBlockList(domains).write_compiled(compiled_path)
+
+        results = []
+        for name, load, path in (
+            ("set", _load_set, text_path),
+            ("DomainBlockList", _load_block_list, text_path),
+            ("compiled", _load_block_list, compiled_path),
+        ):
+            memory, load_time, latency = _measure(load, path, queries)
+            results.append(
+                {
+                    "block_list": name,
+                    "domains": count,
+                    "memory_bytes": memory,
+                    "load_seconds": load_time,
+                    "ns_per_lookup": latency,
+                }
+            )
+
+    json.dump(
+        {"python": platform.python_version(), "results": results},
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the throughput and latency of each stage of a login through the username
+picker: mapping the SAML response, rendering the picker page, checking a username and
+submitting it.
+
+Synthetic SAML responses are fed to SamlMappingProvider, and the username picker
+resources are driven with fake requests against an in-memory ModuleApi, so the
+results exclude Synapse and the network. Every combination of the given numbers of
+emails per response, block list sizes and live sessions is run, and the results are
+written as JSON, so that they can be compared between releases.
+
+Run with `python -m benchmarks.flow [--logins N] [--emails 1,10] [--output FILE]`.
+See `--help` for the other options.
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import platform
+import random
+import sqlite3
+import string
+import sys
+import time
+from typing import Dict, List
+
+from twisted.internet import defer
+from twisted.web.resource import Resource, getChildForRequest
+from twisted.web.test.requesthelper import DummyRequest
+
+from synapse.api.errors import RedirectException
+
+from matrix_synapse_saml_mozilla._attributes import (
+    DISPLAYNAME_ATTRIBUTE_NAME,
+    EMAIL_ATTRIBUTE_NAME,
+    UID_ATTRIBUTE_NAME,
+)
+from matrix_synapse_saml_mozilla._sessions import (
+    SESSION_COOKIE_NAME,
+    InMemorySessionStore,
+    UsernameMappingSession,
+    set_session_store,
+)
+from matrix_synapse_saml_mozilla.mapping_provider import SamlConfig, SamlMappingProvider
+from matrix_synapse_saml_mozilla.username_picker import (
+    PickUsernameConfig,
+    pick_username_resource,
+)
+
+STAGES = ["saml_response", "page", "check", "submit"]
+
+# the number of users which are already registered
+REGISTERED_USERS = 10000
+
+
+class FakeResponse:
+    """Stands in for a saml2 AuthnResponse"""
+
+    def __init__(self, remote_user_id: str, displayname: str, emails: List[str]):
+        self.ava = {
+            UID_ATTRIBUTE_NAME: [remote_user_id],
+            DISPLAYNAME_ATTRIBUTE_NAME: [displayname],
+            EMAIL_ATTRIBUTE_NAME: emails,
+        }
+
+
+class FakeModuleApi:
+    """Implements the parts of ModuleApi used by the username picker, on top of an
+    in-memory SQLite users table"""
+
+    def __init__(self, registered: int):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE users (name TEXT PRIMARY KEY)")
+        # as Synapse's users_lower_name index
+        self.db.execute("CREATE INDEX users_lower_name ON users (LOWER(name))")
+        self.db.execute(
+            "CREATE TABLE user_external_ids (auth_provider TEXT, external_id TEXT,"
+            " user_id TEXT, PRIMARY KEY (auth_provider, external_id))"
+        )
+        self.db.executemany(
+            "INSERT INTO users VALUES (?)",
+            (("@registered%i:bench" % (i,),) for i in range(registered)),
+        )
+
+    def get_qualified_user_id(self, localpart):
+        return "@%s:bench" % (localpart,)
+
+    def check_user_exists(self, user_id):
+        row = self.db.execute(
+            "SELECT name FROM users WHERE LOWER(name) = ?", (user_id.lower(),)
+        ).fetchone()
+        return defer.succeed(row[0] if row else None)
+
+    def run_db_interaction(self, desc, func, *args):
+        return defer.succeed(func(self.db.cursor(), *args))
+
+    def register_user(self, localpart, displayname=None):
+        user_id = self.get_qualified_user_id(localpart)
+        self.db.execute("INSERT INTO users VALUES (?)", (user_id,))
+        return defer.succeed(user_id)
+
+    def record_user_external_id(self, auth_provider_id, remote_user_id, user_id):
+        self.db.execute(
+            "INSERT INTO user_external_ids VALUES (?, ?, ?)",
+            (auth_provider_id, remote_user_id, user_id),
+        )
+        return defer.succeed(None)
+
+    def complete_sso_login_async(self, user_id, request, client_redirect_url):
+        request.redirect(client_redirect_url.encode("utf-8"))
+        request.finish()
+        return defer.succeed(None)
+
+
+class FakeRequest(DummyRequest):
+    def __init__(self, postpath: List[bytes], session_id: str):
+        super().__init__(postpath)
+        self._session_cookie = session_id.encode("ascii")
+
+    def getCookie(self, name):
+        if name == SESSION_COOKIE_NAME:
+            return self._session_cookie
+        return None
+
+    def addCookie(self, name, value, **kwargs):
+        pass
+
+    @contextlib.contextmanager
+    def processing(self):
+        yield
+
+
+def _random_domain(rng: random.Random) -> str:
+    label = "".join(rng.choice(string.ascii_lowercase) for _ in range(10))
+    return "%s.%s" % (label, rng.choice(["com", "net", "org"]))
+
+
+def _render(resource: Resource, request: FakeRequest):
+    getChildForRequest(resource, request).render(request)
+    if not request.finished:
+        raise Exception("Request to %s did not complete" % (request.postpath,))
+
+
+def _summarise(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        index = min(len(latencies) - 1, int(len(latencies) * p / 100))
+        return latencies[index] * 1000
+
+    return {
+        "count": len(latencies),
+        "throughput_per_second": len(latencies) / sum(latencies),
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+    }
+
+
+def run(
+    logins: int, emails: int, block_list_size: int, live_sessions: int
+) -> Dict[str, Dict[str, float]]:
+    """Runs `logins` logins through each stage, and summarises the latencies"""
+    rng = random.Random(0)
+
+    store = InMemorySessionStore()
+    set_session_store(store)
+    expiry_time_ms = int(time.time() * 1000) + 3600 * 1000
+    for i in range(live_sessions):
+        store.create(
+            UsernameMappingSession(
+                remote_user_id="live%i" % (i,),
+                displayname="Live User",
+                client_redirect_url="https://client/",
+                expiry_time_ms=expiry_time_ms,
+            )
+        )
+
+    provider = SamlMappingProvider(
+        SamlConfig(
+            use_name_id_for_remote_uid=False,
+            domain_block_list=[_random_domain(rng) for _ in range(block_list_size)],
+        ),
+        None,
+    )
+    resource = pick_username_resource(
+        PickUsernameConfig(), FakeModuleApi(REGISTERED_USERS),
+    )
+
+    latencies: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+
+    def timed(stage, f, *args):
+        start = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            latencies[stage].append(time.perf_counter() - start)
+
+    for i in range(logins):
+        response = FakeResponse(
+            "remote%i" % (i,),
+            "Bench User%i" % (i,),
+            ["user%i@mail%i.example.org" % (i, j) for j in range(emails)],
+        )
+        try:
+            timed(
+                "saml_response",
+                provider.saml_response_to_user_attributes,
+                response,
+                0,
+                "https://client/",
+            )
+        except RedirectException as e:
+            cookie = e.cookies[0].split(b";", 1)[0]
+            session_id = cookie.split(b"=", 1)[1].decode("ascii")
+        else:
+            raise Exception("SAML response was not redirected to the picker")
+
+        timed("page", _render, resource, FakeRequest([b""], session_id))
+
+        username = "bench%i" % (i,)
+        request = FakeRequest([b"check"], session_id)
+        request.args = {b"username": [username.encode("ascii")]}
+        timed("check", _render, resource, request)
+
+        request = FakeRequest([b"submit"], session_id)
+        request.method = b"POST"
+        request.args = {b"username": [username.encode("ascii")]}
+        timed("submit", _render, resource, request)
+        if request.responseCode != 302:
+            raise Exception("Submitting %s failed: %s" % (username, request.written))
+
+    return {stage: _summarise(latencies[stage]) for stage in STAGES}
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SAML mapping and username picker flow"
+    )
+    parser.add_argument(
+        "--logins", type=int, default=2000, help="logins to run for each combination"
+    )
+    parser.add_argument(
+        "--emails",
+        type=_int_list,
+        default=[1, 10],
+        help="comma-separated numbers of emails in each SAML response",
+    )
+    parser.add_argument(
+        "--block-list-size",
+        type=_int_list,
+        default=[100, 100000],
+        help="comma-separated numbers of domains in the block list",
+    )
+    parser.add_argument(
+        "--live-sessions",
+        type=_int_list,
+        default=[0, 100000],
+        help="comma-separated numbers of sessions which are live before starting",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    results = []
+    for emails, block_list_size, live_sessions in itertools.product(
+        parsed.emails, parsed.block_list_size, parsed.live_sessions
+    ):
+        results.append(
+            {
+                "emails": emails,
+                "block_list_size": block_list_size,
+                "live_sessions": live_sessions,
+                "stages": run(parsed.logins, emails, block_list_size, live_sessions),
+            }
+        )
+
+    json.dump(
+        {
+            "python": platform.python_version(),
+            "logins": parsed.logins,
+            "results": results,
+        },
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long it takes to import the package, and each of its entry points.
+
+Each import is run in a fresh interpreter with `python -X importtime`, and the time
+is the total for the modules which the import loaded. By default, the modules which
+Synapse has always loaded by the time it loads a module (the module API, and with it
+Twisted) are imported first and not counted, so the results are what a Synapse
+worker pays for loading this module.
+
+Run with `python -m benchmarks.import_time [--runs N] [--no-preload] [--output FILE]`.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+# the code to import, for each target
+TARGETS = {
+    "package": "import matrix_synapse_saml_mozilla",
+    "mapping_provider": "from matrix_synapse_saml_mozilla import SamlMappingProvider",
+    "username_picker": "from matrix_synapse_saml_mozilla import pick_username_resource",
+}
+
+# the modules which Synapse has already imported when it loads the module
+SYNAPSE_PRELOAD = ["synapse.module_api"]
+
+# written to stderr between the preloaded imports and the target, so that only the
+# imports after it are counted
+_MARKER = "-- target --"
+
+
+def parse_import_times(stderr: str) -> List[Tuple[str, int, int]]:
+    """Parse the output of `python -X importtime`
+
+    Only the imports after the marker are returned, if there is a marker.
+
+    Returns:
+        the name, self time and cumulative time in microseconds, of each module
+        which was imported, in the order in which they finished importing
+    """
+    lines = stderr.splitlines()
+    if _MARKER in lines:
+        del lines[: lines.index(_MARKER) + 1]
+
+    times = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line.split(":", 1)[1].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header line
+            continue
+        times.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return times
+
+
+def measure(target: str, preload: Optional[List[str]] = None) -> Dict[str, object]:
+    """Import the target in a fresh interpreter
+
+    Args:
+        target: one of TARGETS
+        preload: modules to import first, whose time is not counted
+
+    Returns:
+        the total import time in milliseconds, the modules which were imported, and
+        the five which took longest themselves
+    """
+    code = "".join("import %s\n" % (module,) for module in preload or [])
+    code += "import sys\nsys.stderr.write(%r)\n%s\n" % (_MARKER + "\n", TARGETS[target])
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        raise Exception("Importing %s failed:\n%s" % (target, result.stderr))
+
+    times = parse_import_times(result.stderr)
+    slowest = sorted(times, key=lambda t: t[1], reverse=True)[:5]
+    return {
+        "total_ms": sum(self_us for _, self_us, _ in times) / 1000,
+        "modules": [name for name, _, _ in times],
+        "slowest": {name: self_us / 1000 for name, self_us, _ in slowest},
+    }
+
+
+def run(runs: int, preload: List[str]) -> List[Dict[str, object]]:
+    results = []
+    for target in TARGETS:
+        measurements = [measure(target, preload) for _ in range(runs)]
+        results.append(
+            {
+                "target": target,
+                "median_ms": statistics.median(m["total_ms"] for m in measurements),
+                "min_ms": min(m["total_ms"] for m in measurements),
+                "modules_imported": len(measurements[0]["modules"]),
+                "slowest_ms": measurements[0]["slowest"],
+            }
+        )
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the time taken to import the module"
+    )
+    parser.add_argument(
+        "--runs", type=int, default=10, help="imports of each target to time"
+    )
+    parser.add_argument(
+        "--no-preload",
+        action="store_true",
+        help="also count the modules which Synapse has already imported",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    preload = [] if parsed.no_preload else SYNAPSE_PRELOAD
+    json.dump(
+        {
+            "python": platform.python_version(),
+            "preload": preload,
+            "results": run(parsed.runs, preload),
+        },
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how many database queries the filter of registered users saves when
+checking usernames, and what it costs to build.
+
+The users table is filled with users whose display names are drawn from a
+Zipf-like distribution of first and last names, each registered under the first
+free username suggested for them, as the username picker would. Then new users
+arrive: each checks the usernames suggested for them, as the picker page does, and
+then the first of them on its own, as `/check` does. The checks are run against an
+in-memory SQLite users table, with and without the filter, counting the queries.
+
+Run with `python -m benchmarks.registered_users [--users 100000] [--logins 10000]`.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import sqlite3
+import string
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from twisted.internet import defer
+
+from matrix_synapse_saml_mozilla._availability import UsernameAvailabilityChecker
+from matrix_synapse_saml_mozilla._cache import TTLCache
+from matrix_synapse_saml_mozilla._registered_users import (
+    RegisteredUsersFilter,
+    RegisteredUsersFilterConfig,
+)
+from matrix_synapse_saml_mozilla._suggestions import suggest_localparts
+
+FIRST_NAMES = 2000
+LAST_NAMES = 20000
+
+# the number of usernames the picker page checks for each user
+PAGE_CANDIDATES = 9
+
+
+class FakeModuleApi:
+    """Implements the parts of ModuleApi used for checking availability, on top of
+    an in-memory SQLite users table, counting the queries"""
+
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE users (name TEXT PRIMARY KEY)")
+        # as Synapse's users_lower_name index
+        self.db.execute("CREATE INDEX users_lower_name ON users (LOWER(name))")
+        self.queries = 0
+        self.user_ids_queried = 0
+
+    def get_qualified_user_id(self, localpart):
+        return "@%s:bench" % (localpart,)
+
+    def check_user_exists(self, user_id):
+        self.queries += 1
+        self.user_ids_queried += 1
+        row = self.db.execute(
+            "SELECT name FROM users WHERE LOWER(name) = ?", (user_id.lower(),)
+        ).fetchone()
+        return defer.succeed(row[0] if row else None)
+
+    def run_db_interaction(self, desc, func, *args):
+        self.queries += 1
+        if desc == "saml_mozilla_get_taken_user_ids":
+            self.user_ids_queried += len(args[0])
+        return defer.succeed(func(self.db.cursor(), *args))
+
+
+def _name(rng: random.Random) -> str:
+    length = rng.randint(4, 9)
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length)).title()
+
+
+class NameGenerator:
+    """Draws display names from a Zipf-like distribution of first and last names"""
+
+    def __init__(self, rng: random.Random):
+        self._rng = rng
+        self._first = [_name(rng) for _ in range(FIRST_NAMES)]
+        self._last = [_name(rng) for _ in range(LAST_NAMES)]
+        self._first_weights = list(
+            itertools.accumulate(1 / (rank + 1) for rank in range(FIRST_NAMES))
+        )
+        self._last_weights = list(
+            itertools.accumulate(1 / (rank + 1) for rank in range(LAST_NAMES))
+        )
+
+    def displayname(self) -> str:
+        first = self._rng.choices(self._first, cum_weights=self._first_weights)[0]
+        last = self._rng.choices(self._last, cum_weights=self._last_weights)[0]
+        return "%s %s" % (first, last)
+
+
+def _register_users(
+    module_api: FakeModuleApi, names: NameGenerator, count: int
+) -> None:
+    taken = set()
+    for _ in range(count):
+        for candidate in suggest_localparts(names.displayname(), None, 50):
+            if candidate not in taken:
+                taken.add(candidate)
+                break
+    module_api.db.executemany(
+        "INSERT INTO users VALUES (?)",
+        ((module_api.get_qualified_user_id(localpart),) for localpart in taken),
+    )
+
+
+def _run(d: defer.Deferred):
+    results = []
+    defer.ensureDeferred(d).addBoth(results.append)
+    return results[0]
+
+
+def run(
+    module_api: FakeModuleApi,
+    logins: List[str],
+    filter_config: Optional[RegisteredUsersFilterConfig],
+) -> Dict[str, object]:
+    result: Dict[str, object] = {"filter": filter_config is not None}
+
+    registered_users = None
+    if filter_config is not None:
+        registered_users = RegisteredUsersFilter(module_api, filter_config)
+        module_api.queries = 0
+        start = time.perf_counter()
+        _run(registered_users.rebuild())
+        result["build_seconds"] = time.perf_counter() - start
+        result["build_queries"] = module_api.queries
+        result["filter_bytes"] = registered_users.size
+
+    checker = UsernameAvailabilityChecker(
+        module_api, TTLCache(max_size=10000, ttl=60), registered_users=registered_users
+    )
+
+    module_api.queries = module_api.user_ids_queried = 0
+    free = checks = 0
+    start = time.perf_counter()
+    for displayname in logins:
+        candidates = suggest_localparts(displayname, None, PAGE_CANDIDATES)
+        available = _run(checker.check_many(candidates))
+        free += sum(available.values())
+        checks += len(candidates)
+
+        _run(checker.is_available(candidates[0]))
+        free += available[candidates[0]]
+        checks += 1
+    duration = time.perf_counter() - start
+
+    result.update(
+        {
+            "checks": checks,
+            "free": free,
+            "queries": module_api.queries,
+            "queries_per_login": module_api.queries / len(logins),
+            "user_ids_queried": module_api.user_ids_queried,
+            "us_per_check": duration / checks * 1e6,
+        }
+    )
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the filter of registered users"
+    )
+    parser.add_argument(
+        "--users", type=int, default=100000, help="number of registered users"
+    )
+    parser.add_argument(
+        "--logins", type=int, default=10000, help="number of new users to check for"
+    )
+    parser.add_argument(
+        "--false-positive-rate",
+        type=float,
+        default=0.01,
+        help="the filter's false positive rate",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    rng = random.Random(0)
+    names = NameGenerator(rng)
+    module_api = FakeModuleApi()
+    _register_users(module_api, names, parsed.users)
+    logins = [names.displayname() for _ in range(parsed.logins)]
+
+    filter_configs: Tuple[Optional[RegisteredUsersFilterConfig], ...] = (
+        None,
+        RegisteredUsersFilterConfig(false_positive_rate=parsed.false_positive_rate),
+    )
+    results = [run(module_api, logins, config) for config in filter_configs]
+    json.dump(
+        {
+            "python": platform.python_version(),
+            "users": parsed.users,
+            "logins": parsed.logins,
+            "results": results,
+        },
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
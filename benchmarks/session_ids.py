@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the cost of generating a session id, and of creating a session, against
+the method which was used before.
+
+Run with `python -m benchmarks.session_ids [--iterations 100000]`.
+"""
+
+import argparse
+import json
+import platform
+import random
+import string
+import sys
+import timeit
+from typing import Callable, Dict, List
+
+from matrix_synapse_saml_mozilla._sessions import (
+    InMemorySessionStore,
+    UsernameMappingSession,
+    generate_session_id,
+)
+
+_random = random.SystemRandom()
+
+
+def _old_session_id() -> str:
+    # this is how session ids used to be generated: about 91 bits of entropy
+    return "".join(_random.choice(string.ascii_letters) for _ in range(16))
+
+
+def _measure(name: str, f: Callable[[], object], iterations: int) -> Dict[str, object]:
+    elapsed = min(timeit.repeat(f, number=iterations, repeat=3))
+    return {"name": name, "us_per_call": elapsed / iterations * 1e6}
+
+
+def run(iterations: int) -> List[Dict[str, object]]:
+    session = UsernameMappingSession(
+        remote_user_id="remote",
+        displayname="Jonny",
+        client_redirect_url="http://client/",
+        expiry_time_ms=2 ** 62,
+    )
+    store = InMemorySessionStore()
+
+    def old_create():
+        store.add(_old_session_id(), session)
+
+    return [
+        _measure("old session id", _old_session_id, iterations),
+        _measure("generate_session_id", generate_session_id, iterations),
+        _measure("create, with old session id", old_create, iterations),
+        _measure("create", lambda: store.create(session), iterations),
+    ]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark generating session ids and creating sessions"
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=100000,
+        help="number of calls to time, in each of three repeats",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    json.dump(
+        {
+            "python": platform.python_version(),
+            "iterations": parsed.iterations,
+            "results": run(parsed.iterations),
+        },
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
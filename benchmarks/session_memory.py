@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the memory used by each live session in the in-memory session store,
+with the session records as they were before they were slotted and interned, and as
+they are now.
+
+Each session gets its own copy of its redirect URL and display name, as it would
+when built from a SAML response, with the redirect URL one of a handful of clients.
+The memory allocated while filling the store is measured with tracemalloc, and
+compared with the store's own `memory_usage` and `estimate_memory_usage`.
+
+Run with `python -m benchmarks.session_memory [--sessions 100000,1000000]`.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import attr
+
+from matrix_synapse_saml_mozilla._sessions import (
+    InMemorySessionStore,
+    UsernameMappingSession,
+)
+
+CLIENT_REDIRECT_URLS = [
+    "https://app.element.io/#/home",
+    "https://develop.element.io/#/home",
+    "https://chat.example.com/",
+    "element://vector/webapp/",
+]
+
+# the number of distinct users which the sessions are for
+USERS = 50000
+
+
+@attr.s
+class LegacyUsernameMappingSession:
+    """UsernameMappingSession as it was before it was slotted and interned"""
+
+    remote_user_id = attr.ib(type=str)
+    displayname = attr.ib(type=Optional[str])
+    client_redirect_url = attr.ib(type=str)
+    expiry_time_ms = attr.ib(type=int)
+
+
+SESSION_CLASSES = {
+    "before": LegacyUsernameMappingSession,
+    "after": UsernameMappingSession,
+}
+
+
+def _fill(store: InMemorySessionStore, session_class: type, count: int):
+    expiry_time_ms = int(time.time() * 1000) + 3600 * 1000
+    for i in range(count):
+        user = i % USERS
+        # build fresh copies of the strings, as parsing a SAML response would
+        store.add(
+            "session%010i" % (i,),
+            session_class(
+                remote_user_id="remote%i" % (user,),
+                displayname="%s %i" % ("Bench User", user),
+                client_redirect_url="%s" % (CLIENT_REDIRECT_URLS[i % 4],),
+                expiry_time_ms=expiry_time_ms + i,
+            ),
+        )
+
+
+def run(count: int, version: str) -> Dict[str, object]:
+    store = InMemorySessionStore()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        _fill(store, SESSION_CLASSES[version], count)
+        gc.collect()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    start = time.perf_counter()
+    estimated = store.estimate_memory_usage()
+    estimate_ms = (time.perf_counter() - start) * 1000
+    measured = store.memory_usage()
+
+    return {
+        "sessions": count,
+        "version": version,
+        "allocated_bytes_per_session": allocated / count,
+        "measured_bytes_per_session": measured / count,
+        "estimated_bytes_per_session": estimated / count,
+        "estimate_ms": estimate_ms,
+    }
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the memory used by each live session"
+    )
+    parser.add_argument(
+        "--sessions",
+        type=_int_list,
+        default=[100000, 1000000],
+        help="comma-separated numbers of live sessions",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    results = [
+        run(count, version) for count in parsed.sessions for version in SESSION_CLASSES
+    ]
+    json.dump(
+        {"python": platform.python_version(), "results": results},
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
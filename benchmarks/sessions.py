@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the per-request cost of the session store against the number of live
+sessions.
+
+Each simulated request looks up a session, expires any old sessions and creates a new
+session, which is what a `/check` followed by a SAML login costs.
+
+Run with `python -m benchmarks.sessions [--sessions 10,1000,100000,1000000]`.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from typing import Dict, List
+
+from matrix_synapse_saml_mozilla._sessions import (
+    InMemorySessionStore,
+    UsernameMappingSession,
+)
+
+# sessions last this long, in simulated milliseconds
+VALIDITY_MS = 15 * 60 * 1000
+
+
+def _make_session(expiry_time_ms: int) -> UsernameMappingSession:
+    return UsernameMappingSession(
+        remote_user_id="remote",
+        displayname="Jonny",
+        client_redirect_url="http://client/",
+        expiry_time_ms=expiry_time_ms,
+    )
+
+
+def run(size: int, requests: int) -> Dict[str, object]:
+    """Measures the mean cost of a request with `size` live sessions"""
+    now_ms = 0
+    store = InMemorySessionStore(gettime=lambda: now_ms / 1000)
+
+    # spread the expiry times of the existing sessions over the validity period, so
+    # that a steady trickle expire as the clock advances.
+    step = VALIDITY_MS / size
+    for i in range(size):
+        store["s%i" % (i,)] = _make_session(int(i * step) + 1)
+
+    start = time.perf_counter()
+    for i in range(requests):
+        now_ms += 1
+        store.get("s%i" % (i,))
+        store.expire(now_ms)
+        store["n%i" % (i,)] = _make_session(now_ms + VALIDITY_MS)
+    elapsed = time.perf_counter() - start
+
+    return {"sessions": size, "us_per_request": elapsed / requests * 1e6}
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the session store against the number of live sessions"
+    )
+    parser.add_argument(
+        "--sessions",
+        type=_int_list,
+        default=[10, 1000, 100000, 1000000],
+        help="comma-separated numbers of live sessions",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=10000,
+        help="number of requests to simulate for each number of sessions",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="where to write the JSON results (default: stdout)",
+    )
+    parsed = parser.parse_args(args)
+
+    results = [run(size, parsed.requests) for size in parsed.sessions]
+    json.dump(
+        {
+            "python": platform.python_version(),
+            "requests": parsed.requests,
+            "results": results,
+        },
+        parsed.output,
+        indent=2,
+    )
+    parsed.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
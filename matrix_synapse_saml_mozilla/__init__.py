@@ -13,15 +13,58 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pkg_resources import DistributionNotFound, get_distribution
+"""
+The entry points, `SamlMappingProvider` and `pick_username_resource`, are loaded on
+first use rather than when the package is imported, so that a Synapse worker which
+only loads one of them does not pay for importing the other. `__version__` is
+likewise only read from the package metadata when it is asked for.
+"""
 
-from matrix_synapse_saml_mozilla.mapping_provider import SamlMappingProvider
-from matrix_synapse_saml_mozilla.username_picker import pick_username_resource
+import importlib
+from typing import TYPE_CHECKING
 
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:
-    # package is not installed
-    pass
+if TYPE_CHECKING:
+    from matrix_synapse_saml_mozilla.mapping_provider import SamlMappingProvider
+    from matrix_synapse_saml_mozilla.username_picker import pick_username_resource
+
+# the module which defines each lazily-loaded attribute
+_LAZY_ATTRIBUTES = {
+    "SamlMappingProvider": "matrix_synapse_saml_mozilla.mapping_provider",
+    "pick_username_resource": "matrix_synapse_saml_mozilla.username_picker",
+}
 
 __all__ = ["SamlMappingProvider", "pick_username_resource"]
+
+
+def _get_version() -> str:
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        # Python < 3.8
+        from importlib_metadata import PackageNotFoundError, version  # type: ignore
+
+    try:
+        return version("matrix-synapse-saml-mozilla")
+    except PackageNotFoundError:
+        # package is not installed
+        raise AttributeError("module %r has no attribute '__version__'" % (__name__,))
+
+
+def __getattr__(name: str):
+    if name == "__version__":
+        value = _get_version()
+        globals()[name] = value
+        return value
+
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    value = getattr(importlib.import_module(module_name), name)
+    # cache it, so that __getattr__ is not called again
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
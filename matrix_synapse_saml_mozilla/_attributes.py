@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import attr
+
+# default names of attributes in the `ava` property we get from pysaml2
+UID_ATTRIBUTE_NAME = (
+    "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/nameidentifier"
+)
+EMAIL_ATTRIBUTE_NAME = "email"
+DISPLAYNAME_ATTRIBUTE_NAME = "displayName"
+
+# the user attributes which can be mapped from SAML attributes, in the order of the
+# fields of SamlUserAttributes
+USER_ATTRIBUTES = ("remote_user_id", "email", "displayname")
+_EMAIL_INDEX = USER_ATTRIBUTES.index("email")
+
+
+def _to_names(value) -> Tuple[str, ...]:
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+@attr.s(frozen=True)
+class AttributeMapping:
+    """The names of the SAML attributes to take each user attribute from
+
+    Each user attribute may be taken from any of several SAML attributes, to
+    accommodate IdPs which use different names. If more than one is present, the
+    first is used, except that the emails are collected from all of them, so that
+    every email the IdP asserts is checked against the domain block list.
+    """
+
+    remote_user_id = attr.ib(
+        type=Tuple[str, ...], default=(UID_ATTRIBUTE_NAME,), converter=_to_names
+    )
+    email = attr.ib(
+        type=Tuple[str, ...], default=(EMAIL_ATTRIBUTE_NAME,), converter=_to_names
+    )
+    displayname = attr.ib(
+        type=Tuple[str, ...], default=(DISPLAYNAME_ATTRIBUTE_NAME,), converter=_to_names
+    )
+
+
+def parse_attribute_mapping(config: dict) -> AttributeMapping:
+    """Parse the `attribute_mapping` section of the module config
+
+    Each entry is the name of a SAML attribute, or a list of names in order of
+    preference.
+    """
+    unknown = set(config) - set(USER_ATTRIBUTES)
+    if unknown:
+        raise Exception(
+            "Unknown attribute_mapping entries %s: must be one of %s"
+            % (", ".join(sorted(unknown)), ", ".join(USER_ATTRIBUTES))
+        )
+
+    mapping = AttributeMapping(**config)
+    for name in USER_ATTRIBUTES:
+        names = getattr(mapping, name)
+        if not names or not all(isinstance(n, str) and n for n in names):
+            raise Exception(
+                "attribute_mapping.%s must be an attribute name or a list of names"
+                % (name,)
+            )
+    return mapping
+
+
+@attr.s(frozen=True, slots=True)
+class SamlUserAttributes:
+    """The user attributes extracted from a SAML response"""
+
+    # the user's ID on the SAML server, if the response included it
+    remote_user_id = attr.ib(type=Optional[str])
+
+    # the user's email addresses from all of the mapped email attributes, in order
+    # of preference, or None if the response had no email attribute
+    emails = attr.ib(type=Optional[List[str]])
+
+    displayname = attr.ib(type=Optional[str])
+
+
+class AttributeExtractionPlan:
+    """Extracts the user attributes from a SAML response, per an AttributeMapping
+
+    The mapping is compiled into a single dict from SAML attribute name to the user
+    attributes it may provide, so that extraction is one pass over the response's
+    attributes.
+    """
+
+    def __init__(self, mapping: AttributeMapping = AttributeMapping()):
+        self.mapping = mapping
+
+        # map from SAML attribute name to a list of (field index, preference) pairs,
+        # where lower preferences win
+        self._plan: Dict[str, List[Tuple[int, int]]] = {}
+        for index, field in enumerate(USER_ATTRIBUTES):
+            for preference, name in enumerate(getattr(mapping, field)):
+                self._plan.setdefault(name, []).append((index, preference))
+
+    def extract(self, ava: Mapping[str, List[str]]) -> SamlUserAttributes:
+        """Extract the user attributes from a response's `ava`"""
+        values: List[Optional[List[str]]] = [None, None, None]
+        preferences = [math.inf] * len(USER_ATTRIBUTES)
+
+        # the values of each email attribute present, with its preference
+        email_values: List[Tuple[int, List[str]]] = []
+
+        plan = self._plan
+        for name, value in ava.items():
+            targets = plan.get(name)
+            if targets is None:
+                continue
+            for index, preference in targets:
+                if index == _EMAIL_INDEX:
+                    email_values.append((preference, value))
+                elif preference < preferences[index]:
+                    values[index] = value
+                    preferences[index] = preference
+
+        emails: Optional[List[str]] = None
+        if len(email_values) == 1:
+            emails = email_values[0][1]
+        elif email_values:
+            email_values.sort(key=lambda pair: pair[0])
+            emails = [email for _, value in email_values for email in value]
+
+        remote_user_id, _, displayname = values
+        return SamlUserAttributes(
+            remote_user_id=remote_user_id[0] if remote_user_id else None,
+            emails=emails,
+            displayname=displayname[0] if displayname else None,
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, AttributeExtractionPlan):
+            return NotImplemented
+        return self.mapping == other.mapping
+
+    def __repr__(self) -> str:
+        return "<AttributeExtractionPlan for %r>" % (self.mapping,)
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An audit trail of the decisions which the module makes: the sessions it creates, the
+users it refuses because of their email domain, the usernames it checks, the users it
+registers, and the sessions which expire.
+
+Recording an event only appends it to a bounded in-memory queue, so it never waits
+for the disk. The queue is written to the sink in batches, in the executor's thread
+pool. If the sink cannot keep up and the queue fills, further events are dropped and
+counted, rather than holding up logins.
+
+When auditing is enabled, the decisions are only recorded as audit events; otherwise
+they are logged, as they were before there was an audit log.
+"""
+
+import abc
+import collections
+import importlib
+import json
+import logging
+import time
+from typing import Any, Deque, Dict, List, Optional
+
+import attr
+from twisted.internet import defer
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet.task import LoopingCall
+
+from matrix_synapse_saml_mozilla._executor import Executor, get_executor
+from matrix_synapse_saml_mozilla._metrics import (
+    audit_events_dropped,
+    audit_events_written,
+    audit_queued_events,
+)
+
+logger = logging.getLogger(__name__)
+
+AUDIT_SINK_TYPES = ("jsonl", "class")
+
+DEFAULT_AUDIT_QUEUE_SIZE = 10000
+DEFAULT_AUDIT_BATCH_SIZE = 1000
+DEFAULT_AUDIT_FLUSH_INTERVAL = 1.0
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+@attr.s(frozen=True, slots=True)
+class AuditEvent:
+    """Something which the module decided. Subclasses set `event_type`."""
+
+    event_type = ""
+
+    # when the event happened, in milliseconds
+    time_ms = attr.ib(type=int, factory=_now_ms, kw_only=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"type": self.event_type, **attr.asdict(self)}
+
+
+@attr.s(frozen=True, slots=True)
+class SessionCreated(AuditEvent):
+    """A remote user was sent to the username picker"""
+
+    event_type = "session_created"
+
+    remote_user_id = attr.ib(type=str)
+
+
+@attr.s(frozen=True, slots=True)
+class DomainBlocked(AuditEvent):
+    """A remote user was refused because of one of their emails"""
+
+    event_type = "domain_blocked"
+
+    remote_user_id = attr.ib(type=str)
+    email = attr.ib(type=str)
+
+    # why the email was refused, as given by find_rejected_email
+    reason = attr.ib(type=str)
+
+
+@attr.s(frozen=True, slots=True)
+class UsernameChecked(AuditEvent):
+    """A remote user checked if a username is available"""
+
+    event_type = "username_checked"
+
+    remote_user_id = attr.ib(type=str)
+    username = attr.ib(type=str)
+    available = attr.ib(type=bool)
+
+
+@attr.s(frozen=True, slots=True)
+class UserRegistered(AuditEvent):
+    """A remote user picked a username, and was registered"""
+
+    event_type = "user_registered"
+
+    remote_user_id = attr.ib(type=str)
+    user_id = attr.ib(type=str)
+
+
+@attr.s(frozen=True, slots=True)
+class SessionsExpired(AuditEvent):
+    """Sessions passed their expiry time without registering a user"""
+
+    event_type = "session_expired"
+
+    count = attr.ib(type=int)
+
+
+class AuditSink(abc.ABC):
+    """Where audit events are written
+
+    Sinks are called from the executor's thread pool, one batch at a time.
+    """
+
+    @abc.abstractmethod
+    def write(self, events: List[AuditEvent]):
+        """Write a batch of events. Should not return until they are written."""
+
+    def close(self):
+        """Release any resources held by the sink"""
+
+
+class JsonlAuditSink(AuditSink):
+    """Appends each event to a file, as a line of JSON
+
+    Args:
+        path: the file, which is created if it does not exist
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, events: List[AuditEvent]):
+        self._file.write(
+            "".join(json.dumps(event.to_dict()) + "\n" for event in events)
+        )
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class AuditLog:
+    """A bounded queue of audit events, which is written to a sink in the background
+
+    Args:
+        sink: where to write the events
+        max_queue_size: the maximum number of events to hold before dropping them
+        batch_size: the maximum number of events to write at once. The queue is
+            flushed early once it holds this many events.
+        flush_interval: how often to write the queue, in seconds
+        clock: the reactor to schedule flushes on. Defaults to the global reactor.
+        executor: runs the writes. Defaults to the executor for blocking steps.
+    """
+
+    def __init__(
+        self,
+        sink: AuditSink,
+        max_queue_size: int = DEFAULT_AUDIT_QUEUE_SIZE,
+        batch_size: int = DEFAULT_AUDIT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_AUDIT_FLUSH_INTERVAL,
+        clock: Optional[IReactorTime] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self._sink = sink
+        self._max_queue_size = max_queue_size
+        self._batch_size = batch_size
+        self._executor = executor
+        self._queue: Deque[AuditEvent] = collections.deque()
+
+        # the write which is running in the thread pool, if any
+        self._flushing: Optional[defer.Deferred] = None
+        self._closed = False
+
+        self._flusher = LoopingCall(self._flush_in_background)
+        if clock is not None:
+            self._flusher.clock = clock
+        self._flusher.start(flush_interval, now=False)
+
+    def __len__(self) -> int:
+        """Returns the number of events waiting to be written"""
+        return len(self._queue)
+
+    def record(self, event: AuditEvent):
+        """Queue an event to be written, or drop it if the queue is full"""
+        if len(self._queue) >= self._max_queue_size:
+            audit_events_dropped.labels("queue_full").inc()
+            return
+
+        self._queue.append(event)
+        if len(self._queue) >= self._batch_size and self._flushing is None:
+            self._flush_in_background()
+
+    def close(self) -> defer.Deferred:
+        """Stop flushing in the background, write any queued events and close the sink
+
+        Returns:
+            a Deferred which resolves once the sink is closed
+        """
+        self._closed = True
+        if self._flusher.running:
+            self._flusher.stop()
+
+        def finish(_):
+            while self._queue:
+                self._write(self._take_batch())
+            self._sink.close()
+
+        if self._flushing is None:
+            return defer.maybeDeferred(finish, None)
+
+        # wait for the background write, so that the writes do not interleave
+        d: defer.Deferred = defer.Deferred()
+        self._flushing.addBoth(lambda _: d.callback(None))
+        return d.addCallback(finish)
+
+    def _take_batch(self) -> List[AuditEvent]:
+        count = min(len(self._queue), self._batch_size)
+        return [self._queue.popleft() for _ in range(count)]
+
+    def _flush_in_background(self) -> Optional[defer.Deferred]:
+        """Write the next batch in the executor's thread pool"""
+        if self._flushing is not None or self._closed or not self._queue:
+            return None
+
+        executor = self._executor or get_executor()
+        self._flushing = executor.run(
+            "write_audit_events", self._write, self._take_batch()
+        )
+
+        def flushed(_):
+            self._flushing = None
+            # carry on if events arrived faster than a batch per flush_interval
+            if len(self._queue) >= self._batch_size:
+                self._flush_in_background()
+
+        return self._flushing.addBoth(flushed)
+
+    def _write(self, events: List[AuditEvent]):
+        try:
+            self._sink.write(events)
+        except Exception:
+            logger.exception("Error writing %i audit events", len(events))
+            audit_events_dropped.labels("sink_error").inc(len(events))
+            return
+        audit_events_written.inc(len(events))
+
+
+@attr.s(frozen=True)
+class AuditLogConfig:
+    # one of AUDIT_SINK_TYPES
+    type = attr.ib(type=str)
+
+    # the file to write, for the jsonl sink
+    path = attr.ib(type=Optional[str], default=None)
+
+    # the dotted path of an AuditSink subclass, and the keyword arguments to
+    # construct it with, for the class sink
+    sink_class = attr.ib(type=Optional[str], default=None)
+    sink_config = attr.ib(type=Dict[str, Any], factory=dict)
+
+    max_queue_size = attr.ib(type=int, default=DEFAULT_AUDIT_QUEUE_SIZE)
+    batch_size = attr.ib(type=int, default=DEFAULT_AUDIT_BATCH_SIZE)
+    flush_interval = attr.ib(type=float, default=DEFAULT_AUDIT_FLUSH_INTERVAL)
+
+
+def parse_audit_log_config(config: dict) -> AuditLogConfig:
+    """Parse the `audit_log` section of the module config
+
+    Args:
+        config: the `audit_log` section of the config
+
+    Returns:
+        the parsed config
+    """
+    sink_type = config.get("type", "jsonl")
+    if sink_type not in AUDIT_SINK_TYPES:
+        raise Exception(
+            "Unknown audit_log type %s: must be one of %s"
+            % (sink_type, ", ".join(AUDIT_SINK_TYPES))
+        )
+
+    parsed = AuditLogConfig(
+        type=sink_type,
+        path=config.get("path"),
+        sink_class=config.get("class"),
+        sink_config=config.get("config", {}),
+        max_queue_size=config.get("max_queue_size", DEFAULT_AUDIT_QUEUE_SIZE),
+        batch_size=config.get("batch_size", DEFAULT_AUDIT_BATCH_SIZE),
+        flush_interval=config.get("flush_interval", DEFAULT_AUDIT_FLUSH_INTERVAL),
+    )
+
+    if parsed.type == "jsonl" and not parsed.path:
+        raise Exception("audit_log.path is required for the jsonl sink")
+    if parsed.type == "class" and not parsed.sink_class:
+        raise Exception("audit_log.class is required for the class sink")
+    if parsed.max_queue_size < 1 or parsed.batch_size < 1:
+        raise Exception("audit_log.max_queue_size and batch_size must be positive")
+
+    return parsed
+
+
+def _load_sink_class(dotted_path: str) -> type:
+    module_name, _, class_name = dotted_path.rpartition(".")
+    try:
+        sink_class = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise Exception("Unable to load audit sink %s: %s" % (dotted_path, e))
+    if not (isinstance(sink_class, type) and issubclass(sink_class, AuditSink)):
+        raise Exception("Audit sink %s is not an AuditSink" % (dotted_path,))
+    return sink_class
+
+
+def build_audit_log(config: AuditLogConfig) -> AuditLog:
+    """Create an audit log from its config"""
+    if config.type == "class":
+        sink = _load_sink_class(config.sink_class)(**config.sink_config)
+    else:
+        sink = JsonlAuditSink(config.path)
+
+    from twisted.internet import reactor
+
+    audit_log = AuditLog(
+        sink, config.max_queue_size, config.batch_size, config.flush_interval
+    )
+    # write out any queued events when Synapse shuts down
+    reactor.addSystemEventTrigger("before", "shutdown", audit_log.close)
+    return audit_log
+
+
+# the audit log, or None if auditing is disabled
+_audit_log: Optional[AuditLog] = None
+
+# the config used to build the current audit log, if it has been configured
+_configured_audit_log_config: Optional[AuditLogConfig] = None
+
+
+def get_audit_log() -> Optional[AuditLog]:
+    """Returns the audit log, or None if auditing is disabled"""
+    return _audit_log
+
+
+def set_audit_log(audit_log: Optional[AuditLog]):
+    """Replace the audit log. Mostly useful for tests."""
+    global _audit_log
+    _audit_log = audit_log
+
+
+audit_queued_events.set_function(lambda: len(_audit_log) if _audit_log else 0)
+
+
+def configure_audit_log(config: AuditLogConfig):
+    """Install the audit log described by the given config
+
+    Both the mapping provider and the username picker resource call this, so it only
+    builds a new audit log if the config has changed since the last call.
+    """
+    global _configured_audit_log_config
+    if config == _configured_audit_log_config:
+        return
+
+    logger.info("Writing audit events to a %s sink", config.type)
+    if _audit_log is not None:
+        _audit_log.close()
+    set_audit_log(build_audit_log(config))
+    _configured_audit_log_config = config
+
+
+def record_audit_event(event: AuditEvent) -> bool:
+    """Record an event in the audit log, if auditing is enabled
+
+    Returns:
+        whether auditing is enabled. If it is not, callers log the decision instead.
+    """
+    if _audit_log is None:
+        return False
+    _audit_log.record(event)
+    return True
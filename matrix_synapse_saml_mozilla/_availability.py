@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+
+import synapse.module_api
+
+from matrix_synapse_saml_mozilla._cache import TTLCache
+from matrix_synapse_saml_mozilla._localpart_rules import LocalpartValidator
+from matrix_synapse_saml_mozilla._metrics import (
+    availability_cache_lookups,
+    check_user_exists_duration,
+    rejected_localparts,
+)
+from matrix_synapse_saml_mozilla._registered_users import RegisteredUsersFilter
+from matrix_synapse_saml_mozilla._suggestions import suggest_localparts
+
+logger = logging.getLogger(__name__)
+
+
+def _get_taken_user_ids_txn(txn, user_ids: List[str]) -> Set[str]:
+    """Returns the (lowercased) members of user_ids which are already registered
+
+    User IDs are compared case-insensitively, as check_user_exists does.
+    """
+    sql = "SELECT LOWER(name) FROM users WHERE LOWER(name) IN (%s)" % (
+        ", ".join("?" for _ in user_ids),
+    )
+    txn.execute(sql, [user_id.lower() for user_id in user_ids])
+    return {row[0] for row in txn.fetchall()}
+
+
+class UsernameAvailabilityChecker:
+    """Checks whether localparts are free to be registered
+
+    Usernames which break the username rules are unavailable, without querying the
+    database. Usernames which are found to be taken are remembered in a short-lived
+    cache. Usernames which are available are not cached, so they are checked against
+    the database, unless the filter of registered users says that they are
+    definitely free.
+
+    Args:
+        module_api: the Synapse module API
+        unavailable_usernames: the cache of user IDs which are known to be taken
+        localpart_validator: the username rules. If None, usernames are only
+            checked against the database.
+        registered_users: the filter of registered users. If None, every username
+            which is not in the cache is checked against the database.
+    """
+
+    def __init__(
+        self,
+        module_api: synapse.module_api.ModuleApi,
+        unavailable_usernames: TTLCache[str, bool],
+        localpart_validator: Optional[LocalpartValidator] = None,
+        registered_users: Optional[RegisteredUsersFilter] = None,
+    ):
+        self._module_api = module_api
+        self._unavailable_usernames = unavailable_usernames
+        self._localpart_validator = localpart_validator
+        self._registered_users = registered_users
+
+    def _is_invalid(self, localpart: str) -> bool:
+        if self._localpart_validator is None:
+            return False
+        rejection = self._localpart_validator.check(localpart)
+        if rejection is None:
+            return False
+        rejected_localparts.labels(rejection.reason).inc()
+        return True
+
+    def _may_be_registered(self, user_id: str) -> bool:
+        if self._registered_users is None:
+            return True
+        return self._registered_users.may_be_registered(user_id)
+
+    async def is_available(self, localpart: str) -> bool:
+        """Check if a single localpart is available"""
+        if self._is_invalid(localpart):
+            return False
+
+        user_id = self._module_api.get_qualified_user_id(localpart)
+        if self._unavailable_usernames.get(user_id):
+            availability_cache_lookups.labels("hit").inc()
+            return False
+
+        availability_cache_lookups.labels("miss").inc()
+        if not self._may_be_registered(user_id):
+            return True
+
+        with check_user_exists_duration.time():
+            registered_id = await self._module_api.check_user_exists(user_id)
+        if registered_id is not None:
+            self._unavailable_usernames.set(user_id, True)
+            return False
+        return True
+
+    async def check_many(self, localparts: Iterable[str]) -> Dict[str, bool]:
+        """Check if each of several localparts is available
+
+        The valid localparts which are not in the cache, and which may be
+        registered, are checked with a single database query.
+
+        Returns:
+            a map from each localpart to whether it is available
+        """
+        results: Dict[str, bool] = {}
+        to_query: Dict[str, str] = {}
+        for localpart in localparts:
+            if self._is_invalid(localpart):
+                results[localpart] = False
+                continue
+
+            user_id = self._module_api.get_qualified_user_id(localpart)
+            if self._unavailable_usernames.get(user_id):
+                availability_cache_lookups.labels("hit").inc()
+                results[localpart] = False
+            else:
+                availability_cache_lookups.labels("miss").inc()
+                if self._may_be_registered(user_id):
+                    to_query[localpart] = user_id
+                else:
+                    results[localpart] = True
+
+        if to_query:
+            with check_user_exists_duration.time():
+                taken = await self._module_api.run_db_interaction(
+                    "saml_mozilla_get_taken_user_ids",
+                    _get_taken_user_ids_txn,
+                    list(to_query.values()),
+                )
+            for localpart, user_id in to_query.items():
+                available = user_id.lower() not in taken
+                if not available:
+                    self._unavailable_usernames.set(user_id, True)
+                results[localpart] = available
+
+        return results
+
+    async def suggest_available(
+        self, displayname: Optional[str], remote_user_id: Optional[str], count: int
+    ) -> List[str]:
+        """Suggest up to `count` available localparts for a user
+
+        More candidates than are needed are checked, in case some are taken.
+        """
+        candidates = suggest_localparts(displayname, remote_user_id, count * 3)
+        if not candidates:
+            return []
+        results = await self.check_many(candidates)
+        return [c for c in candidates if results[c]][:count]
+
+    def mark_unavailable(self, user_id: str):
+        """Record that the given user ID has just been registered"""
+        self._unavailable_usernames.set(user_id, True)
+        if self._registered_users is not None:
+            self._registered_users.add(user_id)
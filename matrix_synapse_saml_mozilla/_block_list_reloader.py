@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import os
+import time
+from typing import Callable, Optional, Tuple
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet.task import LoopingCall
+
+from matrix_synapse_saml_mozilla._domains import DomainBlockList
+from matrix_synapse_saml_mozilla._executor import get_executor
+from matrix_synapse_saml_mozilla._metrics import (
+    block_list_reload_duration,
+    block_list_reloads,
+    block_list_rules,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def stat_block_file(path: str) -> Optional[Tuple[int, int, int]]:
+    """Returns the parts of the file's status which change when it is rewritten"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class DomainBlockListReloader:
+    """Watches the domain block file, and rebuilds the block list when it changes
+
+    The file is polled by checking its modification time, size and inode. The new
+    block list is built in the executor's thread pool, so that a large file does not
+    block the reactor, and is then handed to `on_reload` to be swapped in.
+
+    Args:
+        path: the domain block file to watch
+        build: builds a new block list. Called in a thread.
+        on_reload: called on the reactor thread with the new block list.
+        interval: how often to check the file, in seconds
+        clock: the reactor to schedule checks on. Defaults to the global reactor.
+        run_in_thread: runs a function in a thread, returning a Deferred. Defaults to
+            the executor for blocking steps.
+        last_stat: the result of `stat_block_file`, taken before the current block
+            list was loaded. Defaults to the file's status now, which misses any
+            change made while the current block list was being loaded.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        build: Callable[[], DomainBlockList],
+        on_reload: Callable[[DomainBlockList], None],
+        interval: float,
+        clock: Optional[IReactorTime] = None,
+        run_in_thread: Optional[Callable[..., defer.Deferred]] = None,
+        last_stat: Optional[Tuple[int, int, int]] = None,
+    ):
+        self._path = path
+        self._build = build
+        self._on_reload = on_reload
+        self._interval = interval
+        self._run_in_thread = run_in_thread
+        self._last_stat = last_stat if last_stat is not None else stat_block_file(path)
+
+        self._looping_call = LoopingCall(lambda: defer.ensureDeferred(self.check()))
+        if clock is not None:
+            self._looping_call.clock = clock
+
+    def start(self):
+        """Start polling the file"""
+        self._looping_call.start(self._interval, now=False)
+
+    def stop(self):
+        self._looping_call.stop()
+
+    async def check(self):
+        """Reload the block list if the file has changed since it was last loaded"""
+        stat = stat_block_file(self._path)
+        if stat is None or stat == self._last_stat:
+            return
+        self._last_stat = stat
+
+        logger.info("Domain block file %s has changed: reloading", self._path)
+        start = time.perf_counter()
+        try:
+            if self._run_in_thread is not None:
+                block_list = await self._run_in_thread(self._build)
+            else:
+                block_list = await get_executor().run("reload_block_list", self._build)
+        except Exception:
+            block_list_reloads.labels("failure").inc()
+            logger.exception(
+                "Error reloading domain block file %s: keeping the old block list",
+                self._path,
+            )
+            return
+
+        duration = time.perf_counter() - start
+        block_list_reloads.labels("success").inc()
+        block_list_reload_duration.observe(duration)
+        block_list_rules.set(len(block_list))
+
+        self._on_reload(block_list)
+        logger.info(
+            "Reloaded domain block file %s in %.3fs: %i rules",
+            self._path,
+            duration,
+            len(block_list),
+        )
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A Bloom filter: a compact set of strings, which can say that a string is definitely
+not in the set, or that it may be.
+"""
+
+import hashlib
+import math
+from typing import Iterable, List, Optional, Tuple
+
+
+def bloom_filter_parameters(
+    capacity: int, false_positive_rate: float, max_size: Optional[int] = None
+) -> Tuple[int, int]:
+    """Work out the size of a Bloom filter
+
+    Args:
+        capacity: the number of strings the filter is expected to hold
+        false_positive_rate: the fraction of strings which are not in the filter
+            which it should report as maybe being in it, once it holds `capacity`
+            strings
+        max_size: the maximum size of the filter, in bytes. If the false positive
+            rate would need a bigger filter, the rate is allowed to rise instead.
+
+    Returns:
+        the number of bits and the number of hash functions
+    """
+    capacity = max(capacity, 1)
+    bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+    if max_size is not None:
+        bits = min(bits, max_size * 8)
+    bits = max(bits, 8)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """A Bloom filter of strings
+
+    Each string sets `hashes` bits in a bit array, at positions derived from a single
+    128-bit BLAKE2 digest by double hashing. A string is maybe in the filter if all
+    of its bits are set, and definitely not in it otherwise.
+
+    Filters must not be changed by one thread while another reads them.
+
+    Args:
+        bits: the size of the bit array
+        hashes: the number of bits to set for each string
+    """
+
+    def __init__(self, bits: int, hashes: int):
+        self._bits = bits
+        self._hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+        self._count = 0
+
+    @classmethod
+    def for_capacity(
+        cls, capacity: int, false_positive_rate: float, max_size: Optional[int] = None
+    ) -> "BloomFilter":
+        """Create a filter sized to hold `capacity` strings. See
+        `bloom_filter_parameters`."""
+        return cls(*bloom_filter_parameters(capacity, false_positive_rate, max_size))
+
+    def __len__(self) -> int:
+        """Returns the number of strings which have been added"""
+        return self._count
+
+    @property
+    def size(self) -> int:
+        """The size of the bit array, in bytes"""
+        return len(self._array)
+
+    def _positions(self, value: str) -> List[int]:
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        bits = self._bits
+        return [(h1 + i * h2) % bits for i in range(self._hashes)]
+
+    def add(self, value: str):
+        array = self._array
+        for position in self._positions(value):
+            array[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def update(self, values: Iterable[str]):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value: str) -> bool:
+        array = self._array
+        for position in self._positions(value):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """Estimate the false positive rate, given the strings added so far"""
+        return (1 - math.exp(-self._hashes * self._count / self._bits)) ** self._hashes
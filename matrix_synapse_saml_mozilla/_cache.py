@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import time
+from typing import Any, Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+
+class TTLCache(Generic[KT, VT]):
+    """A bounded LRU cache whose entries expire after a fixed time
+
+    Args:
+        max_size: the maximum number of entries. The least recently used entry is
+            evicted when the cache is full.
+        ttl: how long entries live for, in seconds
+    """
+
+    def __init__(
+        self, max_size: int, ttl: float, gettime: Callable[[], float] = time.time
+    ):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._gettime = gettime
+
+        # map from key to (value, expiry time), in least-recently-used order
+        self._entries: "collections.OrderedDict[KT, Tuple[VT, float]]" = (
+            collections.OrderedDict()
+        )
+
+    def get(self, key: KT, default: Any = None) -> Optional[VT]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        value, expiry_time = entry
+        if expiry_time <= self._gettime():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: KT, value: VT):
+        self._entries[key] = (value, self._gettime() + self._ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: KT):
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import array
+import mmap
+import os
+import struct
+import sys
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+# the first bytes of a compiled block list file, in the current format and in any
+# format
+COMPILED_BLOCK_LIST_MAGIC = b"SAMLDBL2"
+_COMPILED_BLOCK_LIST_MAGIC_PREFIX = b"SAMLDBL"
+
+# the header of a compiled block list: the magic, followed by the number of distinct
+# domains, the number of domain rules and the number of wildcard rules
+_HEADER = struct.Struct("<8sIII")
+
+# the hash table slots in a compiled block list
+_UINT64 = struct.Struct("<Q")
+
+# the kinds of rule which apply to a domain in a compiled block list, as bit flags
+_DOMAIN_RULE = 1
+_WILDCARD_RULE = 2
+
+# the longest domain which can be written to a compiled block list. DNS names are
+# at most 253 characters, and the length is stored in a byte.
+_MAX_COMPILED_DOMAIN_LENGTH = 255
+
+
+class DomainBlockList:
+    """A set of rules for matching email domains
+
+    Each rule is either:
+
+      * a domain, such as `example.com`, which matches that domain and any of its
+        subdomains; or
+      * a wildcard, such as `*.example.com`, which matches any subdomain of
+        `example.com`, but not `example.com` itself.
+
+    Rather than expanding the rules, a lookup checks each suffix of the domain which
+    starts on a label boundary (`mail.example.com`, `example.com`, `com`) against the
+    rules, so it costs one hash lookup per label and the rules take no more memory
+    than a plain set of domains.
+
+    Rules can also be loaded from a compiled block list file (see
+    `write_compiled`), which is memory-mapped rather than read into sets.
+    """
+
+    def __init__(self, rules: Iterable[str] = ()):
+        # rules which match the domain and its subdomains
+        self._domains: Set[str] = set()
+
+        # rules which only match subdomains, without the leading "*."
+        self._wildcards: Set[str] = set()
+
+        # compiled block lists which have been loaded
+        self._compiled: List[CompiledDomainBlockList] = []
+
+        self.update(rules)
+
+    def add(self, rule: str):
+        """Add a rule to the block list. Blank lines and comments are ignored."""
+        rule = rule.strip().lower().rstrip(".")
+        if not rule or rule.startswith("#"):
+            return
+
+        if rule.startswith("*."):
+            self._wildcards.add(rule[2:])
+        else:
+            self._domains.add(rule)
+
+    def update(self, rules: Iterable[str]):
+        """Add several rules to the block list"""
+        for rule in rules:
+            self.add(rule)
+
+    def add_compiled(self, compiled: "CompiledDomainBlockList"):
+        """Add the rules from a compiled block list"""
+        self._compiled.append(compiled)
+
+    def __contains__(self, domain: str) -> bool:
+        domain = domain.lower().rstrip(".")
+        if domain in self._domains:
+            return True
+
+        start = domain.find(".") + 1
+        while start:
+            suffix = domain[start:]
+            if suffix in self._domains or suffix in self._wildcards:
+                return True
+            start = domain.find(".", start) + 1
+
+        if self._compiled:
+            encoded = domain.encode("utf-8")
+            for compiled in self._compiled:
+                if encoded in compiled:
+                    return True
+
+        return False
+
+    def write_compiled(self, path: str):
+        """Write the rules in this block list to a compiled block list file
+
+        The file is written to a temporary file which is then moved into place, so
+        that processes which have the old file mapped are not affected.
+        """
+        kinds: Dict[bytes, int] = {}
+        for domain in self._domains:
+            kinds[domain.encode("utf-8")] = _DOMAIN_RULE
+        for wildcard in self._wildcards:
+            encoded = wildcard.encode("utf-8")
+            kinds[encoded] = kinds.get(encoded, 0) | _WILDCARD_RULE
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(
+                _HEADER.pack(
+                    COMPILED_BLOCK_LIST_MAGIC,
+                    len(kinds),
+                    len(self._domains),
+                    len(self._wildcards),
+                )
+            )
+            fh.write(_build_compiled_table(sorted(kinds.items())))
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return (
+            len(self._domains)
+            + len(self._wildcards)
+            + sum(len(compiled) for compiled in self._compiled)
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, DomainBlockList):
+            return NotImplemented
+        return (
+            self._domains == other._domains
+            and self._wildcards == other._wildcards
+            and self._compiled == other._compiled
+        )
+
+    def __repr__(self) -> str:
+        return "<DomainBlockList with %i rules>" % (len(self),)
+
+
+def _table_capacity(count: int) -> int:
+    """The number of slots in the hash table for `count` domains
+
+    A power of two, at least twice the number of domains, so that lookups rarely
+    probe more than a couple of slots.
+    """
+    capacity = 1
+    while capacity < count * 2:
+        capacity *= 2
+    return capacity
+
+
+def _build_compiled_table(entries: List[Tuple[bytes, int]]) -> bytes:
+    """Build the body of a compiled block list. See `CompiledDomainBlockList`.
+
+    Args:
+        entries: each domain, with the kinds of rule which apply to it
+    """
+    capacity = _table_capacity(len(entries))
+    mask = capacity - 1
+    table = [0] * capacity
+    records = []
+    offset = _HEADER.size + capacity * _UINT64.size
+    for domain, kind in entries:
+        if len(domain) > _MAX_COMPILED_DOMAIN_LENGTH:
+            raise ValueError("Domain is too long to compile: %r" % (domain,))
+
+        domain_hash = zlib.crc32(domain)
+        slot = domain_hash & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = domain_hash << 32 | offset
+
+        records.append(bytes((kind, len(domain))) + domain)
+        offset += len(records[-1])
+
+    parts = [_UINT64.pack(value) for value in table]
+    parts.extend(records)
+    return b"".join(parts)
+
+
+class CompiledDomainBlockList:
+    """A compiled block list file, mapped into memory
+
+    Lookups probe a hash table in the mapped file, so the rules are never copied onto
+    the Python heap, and processes which load the same file share its pages.
+
+    After the header, the file consists of:
+
+      * the hash table: `_table_capacity(count)` little-endian uint64 slots, each
+        either 0 for an empty slot, or the CRC-32 of a domain in the top 32 bits and
+        the file offset of its record in the bottom 32. Domains are placed by their
+        CRC-32, with linear probing.
+      * a record for each domain: a byte with a bit for each kind of rule which
+        applies to it, a byte with the length of the domain, then the domain.
+
+    Each slot holds the hash, so a miss reads one or two fixed-width slots, and only
+    the record whose hash matches is compared.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, self._domain_count, self._wildcard_count = _HEADER.unpack_from(
+            self._buf, 0
+        )
+        if magic != COMPILED_BLOCK_LIST_MAGIC:
+            if magic.startswith(_COMPILED_BLOCK_LIST_MAGIC_PREFIX):
+                raise ValueError(
+                    "%s was compiled by an older version: compile it again" % (path,)
+                )
+            raise ValueError("%s is not a compiled block list" % (path,))
+
+        capacity = _table_capacity(count)
+        self._mask = capacity - 1
+        table_start = _HEADER.size
+        table_end = table_start + capacity * _UINT64.size
+        if table_end > len(self._buf):
+            raise ValueError("%s is truncated or corrupt" % (path,))
+
+        self._table: Sequence[int]
+        if sys.byteorder == "little":
+            self._table = memoryview(self._buf)[table_start:table_end].cast("Q")
+        else:
+            table = array.array("Q", self._buf[table_start:table_end])
+            table.byteswap()
+            self._table = table
+
+    def __contains__(self, domain: bytes) -> bool:
+        """Check if any rule matches the given domain
+
+        Like `DomainBlockList`, checks each suffix of the domain which starts on a
+        label boundary, and wildcard rules only match the shorter suffixes.
+        """
+        buf = self._buf
+        table = self._table
+        mask = self._mask
+        is_parent = False
+        start = 0
+        while True:
+            suffix = domain[start:] if start else domain
+            suffix_hash = zlib.crc32(suffix)
+            slot = suffix_hash & mask
+            value = table[slot]
+            while value:
+                if value >> 32 == suffix_hash:
+                    # the record is the kind, the length, then the domain
+                    kind_offset = value & 0xFFFFFFFF
+                    domain_start = kind_offset + 2
+                    domain_end = domain_start + buf[kind_offset + 1]
+                    if buf[domain_start:domain_end] == suffix:
+                        kind = buf[kind_offset]
+                        if kind & _DOMAIN_RULE or (is_parent and kind & _WILDCARD_RULE):
+                            return True
+                        break
+                slot = (slot + 1) & mask
+                value = table[slot]
+
+            start = domain.find(b".", start) + 1
+            if not start:
+                return False
+            is_parent = True
+
+    def __len__(self) -> int:
+        return self._domain_count + self._wildcard_count
+
+
+def is_compiled_block_list(path: str) -> bool:
+    """Check whether the given file is a compiled block list, rather than text"""
+    with open(path, "rb") as fh:
+        magic = fh.read(len(COMPILED_BLOCK_LIST_MAGIC))
+    # files in older formats are reported as such, rather than read as text
+    return magic.startswith(_COMPILED_BLOCK_LIST_MAGIC_PREFIX)
+
+
+def load_domain_block_file(path: str, block_list: DomainBlockList):
+    """Add the rules from the given block list file, in either format
+
+    Compiled block lists are memory-mapped. Anything else is read as a text file with
+    one rule per line.
+    """
+    if is_compiled_block_list(path):
+        block_list.add_compiled(CompiledDomainBlockList(path))
+        return
+
+    with open(path, encoding="ascii") as fh:
+        block_list.update(fh)
+
+
+def find_rejected_email(
+    emails: Iterable[str], block_list: DomainBlockList
+) -> Optional[Tuple[str, str]]:
+    """Check a user's emails against the domain block list
+
+    Returns:
+        None if every email is acceptable. Otherwise, the reason for rejecting the
+        first email which is not ("unparsable_email" or "blocked_domain"), and the
+        email.
+    """
+    for email in emails:
+        parts = email.rsplit("@", 1)
+        if len(parts) != 2:
+            return "unparsable_email", email
+        if parts[1].lower() in block_list:
+            return "blocked_domain", email
+    return None
+
+
+def to_domain_block_list(rules: Iterable[str]) -> DomainBlockList:
+    """Converts an iterable of rules into a DomainBlockList, if it is not one already"""
+    if isinstance(rules, DomainBlockList):
+        return rules
+    return DomainBlockList(rules)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs blocking steps, such as rebuilding the domain block list or fsyncing the session
+journal, in a thread pool, so that they do not hold up the other requests which the
+Synapse worker is handling.
+
+The pool belongs to this module rather than being the reactor's shared pool, so that
+its size can be configured without affecting Synapse's own use of threads.
+"""
+
+import logging
+from typing import Any, Callable, Optional, TypeVar
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from synapse.module_api import make_deferred_yieldable
+
+from matrix_synapse_saml_mozilla._metrics import (
+    reactor_blocking_step_duration,
+    thread_pool_queued_steps,
+    thread_pool_step_duration,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREAD_POOL_SIZE = 4
+
+T = TypeVar("T")
+
+
+class Executor:
+    """Runs blocking steps in a thread pool
+
+    Args:
+        pool_size: the maximum number of threads. If 0, steps are run on the calling
+            thread instead, blocking the reactor.
+        reactor: the reactor to start and stop the pool with, and to deliver results
+            on. Defaults to the global reactor.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_THREAD_POOL_SIZE, reactor=None):
+        self.pool_size = pool_size
+        self._pool: Optional[ThreadPool] = None
+        if pool_size <= 0:
+            return
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._pool = ThreadPool(minthreads=0, maxthreads=pool_size, name="saml-mozilla")
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger("during", "shutdown", self._pool.stop)
+
+    def run(
+        self, step: str, f: Callable[..., T], *args, **kwargs
+    ) -> "defer.Deferred[T]":
+        """Run a blocking function
+
+        Args:
+            step: the name of the step, for metrics
+            f: the function to run
+            *args, **kwargs: the arguments to pass to `f`
+
+        Returns:
+            a Deferred which resolves to the result of `f`, on the reactor thread
+        """
+        if self._pool is None:
+            with reactor_blocking_step_duration.labels(step).time():
+                return defer.maybeDeferred(f, *args, **kwargs)
+
+        def run_in_thread():
+            thread_pool_queued_steps.dec()
+            with thread_pool_step_duration.labels(step).time():
+                return f(*args, **kwargs)
+
+        thread_pool_queued_steps.inc()
+        return make_deferred_yieldable(
+            threads.deferToThreadPool(self._reactor, self._pool, run_in_thread)
+        )
+
+
+_executor: Optional[Executor] = None
+
+
+def get_executor() -> Executor:
+    """Returns the executor for blocking steps, creating it if need be"""
+    global _executor
+    if _executor is None:
+        _executor = Executor()
+    return _executor
+
+
+def set_executor(executor: Executor):
+    """Replace the executor for blocking steps. Mostly useful for tests."""
+    global _executor
+    _executor = executor
+
+
+def parse_thread_pool_size(value: Any) -> int:
+    """Parse the `thread_pool_size` option of the module config"""
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise Exception("thread_pool_size must be a non-negative integer")
+    return value
+
+
+def configure_executor(pool_size: int):
+    """Use a thread pool of the given size for blocking steps
+
+    Both the mapping provider and the username picker resource call this, so it only
+    builds a new executor if the pool size has changed since the last call.
+    """
+    if _executor is not None and _executor.pool_size == pool_size:
+        return
+
+    logger.info("Using a thread pool of %i threads for blocking steps", pool_size)
+    set_executor(Executor(pool_size))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Looks up the Matrix users which have been registered for remote user ids.
+
+The username picker records each user's remote user id as an external id when it
+registers them, under SAML_AUTH_PROVIDER_ID, which is the auth provider id Synapse
+looks external ids up under when a returning user logs in.
+"""
+
+from typing import Dict, List, Optional
+
+import synapse.module_api
+
+# the auth provider id under which the picker records external ids
+SAML_AUTH_PROVIDER_ID = "saml"
+
+
+def _get_user_by_external_id_txn(
+    txn, auth_provider: str, external_id: str
+) -> Optional[str]:
+    txn.execute(
+        "SELECT user_id FROM user_external_ids"
+        " WHERE auth_provider = ? AND external_id = ?",
+        (auth_provider, external_id),
+    )
+    row = txn.fetchone()
+    return row[0] if row else None
+
+
+def _get_users_by_external_ids_txn(
+    txn, auth_provider: str, external_ids: List[str]
+) -> Dict[str, str]:
+    txn.execute(
+        "SELECT external_id, user_id FROM user_external_ids"
+        " WHERE auth_provider = ? AND external_id IN (%s)"
+        % (", ".join("?" for _ in external_ids),),
+        [auth_provider] + external_ids,
+    )
+    return dict(txn.fetchall())
+
+
+async def lookup_external_ids(
+    module_api: synapse.module_api.ModuleApi, remote_user_ids: List[str]
+) -> Dict[str, str]:
+    """Find the Matrix users registered for several remote user ids, with one query
+
+    Returns:
+        a map from each remote user id which has a Matrix user to the user id
+    """
+    if not remote_user_ids:
+        return {}
+    return await module_api.run_db_interaction(
+        "saml_mozilla_get_users_by_external_ids",
+        _get_users_by_external_ids_txn,
+        SAML_AUTH_PROVIDER_ID,
+        [str(remote_user_id) for remote_user_id in remote_user_ids],
+    )
+
+
+async def lookup_external_id(
+    module_api: synapse.module_api.ModuleApi, remote_user_id: str
+) -> Optional[str]:
+    """Find the Matrix user registered for the remote user id, if any"""
+    return await module_api.run_db_interaction(
+        "saml_mozilla_get_user_by_external_id",
+        _get_user_by_external_id_txn,
+        SAML_AUTH_PROVIDER_ID,
+        str(remote_user_id),
+    )
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The rules which a username must follow: which characters it may contain, which
+names are reserved, and which substrings are prohibited anywhere in it.
+
+The rules are compiled once, when the config is parsed, and are checked before any
+database access. Prohibited substrings are matched with an Aho-Corasick automaton,
+so checking a username takes time linear in its length, however many substrings
+there are. The same rules are served to the username picker page as JSON, so that
+it can reject usernames before they are submitted.
+"""
+
+import collections
+import json
+import logging
+import re
+from array import array
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+# the characters which are allowed in usernames, as the body of a regular expression
+# character class. Matches what Synapse allows for registration.
+ALLOWED_LOCALPART_CHARACTERS = "a-z0-9._=/-"
+
+_DISALLOWED_CHARACTER = re.compile("[^%s]" % (ALLOWED_LOCALPART_CHARACTERS,))
+
+# the reasons for rejecting a username
+EMPTY = "empty"
+INVALID_CHARACTERS = "invalid_characters"
+RESERVED = "reserved"
+PROHIBITED_SUBSTRING = "prohibited_substring"
+
+
+@attr.s(frozen=True, slots=True)
+class LocalpartRejection:
+    # one of the reasons above
+    reason = attr.ib(type=str)
+
+    # a message to show to the user
+    message = attr.ib(type=str)
+
+
+_REJECTIONS = {
+    EMPTY: LocalpartRejection(EMPTY, "Please enter a username."),
+    INVALID_CHARACTERS: LocalpartRejection(
+        INVALID_CHARACTERS,
+        "Invalid username. Only lowercase letters, digits, '.', '_', '-', '/' and"
+        " '=' are allowed.",
+    ),
+    RESERVED: LocalpartRejection(
+        RESERVED, "This username is reserved, please choose another."
+    ),
+    PROHIBITED_SUBSTRING: LocalpartRejection(
+        PROHIBITED_SUBSTRING, "This username is not allowed, please choose another."
+    ),
+}
+
+
+class SubstringMatcher:
+    """An Aho-Corasick automaton, which finds any of a set of patterns in a string
+
+    The patterns are built into a trie, with a failure link from each node to the
+    node for the longest proper suffix of its path which is also in the trie. A
+    string is matched by following the trie edges for each character in turn, and
+    the failure links when there is no edge, so each character is looked at a
+    bounded number of times.
+
+    The edges of all the nodes are held in a single dict keyed by `(node, character)`
+    packed into an int, rather than a dict per node, as there may be hundreds of
+    thousands of nodes.
+
+    Args:
+        patterns: the patterns to look for, which may only contain characters up to
+            U+00FF
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self._patterns: List[str] = []
+        self._edges: Dict[int, int] = {}
+        # for each node, the index of a pattern which ends there or at a node on its
+        # chain of failure links, or -1
+        self._matches = array("i", [-1])
+        self._fail = array("i", [0])
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    @property
+    def patterns(self) -> List[str]:
+        return self._patterns
+
+    def _add(self, pattern: str):
+        if not pattern:
+            return
+        if max(map(ord, pattern)) > 0xFF:
+            raise ValueError("Unsupported character in pattern %r" % (pattern,))
+
+        node = 0
+        for c in pattern:
+            key = node << 8 | ord(c)
+            child = self._edges.get(key)
+            if child is None:
+                child = len(self._matches)
+                self._edges[key] = child
+                self._matches.append(-1)
+                self._fail.append(0)
+            node = child
+
+        if self._matches[node] == -1:
+            self._matches[node] = len(self._patterns)
+            self._patterns.append(pattern)
+
+    def _link(self):
+        """Set the failure links, breadth first from the root"""
+        children: Dict[int, List[tuple]] = collections.defaultdict(list)
+        for key, child in self._edges.items():
+            children[key >> 8].append((key & 0xFF, child))
+
+        queue = collections.deque(child for _, child in children[0])
+        while queue:
+            node = queue.popleft()
+            for c, child in children.get(node, ()):
+                # the longest suffix of the child's path which is in the trie
+                fail = self._fail[node]
+                while fail and (fail << 8 | c) not in self._edges:
+                    fail = self._fail[fail]
+                fail = self._edges.get(fail << 8 | c, 0)
+                self._fail[child] = fail
+
+                if self._matches[child] == -1:
+                    self._matches[child] = self._matches[fail]
+                queue.append(child)
+
+    def find(self, text: str) -> Optional[str]:
+        """Returns one of the patterns which occurs in `text`, or None"""
+        edges = self._edges
+        fail = self._fail
+        matches = self._matches
+
+        node = 0
+        for ch in text:
+            c = ord(ch)
+            if c > 0xFF:
+                # no pattern contains this character
+                node = 0
+                continue
+            while True:
+                child = edges.get(node << 8 | c)
+                if child is not None or node == 0:
+                    break
+                node = fail[node]
+            node = child or 0
+            if matches[node] != -1:
+                return self._patterns[matches[node]]
+        return None
+
+
+class LocalpartValidator:
+    """Checks usernames against the rules
+
+    Args:
+        reserved: usernames which may not be registered
+        prohibited_substrings: strings which may not appear anywhere in a username
+    """
+
+    def __init__(
+        self, reserved: Iterable[str] = (), prohibited_substrings: Iterable[str] = ()
+    ):
+        self._reserved: FrozenSet[str] = frozenset(r.strip().lower() for r in reserved)
+
+        substrings = set()
+        for substring in prohibited_substrings:
+            substring = substring.strip().lower()
+            if not substring:
+                continue
+            if _DISALLOWED_CHARACTER.search(substring):
+                # usernames with this character are rejected anyway
+                logger.warning(
+                    "Ignoring prohibited substring %r, which could never match",
+                    substring,
+                )
+                continue
+            substrings.add(substring)
+        self._substrings = SubstringMatcher(sorted(substrings))
+        self._rules_json: Optional[bytes] = None
+
+    def check(self, localpart: str) -> Optional[LocalpartRejection]:
+        """Check a username against the rules
+
+        Returns:
+            None if the username may be registered, or else why it may not
+        """
+        if not localpart:
+            return _REJECTIONS[EMPTY]
+        if _DISALLOWED_CHARACTER.search(localpart):
+            return _REJECTIONS[INVALID_CHARACTERS]
+        if localpart in self._reserved:
+            return _REJECTIONS[RESERVED]
+        if self._substrings.find(localpart) is not None:
+            return _REJECTIONS[PROHIBITED_SUBSTRING]
+        return None
+
+    def is_valid(self, localpart: str) -> bool:
+        return self.check(localpart) is None
+
+    def to_json(self) -> bytes:
+        """Returns the rules, for the username picker page to check usernames with"""
+        if self._rules_json is None:
+            self._rules_json = json.dumps(
+                {
+                    "allowed_characters": ALLOWED_LOCALPART_CHARACTERS,
+                    "reserved": sorted(self._reserved),
+                    "prohibited_substrings": self._substrings.patterns,
+                    "messages": {
+                        reason: rejection.message
+                        for reason, rejection in _REJECTIONS.items()
+                    },
+                },
+                separators=(",", ":"),
+            ).encode("utf-8")
+        return self._rules_json
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, LocalpartValidator):
+            return NotImplemented
+        return (
+            self._reserved == other._reserved
+            and self._substrings.patterns == other._substrings.patterns
+        )
+
+    def __repr__(self) -> str:
+        return "LocalpartValidator(%i reserved, %i prohibited substrings)" % (
+            len(self._reserved),
+            len(self._substrings),
+        )
+
+
+def load_prohibited_substrings_file(path: str) -> List[str]:
+    """Read a file of prohibited substrings, one per line
+
+    Blank lines, and lines starting with "#", are ignored.
+    """
+    try:
+        with open(path, encoding="utf-8") as fh:
+            return [
+                line.strip()
+                for line in fh
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+    except Exception as e:
+        raise Exception("Error reading prohibited substrings file %s: %s" % (path, e))
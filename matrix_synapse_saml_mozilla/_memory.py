@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for keeping the in-memory session stores small: a bounded intern table, so
+that sessions can share the copies of strings which many of them hold, and a way to
+measure how much memory a store uses.
+"""
+
+import sys
+from typing import Any, Dict, Optional, Set
+
+
+class InternTable:
+    """Maps equal strings to a single shared copy
+
+    Unlike `sys.intern`, the table is bounded: once it holds `max_size` strings, the
+    oldest is forgotten to make room for each new one. Strings which were handed out
+    before being forgotten stay valid; they are just no longer shared with later
+    copies.
+
+    Lookups may race with each other when sessions are decoded in the thread pool.
+    The worst case is that two copies of a string are handed out, so there is no
+    lock.
+
+    Args:
+        max_size: the maximum number of strings to remember
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._table: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def intern(self, value: Optional[str]) -> Optional[str]:
+        """Returns the shared copy of `value`, adding it to the table if need be"""
+        if value is None:
+            return None
+        try:
+            return self._table[value]
+        except KeyError:
+            pass
+
+        table = self._table
+        if len(table) >= self._max_size:
+            try:
+                del table[next(iter(table))]
+            except (KeyError, RuntimeError, StopIteration):
+                # another thread changed the table under us
+                pass
+        return table.setdefault(value, value)
+
+
+def deep_sizeof(obj: Any, seen: Optional[Set[int]] = None) -> int:
+    """Returns the number of bytes used by an object and everything it refers to
+
+    Follows dicts, lists, tuples, sets and the attributes of objects with __slots__
+    or a __dict__. Objects which are referred to more than once, such as interned
+    strings, are only counted once.
+
+    Args:
+        obj: the object to measure
+        seen: the ids of objects which have already been counted, to share the
+            count between several calls
+    """
+    if seen is None:
+        seen = set()
+
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            for cls in type(obj).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    if not slot.startswith("__") and hasattr(obj, slot):
+                        stack.append(getattr(obj, slot))
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+    return size
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prometheus metrics for this module. They are registered with the default registry,
+which Synapse exports on its metrics listener.
+"""
+
+import functools
+
+from prometheus_client import Counter, Gauge, Histogram
+
+block_list_reloads = Counter(
+    "synapse_saml_mozilla_block_list_reloads_total",
+    "Number of times the domain block file has been reloaded",
+    ["result"],
+)
+
+block_list_reload_duration = Histogram(
+    "synapse_saml_mozilla_block_list_reload_seconds",
+    "Time taken to reload the domain block file",
+)
+
+block_list_rules = Gauge(
+    "synapse_saml_mozilla_block_list_rules", "Number of rules in the domain block list",
+)
+
+saml_response_duration = Histogram(
+    "synapse_saml_mozilla_saml_response_seconds",
+    "Time taken to map a SAML response, including rejected responses",
+)
+
+rejected_saml_responses = Counter(
+    "synapse_saml_mozilla_rejected_saml_responses_total",
+    "Number of SAML responses rejected by the mapping provider",
+    ["reason"],
+)
+
+live_sessions = Gauge(
+    "synapse_saml_mozilla_sessions",
+    "Number of live username mapping sessions, as counted when expired sessions"
+    " were last reaped",
+)
+
+session_store_memory = Gauge(
+    "synapse_saml_mozilla_session_store_bytes",
+    "Estimated memory used by the username mapping sessions held in this process",
+)
+
+expired_sessions = Counter(
+    "synapse_saml_mozilla_expired_sessions_total",
+    "Number of username mapping sessions which have expired",
+)
+
+check_duration = Histogram(
+    "synapse_saml_mozilla_check_seconds", "Time taken to handle a /check request"
+)
+
+check_user_exists_duration = Histogram(
+    "synapse_saml_mozilla_check_user_exists_seconds",
+    "Time spent checking the database for existing users",
+)
+
+check_batch_duration = Histogram(
+    "synapse_saml_mozilla_check_batch_seconds",
+    "Time taken to handle a /check_batch request",
+)
+
+page_duration = Histogram(
+    "synapse_saml_mozilla_page_seconds",
+    "Time taken to render the username picker page",
+)
+
+submit_duration = Histogram(
+    "synapse_saml_mozilla_submit_seconds", "Time taken to handle a /submit request"
+)
+
+submit_step_duration = Histogram(
+    "synapse_saml_mozilla_submit_step_seconds",
+    "Time spent in each step of handling a /submit request",
+    ["step"],
+)
+
+rejected_localparts = Counter(
+    "synapse_saml_mozilla_rejected_localparts_total",
+    "Number of usernames rejected by the username rules, before any database access",
+    ["reason"],
+)
+
+availability_cache_lookups = Counter(
+    "synapse_saml_mozilla_availability_cache_lookups_total",
+    "Number of /check lookups in the cache of unavailable usernames",
+    ["result"],
+)
+
+registered_users_filter_lookups = Counter(
+    "synapse_saml_mozilla_registered_users_filter_lookups_total",
+    "Number of usernames looked up in the filter of registered users",
+    ["result"],
+)
+
+registered_users_filter_rebuilds = Counter(
+    "synapse_saml_mozilla_registered_users_filter_rebuilds_total",
+    "Number of attempts to build the filter of registered users",
+    ["result"],
+)
+
+registered_users_filter_rebuild_duration = Histogram(
+    "synapse_saml_mozilla_registered_users_filter_rebuild_seconds",
+    "Time taken to build the filter of registered users",
+)
+
+registered_users_filter_size = Gauge(
+    "synapse_saml_mozilla_registered_users_filter_bytes",
+    "Size of the filter of registered users",
+)
+
+rate_limited_requests = Counter(
+    "synapse_saml_mozilla_rate_limited_requests_total",
+    "Number of username picker requests rejected by the rate limiter",
+    ["endpoint"],
+)
+
+reactor_blocking_step_duration = Histogram(
+    "synapse_saml_mozilla_reactor_blocking_step_seconds",
+    "Time for which blocking steps held up the reactor thread, because the thread"
+    " pool is disabled",
+    ["step"],
+)
+
+thread_pool_step_duration = Histogram(
+    "synapse_saml_mozilla_thread_pool_step_seconds",
+    "Time taken by blocking steps which were run in the thread pool",
+    ["step"],
+)
+
+thread_pool_queued_steps = Gauge(
+    "synapse_saml_mozilla_thread_pool_queued_steps",
+    "Number of blocking steps waiting for a thread in the thread pool",
+)
+
+audit_events_written = Counter(
+    "synapse_saml_mozilla_audit_events_written_total",
+    "Number of audit events written to the audit sink",
+)
+
+audit_events_dropped = Counter(
+    "synapse_saml_mozilla_audit_events_dropped_total",
+    "Number of audit events which were not written, because the queue was full or"
+    " the audit sink failed",
+    ["reason"],
+)
+
+audit_queued_events = Gauge(
+    "synapse_saml_mozilla_audit_queued_events",
+    "Number of audit events waiting to be written",
+)
+
+
+def time_async(histogram: Histogram):
+    """A decorator which records the duration of an async function in a histogram"""
+
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapped(*args, **kwargs):
+            with histogram.time():
+                return await f(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
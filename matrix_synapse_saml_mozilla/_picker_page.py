@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import html
+import os
+from typing import Iterable, Optional
+
+TEMPLATE_FILE_NAME = "pick_username.html"
+STYLE_FILE_NAME = "style.css"
+SCRIPT_FILE_NAME = "script.js"
+
+
+def _read(path: str) -> str:
+    with open(path, encoding="utf-8") as fh:
+        return fh.read()
+
+
+class PickerPageTemplate:
+    """The username picker page, rendered on the server
+
+    The stylesheet and script, which live alongside the template, are inlined into
+    the page, so that it can be shown without any further requests.
+    """
+
+    def __init__(self, template_dir: str):
+        self._template = _read(os.path.join(template_dir, TEMPLATE_FILE_NAME))
+        self._style = _read(os.path.join(template_dir, STYLE_FILE_NAME))
+        self._script = _read(os.path.join(template_dir, SCRIPT_FILE_NAME))
+
+    def render(
+        self,
+        username: str = "",
+        error: Optional[str] = None,
+        suggestions: Iterable[str] = (),
+    ) -> bytes:
+        """Render the page
+
+        Args:
+            username: the username to fill in
+            error: a message explaining why the last username was not accepted
+            suggestions: available usernames to offer along with the error
+        """
+        message = ""
+        if error:
+            message = html.escape(error)
+            links = [
+                '<a href="#" class="suggestion" data-username="%s">%s</a>'
+                % (html.escape(s), html.escape(s))
+                for s in suggestions
+            ]
+            if links:
+                message += " Available: " + ", ".join(links)
+
+        return self._template.format(
+            style=self._style,
+            script=self._script,
+            username=html.escape(username),
+            username_class="has-contents" if username else "",
+            message=message,
+            message_class="tooltip" if message else "tooltip hidden",
+        ).encode("utf-8")
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Registers users in bulk, from a list of remote user ids and the localparts which they
+should have, so that users who are known in advance need not go through the
+username picker.
+
+Records are streamed, and processed in batches. For each batch, the remote user ids
+which already have a Matrix user and the localparts which are taken are looked up
+together, and then the remaining users are registered, with a bounded number of
+registrations in flight at once. The module API can only register one user at a
+time, so the registrations themselves are not batched.
+
+Remote user ids which already have a Matrix user are skipped, so the same input can
+be run again after a failure. The number of records which have been completely
+processed is reported after each batch, so that the re-run can skip them.
+"""
+
+import abc
+import collections
+import csv
+import itertools
+import json
+import logging
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+import attr
+from twisted.internet import defer
+
+import synapse.module_api
+from synapse.module_api import make_deferred_yieldable, run_in_background
+from synapse.module_api.errors import SynapseError
+
+from matrix_synapse_saml_mozilla._availability import UsernameAvailabilityChecker
+from matrix_synapse_saml_mozilla._cache import TTLCache
+from matrix_synapse_saml_mozilla._domains import DomainBlockList, find_rejected_email
+from matrix_synapse_saml_mozilla._external_ids import (
+    SAML_AUTH_PROVIDER_ID,
+    lookup_external_ids,
+)
+
+logger = logging.getLogger(__name__)
+
+INPUT_FORMATS = ("csv", "jsonl")
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 4
+
+# the outcomes of provisioning a record, as well as the reasons for rejecting an
+# email which find_rejected_email gives
+REGISTERED = "registered"
+ALREADY_PROVISIONED = "already_provisioned"
+DUPLICATE = "duplicate"
+MISSING_EMAIL = "missing_email"
+LOCALPART_TAKEN = "localpart_taken"
+FAILED = "failed"
+
+
+@attr.s(frozen=True, slots=True)
+class ProvisioningRecord:
+    """A user to be provisioned"""
+
+    remote_user_id = attr.ib(type=str)
+    localpart = attr.ib(type=str)
+    displayname = attr.ib(type=Optional[str], default=None)
+    emails = attr.ib(type=Tuple[str, ...], default=(), converter=tuple)
+
+
+@attr.s(frozen=True, slots=True)
+class ProvisioningOutcome:
+    record = attr.ib(type=ProvisioningRecord)
+
+    # REGISTERED, or why the record was not registered
+    outcome = attr.ib(type=str)
+
+    # the Matrix user for the record, if it was registered or already provisioned
+    user_id = attr.ib(type=Optional[str], default=None)
+
+    error = attr.ib(type=Optional[str], default=None)
+
+
+class ProvisioningError(Exception):
+    """A homeserver rejected a registration
+
+    Args:
+        errcode: the Matrix error code, such as M_USER_IN_USE
+        msg: a description of the error
+    """
+
+    def __init__(self, errcode: str, msg: str):
+        super().__init__("%s: %s" % (errcode, msg))
+        self.errcode = errcode
+        self.msg = msg
+
+
+def _parse_record(fields: dict, line_number: int) -> ProvisioningRecord:
+    remote_user_id = fields.get("remote_user_id")
+    localpart = fields.get("localpart")
+    if not remote_user_id or not localpart:
+        raise Exception(
+            "Line %i: remote_user_id and localpart are required" % (line_number,)
+        )
+
+    emails = fields.get("emails") or ()
+    if isinstance(emails, str):
+        emails = emails.split()
+
+    return ProvisioningRecord(
+        remote_user_id=str(remote_user_id),
+        localpart=str(localpart),
+        displayname=fields.get("displayname") or None,
+        emails=emails,
+    )
+
+
+def read_records(fh: TextIO, input_format: str) -> Iterator[ProvisioningRecord]:
+    """Stream the records from a file
+
+    Each record has a `remote_user_id` and a `localpart`, and may have a
+    `displayname` and `emails`. CSV files must start with a header row naming the
+    columns, and several emails are separated by spaces. JSONL files have one JSON
+    object per line, whose `emails` is a list.
+
+    Args:
+        fh: the file to read
+        input_format: one of INPUT_FORMATS
+
+    Raises:
+        Exception if a record is invalid
+    """
+    if input_format == "csv":
+        reader = csv.DictReader(fh)
+        for row in reader:
+            yield _parse_record(row, reader.line_num)
+        return
+
+    for line_number, line in enumerate(fh, 1):
+        if not line.strip():
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError as e:
+            raise Exception("Line %i: %s" % (line_number, e))
+        if not isinstance(fields, dict):
+            raise Exception("Line %i: expected a JSON object" % (line_number,))
+        yield _parse_record(fields, line_number)
+
+
+class ProvisioningBackend(abc.ABC):
+    """Looks up and registers users on a homeserver"""
+
+    @abc.abstractmethod
+    async def get_provisioned(self, remote_user_ids: List[str]) -> Dict[str, str]:
+        """Find the Matrix users which already exist for the remote user ids
+
+        Returns:
+            a map from each remote user id which has a Matrix user to the user id
+        """
+
+    @abc.abstractmethod
+    async def check_available(self, localparts: List[str]) -> Dict[str, bool]:
+        """Check if each of the localparts is available"""
+
+    @abc.abstractmethod
+    async def provision(self, record: ProvisioningRecord) -> str:
+        """Register a user for the record, and record its remote user id
+
+        Returns:
+            the new user id
+
+        Raises:
+            ProvisioningError if the homeserver rejected the registration
+        """
+
+    async def resume(self, record: ProvisioningRecord) -> Optional[str]:
+        """Finish provisioning a record whose localpart is taken, if an earlier call
+        to `provision` registered the user but failed to record its remote user id
+
+        Backends which register the user and record its remote user id separately,
+        and which can tell the users they registered from other users, should
+        override this.
+
+        Returns:
+            the user id, if the record's remote user id has now been recorded for
+            it, or None if the localpart was taken by another user
+        """
+        return None
+
+
+class ModuleApiProvisioningBackend(ProvisioningBackend):
+    """Provisions users through the Synapse module API, from inside Synapse"""
+
+    def __init__(self, module_api: synapse.module_api.ModuleApi):
+        self._module_api = module_api
+        self._availability_checker = UsernameAvailabilityChecker(
+            module_api, TTLCache(max_size=DEFAULT_BATCH_SIZE, ttl=60)
+        )
+
+    async def get_provisioned(self, remote_user_ids: List[str]) -> Dict[str, str]:
+        return await lookup_external_ids(self._module_api, remote_user_ids)
+
+    async def check_available(self, localparts: List[str]) -> Dict[str, bool]:
+        return await self._availability_checker.check_many(localparts)
+
+    async def provision(self, record: ProvisioningRecord) -> str:
+        try:
+            user_id = await self._module_api.register_user(
+                localpart=record.localpart,
+                displayname=record.displayname or record.localpart,
+            )
+        except SynapseError as e:
+            raise ProvisioningError(e.errcode, e.msg)
+
+        await self._module_api.record_user_external_id(
+            SAML_AUTH_PROVIDER_ID, record.remote_user_id, user_id
+        )
+        return user_id
+
+
+def _batches(
+    records: Iterable[ProvisioningRecord], size: int
+) -> Iterator[List[ProvisioningRecord]]:
+    it = iter(records)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Provisioner:
+    """Provisions users in batches
+
+    Records are checked against the domain block list as the mapping provider checks
+    SAML responses, so records with no emails, or with an email in a blocked domain,
+    are not registered.
+
+    Args:
+        backend: the homeserver to provision users on
+        block_list: the domains to refuse users from
+        batch_size: the number of records to look up together
+        concurrency: the maximum number of registrations in flight at once
+    """
+
+    def __init__(
+        self,
+        backend: ProvisioningBackend,
+        block_list: DomainBlockList,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self._backend = backend
+        self._block_list = block_list
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+
+    async def run(
+        self,
+        records: Iterable[ProvisioningRecord],
+        skip: int = 0,
+        on_outcome: Optional[Callable[[ProvisioningOutcome], None]] = None,
+        on_batch: Optional[Callable[[int], None]] = None,
+    ) -> Dict[str, int]:
+        """Provision the records
+
+        Args:
+            records: the records to provision
+            skip: the number of records at the start to skip, because a previous run
+                processed them
+            on_outcome: called with the outcome of each record, in order
+            on_batch: called after each batch with the number of records which have
+                been processed, including those which were skipped
+
+        Returns:
+            the number of records with each outcome
+        """
+        counts: Dict[str, int] = collections.Counter()
+        processed = skip
+        for batch in _batches(itertools.islice(records, skip, None), self._batch_size):
+            for outcome in await self._provision_batch(batch):
+                counts[outcome.outcome] += 1
+                if on_outcome is not None:
+                    on_outcome(outcome)
+
+            processed += len(batch)
+            logger.info("Processed %i records", processed)
+            if on_batch is not None:
+                on_batch(processed)
+        return dict(counts)
+
+    async def _provision_batch(
+        self, batch: List[ProvisioningRecord]
+    ) -> List[ProvisioningOutcome]:
+        outcomes: List[Optional[ProvisioningOutcome]] = [None] * len(batch)
+
+        # the records which pass each check, by their index in the batch
+        pending: Dict[int, ProvisioningRecord] = {}
+        remote_user_ids = set()
+        localparts = set()
+        for index, record in enumerate(batch):
+            rejection = self._check(record)
+            if rejection is None:
+                if record.remote_user_id in remote_user_ids:
+                    rejection = DUPLICATE, "remote user id appears more than once"
+                elif record.localpart.lower() in localparts:
+                    rejection = LOCALPART_TAKEN, "localpart appears more than once"
+
+            if rejection is not None:
+                outcomes[index] = ProvisioningOutcome(
+                    record, rejection[0], error=rejection[1]
+                )
+            else:
+                pending[index] = record
+                remote_user_ids.add(record.remote_user_id)
+                localparts.add(record.localpart.lower())
+
+        provisioned = await self._backend.get_provisioned(
+            [record.remote_user_id for record in pending.values()]
+        )
+        for index, record in list(pending.items()):
+            user_id = provisioned.get(record.remote_user_id)
+            if user_id is not None:
+                outcomes[index] = ProvisioningOutcome(
+                    record, ALREADY_PROVISIONED, user_id=user_id
+                )
+                del pending[index]
+
+        available = await self._backend.check_available(
+            [record.localpart for record in pending.values()]
+        )
+        for index, record in list(pending.items()):
+            if not available[record.localpart]:
+                del pending[index]
+                user_id = await self._backend.resume(record)
+                if user_id is not None:
+                    logger.info(
+                        "Recorded %s for %s, which was registered by an earlier run",
+                        record.remote_user_id,
+                        user_id,
+                    )
+                    outcomes[index] = ProvisioningOutcome(
+                        record, REGISTERED, user_id=user_id
+                    )
+                else:
+                    outcomes[index] = ProvisioningOutcome(record, LOCALPART_TAKEN)
+
+        semaphore = defer.DeferredSemaphore(self._concurrency)
+        try:
+            registered = await make_deferred_yieldable(
+                defer.gatherResults(
+                    [
+                        run_in_background(self._provision, semaphore, record)
+                        for record in pending.values()
+                    ],
+                    consumeErrors=True,
+                )
+            )
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+
+        for index, outcome in zip(pending, registered):
+            outcomes[index] = outcome
+
+        return outcomes
+
+    def _check(self, record: ProvisioningRecord) -> Optional[Tuple[str, str]]:
+        """Check the record's emails, as the mapping provider would
+
+        Returns:
+            None if the record may be registered, or else the outcome and error
+        """
+        if not record.emails:
+            return MISSING_EMAIL, "no emails"
+        rejected = find_rejected_email(record.emails, self._block_list)
+        if rejected is not None:
+            return rejected
+        return None
+
+    async def _provision(
+        self, semaphore: defer.DeferredSemaphore, record: ProvisioningRecord
+    ) -> ProvisioningOutcome:
+        await make_deferred_yieldable(semaphore.acquire())
+        try:
+            user_id = await self._backend.provision(record)
+        except ProvisioningError as e:
+            logger.warning("Unable to register %s: %s", record.localpart, e)
+            outcome = LOCALPART_TAKEN if e.errcode == "M_USER_IN_USE" else FAILED
+            return ProvisioningOutcome(record, outcome, error=e.msg)
+        finally:
+            semaphore.release()
+
+        logger.info("Registered %s for %s", user_id, record.remote_user_id)
+        return ProvisioningOutcome(record, REGISTERED, user_id=user_id)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import time
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+import attr
+
+
+@attr.s(frozen=True)
+class RateLimitConfig:
+    # the rate at which actions are allowed, on average
+    per_second = attr.ib(type=float)
+
+    # the number of actions which may be performed in a burst
+    burst_count = attr.ib(type=int)
+
+
+def parse_rate_limit_config(config: dict, default: RateLimitConfig) -> RateLimitConfig:
+    parsed = RateLimitConfig(
+        per_second=float(config.get("per_second", default.per_second)),
+        burst_count=int(config.get("burst_count", default.burst_count)),
+    )
+    if parsed.per_second <= 0:
+        raise Exception("rate_limiting per_second must be positive")
+    if parsed.burst_count < 1:
+        raise Exception("rate_limiting burst_count must be at least 1")
+    return parsed
+
+
+def parse_max_tracked_keys(value: Any) -> int:
+    """Parse the `max_tracked_keys` option of the rate limiting config"""
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise Exception("rate_limiting max_tracked_keys must be a positive integer")
+    return value
+
+
+class TokenBucketRateLimiter:
+    """Limits the rate of actions for each of many keys, using token buckets
+
+    Each key has a bucket of up to `burst_count` tokens, which refills at
+    `per_second` tokens per second. Each action takes a token.
+
+    Only keys with a partly-empty bucket need to be tracked, since a full bucket is
+    the same as no bucket at all. Buckets are kept in least-recently-used order and
+    the oldest are evicted when there are more than `max_keys`, so memory is bounded
+    even if there are many distinct keys.
+
+    Args:
+        config: the rate and burst size
+        max_keys: the maximum number of buckets to keep
+    """
+
+    def __init__(
+        self,
+        config: RateLimitConfig,
+        max_keys: int,
+        gettime: Callable[[], float] = time.monotonic,
+    ):
+        self._rate = config.per_second
+        self._burst_count = config.burst_count
+        self._max_keys = max_keys
+        self._gettime = gettime
+
+        # map from key to (tokens, time the tokens were counted), in
+        # least-recently-used order
+        self._buckets: "collections.OrderedDict[Hashable, Tuple[float, float]]" = (
+            collections.OrderedDict()
+        )
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        """Returns the number of tokens in the key's bucket"""
+        tokens, last_update = self._buckets.get(key, (self._burst_count, now))
+        return min(self._burst_count, tokens + (now - last_update) * self._rate)
+
+    def check(self, key: Hashable) -> float:
+        """Check if there is a token in the key's bucket, without taking it
+
+        Returns:
+            0 if the action would be allowed; otherwise the number of seconds until
+            it would be.
+        """
+        tokens = self._tokens(key, self._gettime())
+        if tokens < 1:
+            return (1 - tokens) / self._rate
+        return 0
+
+    def take(self, key: Hashable):
+        """Take a token from the key's bucket, which must have one"""
+        now = self._gettime()
+        tokens = self._tokens(key, now)
+        self._buckets.pop(key, None)
+        self._buckets[key] = (tokens - 1, now)
+        while len(self._buckets) > self._max_keys:
+            self._buckets.popitem(last=False)
+
+    def try_acquire(self, key: Hashable) -> float:
+        """Take a token from the key's bucket, if there is one
+
+        Returns:
+            0 if the action is allowed; otherwise the number of seconds until it
+            would be.
+        """
+        wait = self.check(key)
+        if not wait:
+            self.take(key)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class RequestRateLimiter:
+    """Limits the rate of requests from each client IP and from each session
+
+    Args:
+        per_ip: the limit for each client IP, or None for no limit
+        per_session: the limit for each session, or None for no limit
+        max_keys: the maximum number of IPs, and of sessions, to track
+    """
+
+    def __init__(
+        self,
+        per_ip: Optional[RateLimitConfig],
+        per_session: Optional[RateLimitConfig],
+        max_keys: int,
+        gettime: Callable[[], float] = time.monotonic,
+    ):
+        self._ip_limiter = (
+            TokenBucketRateLimiter(per_ip, max_keys, gettime)
+            if per_ip is not None
+            else None
+        )
+        self._session_limiter = (
+            TokenBucketRateLimiter(per_session, max_keys, gettime)
+            if per_session is not None
+            else None
+        )
+
+    def try_acquire(self, client_ip: str, session_id: str) -> float:
+        """Count a request against the limits for its IP and session
+
+        A request which is refused by either limit is not counted against the
+        other.
+
+        Returns:
+            0 if the request is allowed; otherwise the number of seconds until it
+            would be.
+        """
+        buckets = [
+            (limiter, key)
+            for limiter, key in (
+                (self._ip_limiter, client_ip),
+                (self._session_limiter, session_id),
+            )
+            if limiter is not None
+        ]
+        wait = max((limiter.check(key) for limiter, key in buckets), default=0)
+        if not wait:
+            for limiter, key in buckets:
+                limiter.take(key)
+        return wait
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in-memory Bloom filter of the registered user IDs, so that most checks of free
+usernames can be answered without a database query.
+
+The filter is built by reading the users table a page at a time, and rebuilt
+periodically to pick up users registered by other workers or through other routes.
+Users registered by the username picker are added as they are registered. A user
+which is not in the filter may still have been registered since the last rebuild,
+so the filter is only used to say whether a username looks free: `register_user`
+still refuses usernames which are taken.
+"""
+
+import logging
+import time
+from typing import List, Optional
+
+import attr
+from twisted.internet import defer
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet.task import LoopingCall
+
+import synapse.module_api
+
+from matrix_synapse_saml_mozilla._bloom import BloomFilter, bloom_filter_parameters
+from matrix_synapse_saml_mozilla._metrics import (
+    registered_users_filter_lookups,
+    registered_users_filter_rebuild_duration,
+    registered_users_filter_rebuilds,
+    registered_users_filter_size,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_PAGE_SIZE = 10000
+DEFAULT_REBUILD_INTERVAL = 300
+
+# the filter is sized for this many times the number of users when it is built, so
+# that the users registered before the next rebuild do not raise its false positive
+# rate much
+CAPACITY_HEADROOM = 1.5
+MIN_CAPACITY = 10000
+
+
+@attr.s(frozen=True)
+class RegisteredUsersFilterConfig:
+    # the fraction of free usernames which the filter may report as maybe taken, so
+    # that they are checked against the database
+    false_positive_rate = attr.ib(type=float, default=DEFAULT_FALSE_POSITIVE_RATE)
+
+    # the maximum size of the filter, in bytes. If the false positive rate would
+    # need a bigger filter, the rate rises instead.
+    max_size = attr.ib(type=int, default=DEFAULT_MAX_SIZE)
+
+    # the number of users to read from the database at once
+    page_size = attr.ib(type=int, default=DEFAULT_PAGE_SIZE)
+
+    # how often to rebuild the filter, in seconds
+    rebuild_interval = attr.ib(type=float, default=DEFAULT_REBUILD_INTERVAL)
+
+
+def parse_registered_users_filter_config(config: dict) -> RegisteredUsersFilterConfig:
+    """Parse the `registered_users_filter` section of the module config
+
+    Args:
+        config: the `registered_users_filter` section of the config
+
+    Returns:
+        the parsed config
+    """
+    parsed = RegisteredUsersFilterConfig(
+        false_positive_rate=config.get(
+            "false_positive_rate", DEFAULT_FALSE_POSITIVE_RATE
+        ),
+        max_size=config.get("max_size", DEFAULT_MAX_SIZE),
+        page_size=config.get("page_size", DEFAULT_PAGE_SIZE),
+        rebuild_interval=config.get("rebuild_interval", DEFAULT_REBUILD_INTERVAL),
+    )
+
+    if not 0 < parsed.false_positive_rate < 1:
+        raise Exception(
+            "registered_users_filter.false_positive_rate must be between 0 and 1"
+        )
+    if parsed.max_size < 1 or parsed.page_size < 1:
+        raise Exception(
+            "registered_users_filter.max_size and page_size must be positive"
+        )
+    if parsed.rebuild_interval <= 0:
+        raise Exception("registered_users_filter.rebuild_interval must be positive")
+
+    return parsed
+
+
+def _count_users_txn(txn) -> int:
+    txn.execute("SELECT COUNT(*) FROM users")
+    return txn.fetchone()[0]
+
+
+def _add_users_page_txn(
+    txn, bloom: BloomFilter, after: Optional[str], limit: int
+) -> Optional[str]:
+    """Add the next page of users to a filter which is being built
+
+    The filter is not yet in use, so it is safe to change it on the database thread.
+
+    Returns:
+        the last user ID in the page, or None if there were no more users
+    """
+    if after is None:
+        txn.execute("SELECT name FROM users ORDER BY name LIMIT ?", (limit,))
+    else:
+        txn.execute(
+            "SELECT name FROM users WHERE name > ? ORDER BY name LIMIT ?",
+            (after, limit),
+        )
+    rows = txn.fetchall()
+    for (name,) in rows:
+        bloom.add(name.lower())
+    return rows[-1][0] if rows else None
+
+
+class RegisteredUsersFilter:
+    """A Bloom filter of the registered user IDs, which is rebuilt periodically
+
+    Until the filter has been built, every user ID may be registered.
+
+    Args:
+        module_api: the Synapse module API, to read the users table with
+        config: the size of the filter, and how it is built
+        clock: the reactor to schedule rebuilds on. Defaults to the global reactor.
+    """
+
+    def __init__(
+        self,
+        module_api: synapse.module_api.ModuleApi,
+        config: RegisteredUsersFilterConfig,
+        clock: Optional[IReactorTime] = None,
+    ):
+        self._module_api = module_api
+        self._config = config
+        self._filter: Optional[BloomFilter] = None
+
+        # the user IDs registered while a new filter is being built, to be added to
+        # it once the build is finished. None if no build is running.
+        self._registered_during_build: Optional[List[str]] = None
+
+        self._looping_call = LoopingCall(lambda: defer.ensureDeferred(self.rebuild()))
+        if clock is not None:
+            self._looping_call.clock = clock
+
+    def start(self):
+        """Build the filter now, and then rebuild it periodically"""
+        self._looping_call.start(self._config.rebuild_interval, now=True)
+
+    def stop(self):
+        self._looping_call.stop()
+
+    @property
+    def ready(self) -> bool:
+        """Whether the filter has been built"""
+        return self._filter is not None
+
+    @property
+    def size(self) -> int:
+        """The size of the filter, in bytes, or 0 if it has not been built"""
+        return self._filter.size if self._filter is not None else 0
+
+    def may_be_registered(self, user_id: str) -> bool:
+        """Check the filter for a user ID
+
+        Returns:
+            False if the user ID is definitely not registered (or was not, when the
+            filter was last built), or True if it needs checking in the database
+        """
+        if self._filter is None:
+            registered_users_filter_lookups.labels("not_ready").inc()
+            return True
+        if user_id.lower() in self._filter:
+            registered_users_filter_lookups.labels("maybe_registered").inc()
+            return True
+        registered_users_filter_lookups.labels("not_registered").inc()
+        return False
+
+    def add(self, user_id: str):
+        """Record that a user ID has been registered"""
+        user_id = user_id.lower()
+        if self._filter is not None:
+            self._filter.add(user_id)
+        if self._registered_during_build is not None:
+            self._registered_during_build.append(user_id)
+
+    async def rebuild(self):
+        """Build a new filter from the users table, and swap it in
+
+        If the build fails, the old filter is kept.
+        """
+        if self._registered_during_build is not None:
+            logger.info("Registered users filter is still being built: skipping")
+            return
+
+        self._registered_during_build = []
+        start = time.perf_counter()
+        try:
+            bloom = await self._build()
+        except Exception:
+            registered_users_filter_rebuilds.labels("failure").inc()
+            logger.exception("Error building registered users filter")
+            return
+        finally:
+            registered_during_build = self._registered_during_build
+            self._registered_during_build = None
+
+        bloom.update(registered_during_build)
+        self._filter = bloom
+
+        duration = time.perf_counter() - start
+        registered_users_filter_rebuilds.labels("success").inc()
+        registered_users_filter_rebuild_duration.observe(duration)
+        registered_users_filter_size.set(bloom.size)
+        logger.info(
+            "Built registered users filter in %.3fs: %i users in %i bytes,"
+            " false positive rate %.4f",
+            duration,
+            len(bloom),
+            bloom.size,
+            bloom.false_positive_rate(),
+        )
+
+    async def _build(self) -> BloomFilter:
+        count = await self._module_api.run_db_interaction(
+            "saml_mozilla_count_users", _count_users_txn
+        )
+        capacity = max(int(count * CAPACITY_HEADROOM), MIN_CAPACITY)
+        bits, hashes = bloom_filter_parameters(
+            capacity, self._config.false_positive_rate, self._config.max_size
+        )
+        if bits == self._config.max_size * 8:
+            logger.warning(
+                "Registered users filter is limited to %i bytes: its false positive"
+                " rate will be higher than %s",
+                self._config.max_size,
+                self._config.false_positive_rate,
+            )
+        bloom = BloomFilter(bits, hashes)
+
+        last_user_id: Optional[str] = None
+        while True:
+            last_user_id = await self._module_api.run_db_interaction(
+                "saml_mozilla_get_registered_users_page",
+                _add_users_page_txn,
+                bloom,
+                last_user_id,
+                self._config.page_size,
+            )
+            if last_user_id is None:
+                return bloom
@@ -0,0 +1,886 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Session stores which can be shared between several Synapse worker processes, so that
+any worker can serve any step of the username picker flow.
+"""
+
+import base64
+import binascii
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+
+import attr
+from twisted.internet import defer
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet.task import LoopingCall
+
+from matrix_synapse_saml_mozilla._executor import Executor, get_executor
+from matrix_synapse_saml_mozilla._memory import deep_sizeof
+from matrix_synapse_saml_mozilla._sessions import (
+    InMemorySessionStore,
+    SessionStore,
+    UsernameMappingSession,
+    set_session_store,
+)
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE_TYPES = ("memory", "sqlite", "redis", "signed_token", "journal")
+
+DEFAULT_REDIS_KEY_PREFIX = "saml_mapping_session:"
+
+DEFAULT_REPLAY_CACHE_SIZE = 10000
+
+DEFAULT_JOURNAL_FLUSH_INTERVAL = 1.0
+
+# the journal is not compacted until it has at least this many records
+JOURNAL_COMPACTION_MIN_RECORDS = 1000
+
+
+@attr.s(frozen=True)
+class SessionStoreConfig:
+    # one of SESSION_STORE_TYPES
+    type = attr.ib(type=str, default="memory")
+
+    # path to the database file, for the sqlite store
+    path = attr.ib(type=Optional[str], default=None)
+
+    # redis:// URL of the server, for the redis store
+    url = attr.ib(type=Optional[str], default=None)
+
+    # prefix for the keys used by the redis store
+    key_prefix = attr.ib(type=str, default=DEFAULT_REDIS_KEY_PREFIX)
+
+    # HMAC key, for the signed_token store
+    secret = attr.ib(type=Optional[str], default=None, repr=False)
+
+    # how many used tokens the signed_token store remembers, to stop them being
+    # replayed
+    replay_cache_size = attr.ib(type=int, default=DEFAULT_REPLAY_CACHE_SIZE)
+
+    # path to an SQLite database in which the signed_token store remembers used
+    # tokens, so that they cannot be replayed on another worker. None to remember
+    # them in this process.
+    replay_cache_path = attr.ib(type=Optional[str], default=None)
+
+    # how often the journal store writes and fsyncs its journal, in seconds
+    flush_interval = attr.ib(type=float, default=DEFAULT_JOURNAL_FLUSH_INTERVAL)
+
+
+def parse_session_store_config(config: dict) -> SessionStoreConfig:
+    """Parse the `session_store` section of the module config
+
+    Args:
+        config: the `session_store` section of the config
+
+    Returns:
+        the parsed config
+    """
+    store_type = config.get("type", "memory")
+    if store_type not in SESSION_STORE_TYPES:
+        raise Exception(
+            "Unknown session_store type %s: must be one of %s"
+            % (store_type, ", ".join(SESSION_STORE_TYPES))
+        )
+
+    parsed = SessionStoreConfig(
+        type=store_type,
+        path=config.get("path"),
+        url=config.get("url"),
+        key_prefix=config.get("key_prefix", DEFAULT_REDIS_KEY_PREFIX),
+        secret=config.get("secret"),
+        replay_cache_size=config.get("replay_cache_size", DEFAULT_REPLAY_CACHE_SIZE),
+        replay_cache_path=config.get("replay_cache_path"),
+        flush_interval=config.get("flush_interval", DEFAULT_JOURNAL_FLUSH_INTERVAL),
+    )
+
+    if parsed.type in ("sqlite", "journal") and not parsed.path:
+        raise Exception(
+            "session_store.path is required for the %s store" % (parsed.type,)
+        )
+    if parsed.type == "redis":
+        if not parsed.url:
+            raise Exception("session_store.url is required for the redis store")
+        try:
+            import redis  # noqa: F401
+        except ImportError:
+            raise Exception(
+                "The redis session store requires the 'redis' python package: install"
+                " matrix-synapse-saml-mozilla[redis]"
+            )
+    if parsed.type == "signed_token" and not parsed.secret:
+        raise Exception("session_store.secret is required for the signed_token store")
+
+    return parsed
+
+
+def build_session_store(config: SessionStoreConfig) -> SessionStore:
+    """Create a session store from its config"""
+    if config.type == "sqlite":
+        return SqliteSessionStore(config.path)
+
+    if config.type == "redis":
+        import redis
+
+        return RedisSessionStore(redis.Redis.from_url(config.url), config.key_prefix)
+
+    if config.type == "signed_token":
+        return SignedTokenSessionStore(
+            config.secret.encode("utf-8"),
+            config.replay_cache_size,
+            replay_cache_path=config.replay_cache_path,
+        )
+
+    if config.type == "journal":
+        from twisted.internet import reactor
+
+        store = JournalSessionStore(config.path, config.flush_interval)
+        # write out any pending records when Synapse shuts down
+        reactor.addSystemEventTrigger("before", "shutdown", store.close)
+        return store
+
+    return InMemorySessionStore()
+
+
+# the config used to build the current session store, if it has been configured
+_configured_store_config: Optional[SessionStoreConfig] = None
+
+
+def configure_session_store(config: SessionStoreConfig):
+    """Install the session store described by the given config
+
+    Both the mapping provider and the username picker resource call this, so it only
+    builds a new store if the config has changed since the last call.
+    """
+    global _configured_store_config
+    if config == _configured_store_config:
+        return
+
+    logger.info("Using %s session store", config.type)
+    set_session_store(build_session_store(config))
+    _configured_store_config = config
+
+
+def _encode_session(session: UsernameMappingSession) -> str:
+    return json.dumps(attr.asdict(session))
+
+
+def _decode_session(data: Any) -> UsernameMappingSession:
+    return UsernameMappingSession(**json.loads(data))
+
+
+class SqliteSessionStore(SessionStore):
+    """A session store backed by an SQLite database in WAL mode
+
+    Workers on the same host can share a database file. Expired sessions are filtered
+    out of lookups, and deleted in bulk by `expire`. Each thread has its own
+    connection, so that `expire` can be run in a thread.
+    """
+
+    blocking_io = True
+
+    def __init__(self, path: str, gettime: Callable[[], float] = time.time):
+        self._path = path
+        self._gettime = gettime
+        self._local = threading.local()
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS username_mapping_sessions ("
+                " session_id TEXT PRIMARY KEY NOT NULL,"
+                " expiry_time_ms BIGINT NOT NULL,"
+                " session TEXT NOT NULL"
+                ")"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS username_mapping_sessions_expiry"
+                " ON username_mapping_sessions (expiry_time_ms)"
+            )
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """The connection for the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id: str) -> Optional[UsernameMappingSession]:
+        row = self._conn.execute(
+            "SELECT session FROM username_mapping_sessions"
+            " WHERE session_id = ? AND expiry_time_ms > ?",
+            (session_id, self._now_ms()),
+        ).fetchone()
+        if row is None:
+            return None
+        return _decode_session(row[0])
+
+    def add_many(self, sessions: Iterable[Tuple[str, UsernameMappingSession]]):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO username_mapping_sessions"
+                " (session_id, expiry_time_ms, session) VALUES (?, ?, ?)",
+                (
+                    (session_id, session.expiry_time_ms, _encode_session(session))
+                    for session_id, session in sessions
+                ),
+            )
+
+    def add_new(self, session_id: str, session: UsernameMappingSession) -> bool:
+        with self._conn:
+            # an expired session may still be in the table, but its id is free
+            self._conn.execute(
+                "DELETE FROM username_mapping_sessions"
+                " WHERE session_id = ? AND expiry_time_ms <= ?",
+                (session_id, self._now_ms()),
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO username_mapping_sessions"
+                " (session_id, expiry_time_ms, session) VALUES (?, ?, ?)",
+                (session_id, session.expiry_time_ms, _encode_session(session)),
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, session_id: str):
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM username_mapping_sessions WHERE session_id = ?",
+                (session_id,),
+            )
+
+    def take(self, session_id: str) -> Optional[UsernameMappingSession]:
+        with self._conn:
+            # take the write lock before reading, so that no other worker can take
+            # the session between reading and deleting it
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT session FROM username_mapping_sessions"
+                " WHERE session_id = ? AND expiry_time_ms > ?",
+                (session_id, self._now_ms()),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "DELETE FROM username_mapping_sessions WHERE session_id = ?",
+                (session_id,),
+            )
+        return _decode_session(row[0])
+
+    def expire(self, now_ms: Optional[int] = None) -> int:
+        if now_ms is None:
+            now_ms = self._now_ms()
+        with self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM username_mapping_sessions WHERE expiry_time_ms <= ?",
+                (now_ms,),
+            )
+        return cursor.rowcount
+
+    def __len__(self) -> int:
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM username_mapping_sessions WHERE expiry_time_ms > ?",
+            (self._now_ms(),),
+        ).fetchone()
+        return row[0]
+
+    def _now_ms(self) -> int:
+        return int(self._gettime() * 1000)
+
+
+class RedisSessionStore(SessionStore):
+    """A session store backed by a server speaking the Redis protocol
+
+    Each session is stored under its own key with a millisecond TTL, so the server
+    expires sessions by itself. `redis.Redis` clients are thread-safe, so the store
+    can be used from the executor's threads.
+
+    Args:
+        client: a client with the interface of `redis.Redis`
+        key_prefix: prefix for the keys used to store sessions
+    """
+
+    blocking_io = True
+
+    def __init__(
+        self, client, key_prefix: str, gettime: Callable[[], float] = time.time
+    ):
+        self._client = client
+        self._key_prefix = key_prefix
+        self._gettime = gettime
+
+    def get(self, session_id: str) -> Optional[UsernameMappingSession]:
+        data = self._client.get(self._key(session_id))
+        if data is None:
+            return None
+        return _decode_session(data)
+
+    def add_many(self, sessions: Iterable[Tuple[str, UsernameMappingSession]]):
+        now_ms = int(self._gettime() * 1000)
+        pipe = self._client.pipeline(transaction=False)
+        for session_id, session in sessions:
+            ttl_ms = session.expiry_time_ms - now_ms
+            if ttl_ms <= 0:
+                continue
+            pipe.set(self._key(session_id), _encode_session(session), px=ttl_ms)
+        pipe.execute()
+
+    def add_new(self, session_id: str, session: UsernameMappingSession) -> bool:
+        ttl_ms = session.expiry_time_ms - int(self._gettime() * 1000)
+        if ttl_ms <= 0:
+            # there is nothing to store, so the session could never be found
+            raise Exception("Session %s has already expired" % (session_id,))
+        return bool(
+            self._client.set(
+                self._key(session_id), _encode_session(session), px=ttl_ms, nx=True
+            )
+        )
+
+    def delete(self, session_id: str):
+        self._client.delete(self._key(session_id))
+
+    def take(self, session_id: str) -> Optional[UsernameMappingSession]:
+        pipe = self._client.pipeline(transaction=True)
+        pipe.get(self._key(session_id))
+        pipe.delete(self._key(session_id))
+        data, deleted = pipe.execute()
+        # if another worker deleted the session first, it has taken it
+        if data is None or not deleted:
+            return None
+        return _decode_session(data)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._client.scan_iter(match=self._key_prefix + "*"))
+
+    def _key(self, session_id: str) -> str:
+        return self._key_prefix + session_id
+
+
+class _LocalReplayCache:
+    """Remembers used session tokens in this process, until they expire
+
+    The oldest entries are forgotten if the cache fills up.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+
+        # map from signature to the expiry time of the used session, in the order
+        # that the sessions were used
+        self._used: "collections.OrderedDict[bytes, int]" = collections.OrderedDict()
+
+    def __contains__(self, signature: bytes) -> bool:
+        return signature in self._used
+
+    def __len__(self) -> int:
+        return len(self._used)
+
+    def add(self, signature: bytes, expiry_time_ms: int) -> bool:
+        """Record that a token has been used
+
+        Returns:
+            False if it had already been used
+        """
+        if signature in self._used:
+            return False
+        self._used[signature] = expiry_time_ms
+        while len(self._used) > self._max_size:
+            self._used.popitem(last=False)
+        return True
+
+    def discard(self, signature: bytes):
+        self._used.pop(signature, None)
+
+    def expire(self, now_ms: int) -> int:
+        # every session has the same validity period, so sessions are used in
+        # roughly the order that they expire.
+        expired = 0
+        while self._used:
+            signature, expiry_time_ms = next(iter(self._used.items()))
+            if expiry_time_ms > now_ms:
+                break
+            del self._used[signature]
+            expired += 1
+        return expired
+
+
+class _SqliteReplayCache:
+    """Remembers used session tokens in an SQLite database, until they expire
+
+    Workers on the same host can share a database file, so that a token used on one
+    worker cannot be used again on another. As for SqliteSessionStore, each thread
+    has its own connection.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS used_session_tokens ("
+                " signature BLOB PRIMARY KEY NOT NULL,"
+                " expiry_time_ms BIGINT NOT NULL"
+                ")"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS used_session_tokens_expiry"
+                " ON used_session_tokens (expiry_time_ms)"
+            )
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """The connection for the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def __contains__(self, signature: bytes) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM used_session_tokens WHERE signature = ?", (signature,)
+        ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM used_session_tokens"
+        ).fetchone()[0]
+
+    def add(self, signature: bytes, expiry_time_ms: int) -> bool:
+        """Record that a token has been used
+
+        Returns:
+            False if it had already been used, on any worker
+        """
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO used_session_tokens"
+                " (signature, expiry_time_ms) VALUES (?, ?)",
+                (signature, expiry_time_ms),
+            )
+        return cursor.rowcount == 1
+
+    def discard(self, signature: bytes):
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM used_session_tokens WHERE signature = ?", (signature,)
+            )
+
+    def expire(self, now_ms: int) -> int:
+        with self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM used_session_tokens WHERE expiry_time_ms <= ?", (now_ms,)
+            )
+        return cursor.rowcount
+
+
+class SignedTokenSessionStore(SessionStore):
+    """A session store which keeps no per-session state on the server
+
+    Instead, the session itself is encoded into the session id, along with an HMAC
+    which stops clients tampering with it. Any worker which knows the secret can
+    verify a session id without any shared storage.
+
+    Used session ids are remembered in a replay cache until they expire, so that a
+    session cannot be used to register a second account. By default the cache is
+    local to this process, so a session is only single-use within one worker: a
+    session taken on one worker can still be taken on another. The oldest entries
+    are forgotten if it fills up. If `replay_cache_path` is given, the cache is kept
+    in an SQLite database there instead, which workers can share, and is unbounded.
+
+    Args:
+        secret: the HMAC key
+        replay_cache_size: the maximum number of used session ids to remember in this
+            process
+        replay_cache_path: an SQLite database to remember used session ids in, or
+            None to remember them in this process
+    """
+
+    def __init__(
+        self,
+        secret: bytes,
+        replay_cache_size: int = DEFAULT_REPLAY_CACHE_SIZE,
+        gettime: Callable[[], float] = time.time,
+        replay_cache_path: Optional[str] = None,
+    ):
+        self._secret = secret
+        self._gettime = gettime
+
+        self._replay_cache: Union[_LocalReplayCache, _SqliteReplayCache]
+        if replay_cache_path is not None:
+            self._replay_cache = _SqliteReplayCache(replay_cache_path)
+            self.blocking_io = True
+        else:
+            self._replay_cache = _LocalReplayCache(replay_cache_size)
+
+    @property
+    def blocking_create(self) -> bool:
+        # the session is encoded into its id, so creating one does no IO, even with a
+        # shared replay cache
+        return False
+
+    def create(self, session: UsernameMappingSession) -> str:
+        payload = json.dumps(
+            [
+                session.remote_user_id,
+                session.displayname,
+                session.client_redirect_url,
+                session.expiry_time_ms,
+            ],
+            separators=(",", ":"),
+        ).encode("utf-8")
+        return "%s.%s" % (_b64encode(payload), _b64encode(self._sign(payload)))
+
+    def get(self, session_id: str) -> Optional[UsernameMappingSession]:
+        parsed = self._verify(session_id)
+        if parsed is None:
+            return None
+
+        session, signature = parsed
+        if session.expiry_time_ms <= self._now_ms():
+            return None
+        if signature in self._replay_cache:
+            return None
+        return session
+
+    def add_many(self, sessions: Iterable[Tuple[str, UsernameMappingSession]]):
+        raise NotImplementedError(
+            "Signed token sessions cannot be stored under a given session id"
+        )
+
+    def delete(self, session_id: str):
+        parsed = self._verify(session_id)
+        if parsed is None:
+            return
+
+        session, signature = parsed
+        self._replay_cache.add(signature, session.expiry_time_ms)
+
+    def take(self, session_id: str) -> Optional[UsernameMappingSession]:
+        parsed = self._verify(session_id)
+        if parsed is None:
+            return None
+
+        # marking the token as used is atomic, so only one caller can take it
+        session, signature = parsed
+        if session.expiry_time_ms <= self._now_ms():
+            return None
+        if not self._replay_cache.add(signature, session.expiry_time_ms):
+            return None
+        return session
+
+    def restore(self, session_id: str, session: UsernameMappingSession):
+        parsed = self._verify(session_id)
+        if parsed is not None:
+            self._replay_cache.discard(parsed[1])
+
+    def expire(self, now_ms: Optional[int] = None) -> int:
+        """Forget any used session ids which have expired anyway"""
+        if now_ms is None:
+            now_ms = self._now_ms()
+        return self._replay_cache.expire(now_ms)
+
+    def __len__(self) -> int:
+        """Always 0: live sessions are held by the clients, not the store"""
+        return 0
+
+    def _sign(self, payload: bytes) -> bytes:
+        # truncate the HMAC to 128 bits to keep the cookie compact
+        return hmac.new(self._secret, payload, hashlib.sha256).digest()[:16]
+
+    def _verify(
+        self, session_id: str
+    ) -> Optional[Tuple[UsernameMappingSession, bytes]]:
+        """Check the signature on a session id and decode the session
+
+        Returns:
+            the session and its signature, or None if the session id is invalid
+        """
+        try:
+            encoded_payload, encoded_signature = session_id.split(".")
+            payload = _b64decode(encoded_payload)
+            signature = _b64decode(encoded_signature)
+        except (ValueError, binascii.Error):
+            logger.debug("Malformed session id")
+            return None
+
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            # the session id comes from the client, so is not worth more than a
+            # debug log, and is not logged itself
+            logger.debug("Invalid signature on session id")
+            return None
+
+        remote_user_id, displayname, client_redirect_url, expiry_time_ms = json.loads(
+            payload
+        )
+        session = UsernameMappingSession(
+            remote_user_id=remote_user_id,
+            displayname=displayname,
+            client_redirect_url=client_redirect_url,
+            expiry_time_ms=expiry_time_ms,
+        )
+        return session, signature
+
+    def _now_ms(self) -> int:
+        return int(self._gettime() * 1000)
+
+
+class JournalSessionStore(SessionStore):
+    """An in-memory session store, which journals changes to a file
+
+    Each session which is created or deleted appends a line to the journal. Lines are
+    buffered and written, then fsynced, in a batch every `flush_interval` seconds, in
+    the executor's thread pool, so neither the login path nor the reactor waits for
+    the disk. Sessions created since the last flush
+    are lost if the process crashes, but not if it shuts down cleanly.
+
+    At startup, the journal is replayed, skipping expired sessions, and then
+    compacted. It is compacted again whenever it grows to more than twice as many
+    records as there are live sessions, by rewriting the live sessions to a new file
+    which replaces the journal.
+
+    The journal belongs to one process: workers must not share a journal file.
+
+    Args:
+        path: the journal file, which is created if it does not exist
+        flush_interval: how often to write the journal, in seconds
+        clock: the reactor to schedule flushes on. Defaults to the global reactor.
+        executor: runs the flushes. Defaults to the executor for blocking steps.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = DEFAULT_JOURNAL_FLUSH_INTERVAL,
+        gettime: Callable[[], float] = time.time,
+        clock: Optional[IReactorTime] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self._path = path
+        self._gettime = gettime
+        self._executor = executor
+        self._sessions = InMemorySessionStore(gettime)
+
+        # journal records which have not yet been written
+        self._pending: List[str] = []
+
+        # the number of records in the journal file, including those being written
+        self._records = 0
+
+        # the flush which is running in the thread pool, if any
+        self._flushing: Optional[defer.Deferred] = None
+
+        self._replay()
+        self._file = None
+        live = self._live_sessions()
+        self._compact(live)
+        self._records = len(live)
+
+        self._flusher = LoopingCall(self._flush_in_background)
+        if clock is not None:
+            self._flusher.clock = clock
+        self._flusher.start(flush_interval, now=False)
+
+    def get(self, session_id: str) -> Optional[UsernameMappingSession]:
+        return self._sessions.get(session_id)
+
+    def add_many(self, sessions: Iterable[Tuple[str, UsernameMappingSession]]):
+        sessions = list(sessions)
+        self._sessions.add_many(sessions)
+        self._pending.extend(
+            _journal_record("c", session_id, attr.asdict(session))
+            for session_id, session in sessions
+        )
+
+    def delete(self, session_id: str):
+        if self._sessions.get(session_id) is None:
+            return
+        self._sessions.delete(session_id)
+        self._pending.append(_journal_record("d", session_id))
+
+    def expire(self, now_ms: Optional[int] = None) -> int:
+        # expired sessions are skipped when the journal is replayed, so there is no
+        # need to record their expiry
+        return self._sessions.expire(now_ms)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def memory_usage(self) -> int:
+        return self._sessions.memory_usage() + deep_sizeof(self._pending)
+
+    def estimate_memory_usage(self) -> int:
+        # the pending records are written out every flush_interval, so there are
+        # not many of them
+        return self._sessions.estimate_memory_usage() + deep_sizeof(self._pending)
+
+    def flush(self):
+        """Write and fsync any pending records, and compact the journal if need be
+
+        This blocks until the records are on disk.
+        """
+        self._write(*self._take_pending())
+
+    def close(self) -> defer.Deferred:
+        """Stop flushing in the background, and write any pending records
+
+        Returns:
+            a Deferred which resolves once the journal is closed
+        """
+        if self._flusher.running:
+            self._flusher.stop()
+
+        def finish(_):
+            self.flush()
+            self._file.close()
+
+        if self._flushing is None:
+            return defer.maybeDeferred(finish, None)
+
+        # wait for the background flush, so that the writes do not interleave
+        d: defer.Deferred = defer.Deferred()
+        self._flushing.addBoth(lambda _: d.callback(None))
+        return d.addCallback(finish)
+
+    def _flush_in_background(self) -> defer.Deferred:
+        """Write the pending records in the executor's thread pool"""
+        records, live = self._take_pending()
+        executor = self._executor or get_executor()
+        self._flushing = executor.run(
+            "flush_session_journal", self._write, records, live
+        )
+
+        def flushed(result):
+            self._flushing = None
+            return result
+
+        return self._flushing.addBoth(flushed)
+
+    def _take_pending(
+        self,
+    ) -> Tuple[List[str], Optional[List[Tuple[str, UsernameMappingSession]]]]:
+        """Take the records which need writing
+
+        Returns:
+            the pending records, and the live sessions if the journal needs compacting
+        """
+        records, self._pending = self._pending, []
+        self._records += len(records)
+
+        live = None
+        if self._records > JOURNAL_COMPACTION_MIN_RECORDS and self._records > 2 * len(
+            self._sessions
+        ):
+            live = self._live_sessions()
+            self._records = len(live)
+        return records, live
+
+    def _write(
+        self,
+        records: List[str],
+        live: Optional[List[Tuple[str, UsernameMappingSession]]],
+    ):
+        """Write and fsync the records, then compact the journal to the live sessions
+        if they are given
+
+        This only touches the file, so that it can be run in a thread.
+        """
+        if records:
+            self._file.write("".join(records))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        if live is not None:
+            self._compact(live)
+
+    def _replay(self):
+        """Load the live sessions from the journal"""
+        try:
+            fh = open(self._path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+
+        sessions = {}
+        with fh:
+            for line_number, line in enumerate(fh, 1):
+                try:
+                    record = json.loads(line)
+                    if record[0] == "c":
+                        sessions[record[1]] = UsernameMappingSession(**record[2])
+                    elif record[0] == "d":
+                        sessions.pop(record[1], None)
+                except (ValueError, TypeError, IndexError):
+                    # most likely a partly-written line from a crash
+                    logger.warning(
+                        "Ignoring invalid record at %s:%i", self._path, line_number
+                    )
+
+        now_ms = int(self._gettime() * 1000)
+        self._sessions.add_many(
+            (session_id, session)
+            for session_id, session in sessions.items()
+            if session.expiry_time_ms > now_ms
+        )
+        logger.info("Loaded %i sessions from %s", len(self._sessions), self._path)
+
+    def _live_sessions(self) -> List[Tuple[str, UsernameMappingSession]]:
+        now_ms = int(self._gettime() * 1000)
+        return [
+            (session_id, session)
+            for session_id, session in self._sessions.items()
+            if session.expiry_time_ms > now_ms
+        ]
+
+    def _compact(self, live: List[Tuple[str, UsernameMappingSession]]):
+        """Replace the journal with one which only records the given live sessions"""
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            fh.writelines(
+                _journal_record("c", session_id, attr.asdict(session))
+                for session_id, session in live
+            )
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_path, self._path)
+        self._file = open(self._path, "a", encoding="utf-8")
+
+
+def _journal_record(*fields: Any) -> str:
+    """Encode a line of a session journal"""
+    return json.dumps(fields, separators=(",", ":")) + "\n"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
@@ -12,53 +12,490 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import abc
+import heapq
+import itertools
 import logging
+import secrets
+import sys
 import time
-from typing import Optional
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
 
 import attr
+from twisted.internet import defer
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet.task import LoopingCall
+
+from synapse.module_api import make_deferred_yieldable
+
+from matrix_synapse_saml_mozilla._audit import SessionsExpired, record_audit_event
+from matrix_synapse_saml_mozilla._executor import get_executor
+from matrix_synapse_saml_mozilla._memory import InternTable, deep_sizeof
+from matrix_synapse_saml_mozilla._metrics import (
+    expired_sessions,
+    live_sessions,
+    session_store_memory,
+)
 
 SESSION_COOKIE_NAME = b"username_mapping_session"
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# the number of random bytes in a session id: 128 bits, which is 22 characters once
+# base64url-encoded
+SESSION_ID_BYTES = 16
+
+# the number of times to try generating a session id which is not already in use
+SESSION_ID_ATTEMPTS = 3
+
+
+def generate_session_id() -> str:
+    """Make up a cryptorandom, URL- and cookie-safe session id"""
+    return secrets.token_urlsafe(SESSION_ID_BYTES)
+
 
-@attr.s
+# the maximum number of distinct redirect URLs and display names to share between
+# sessions. Nearly every session has one of a handful of client redirect URLs;
+# display names are only shared by sessions for the same user.
+REDIRECT_URL_INTERN_TABLE_SIZE = 1000
+DISPLAYNAME_INTERN_TABLE_SIZE = 10000
+
+_redirect_urls = InternTable(REDIRECT_URL_INTERN_TABLE_SIZE)
+_displaynames = InternTable(DISPLAYNAME_INTERN_TABLE_SIZE)
+
+# the number of sessions to measure when estimating the memory used by a store
+MEMORY_ESTIMATE_SAMPLE_SIZE = 100
+
+
+@attr.s(slots=True)
 class UsernameMappingSession:
-    """Data we track about SAML2 sessions"""
+    """Data we track about SAML2 sessions
+
+    Sessions have no __dict__, and share their redirect URL and display name with
+    other sessions which have the same one, as a store may hold a great many.
+    """
 
     # user ID on the SAML server
     remote_user_id = attr.ib(type=str)
 
     # displayname, per the SAML attributes
-    displayname = attr.ib(type=Optional[str])
+    displayname = attr.ib(type=Optional[str], converter=_displaynames.intern)
 
     # where to redirect the client back to
-    client_redirect_url = attr.ib(type=str)
+    client_redirect_url = attr.ib(type=str, converter=_redirect_urls.intern)
 
     # expiry time for the session, in milliseconds
     expiry_time_ms = attr.ib(type=int)
 
 
-# a map from session id to session data
-username_mapping_sessions = {}  # type: dict[str, UsernameMappingSession]
+class SessionStore(abc.ABC):
+    """A map from session id to session data
+
+    Implementations are responsible for expiring sessions once they pass their
+    `expiry_time_ms`: `get` must never return an expired session.
+    """
+
+    # whether the store does blocking IO, so that the username picker's lookups and
+    # the reaper should run in a thread. Stores which set this must be thread-safe.
+    blocking_io = False
+
+    @property
+    def blocking_create(self) -> bool:
+        """Whether `create` does blocking IO, so that new sessions should be stored in
+        a thread. By default, the same as `blocking_io`.
+        """
+        return self.blocking_io
+
+    @abc.abstractmethod
+    def get(self, session_id: str) -> Optional[UsernameMappingSession]:
+        """Look up the given session id, ignoring it if it has expired"""
+
+    def create(self, session: UsernameMappingSession) -> str:
+        """Store a new session
+
+        Returns:
+            the id of the new session
+        """
+        for _ in range(SESSION_ID_ATTEMPTS):
+            session_id = generate_session_id()
+            if self.add_new(session_id, session):
+                return session_id
+            logger.warning("Generated session id which was already in use")
+        raise Exception("Unable to generate an unused session id")
+
+    def add(self, session_id: str, session: UsernameMappingSession):
+        """Store a session under the given session id"""
+        self.add_many([(session_id, session)])
+
+    def add_new(self, session_id: str, session: UsernameMappingSession) -> bool:
+        """Store a session under the given session id, unless the id is in use
+
+        Backends which can check and store a session atomically should override this.
+
+        Returns:
+            whether the session was stored
+        """
+        if session_id in self:
+            return False
+        self.add(session_id, session)
+        return True
+
+    @abc.abstractmethod
+    def add_many(self, sessions: Iterable[Tuple[str, UsernameMappingSession]]):
+        """Store a batch of sessions, keyed by session id"""
+
+    @abc.abstractmethod
+    def delete(self, session_id: str):
+        """Remove the given session, if it exists
+
+        Once deleted, a session id must not be usable again.
+        """
+
+    def expire(self, now_ms: Optional[int] = None) -> int:
+        """Delete any sessions which have passed their expiry time
+
+        Backends which expire sessions by themselves need not override this.
+
+        Args:
+            now_ms: the current time, in milliseconds. Defaults to the time given by
+                the store's clock.
+
+        Returns:
+            the number of sessions which were expired
+        """
+        return 0
+
+    def take(self, session_id: str) -> Optional[UsernameMappingSession]:
+        """Look up and delete the given session, so that nobody else can use it
+
+        Backends which are shared between processes should override this to do so
+        atomically.
+
+        Returns:
+            the session, or None if it was not found, has expired, or has already
+            been taken
+        """
+        session = self.get(session_id)
+        if session is not None:
+            self.delete(session_id)
+        return session
+
+    def restore(self, session_id: str, session: UsernameMappingSession):
+        """Put back a session which was taken, so that it can be used again"""
+        self.add(session_id, session)
+
+    def memory_usage(self) -> Optional[int]:
+        """Returns the number of bytes used by the sessions held in this process
+
+        This measures every session, so is slow for large stores.
+
+        Returns:
+            the number of bytes, or None if the store does not hold its sessions in
+            this process
+        """
+        return None
+
+    def estimate_memory_usage(self) -> Optional[int]:
+        """Estimate the number of bytes used by the sessions held in this process
+
+        Unlike `memory_usage`, this only measures a sample of the sessions, so it
+        is cheap enough to call whenever metrics are collected.
+
+        Returns:
+            the number of bytes, or None if the store does not hold its sessions in
+            this process
+        """
+        return None
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        """Returns the number of live sessions"""
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def __getitem__(self, session_id: str) -> UsernameMappingSession:
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __setitem__(self, session_id: str, session: UsernameMappingSession):
+        self.add(session_id, session)
+
+    def __delitem__(self, session_id: str):
+        self.delete(session_id)
+
+
+class InMemorySessionStore(SessionStore):
+    """A session store which keeps sessions in this process, indexed by expiry time
+
+    Sessions are kept in a dict for lookups, alongside a heap of
+    `(expiry_time_ms, session_id)` pairs, so that expiring old sessions only has to
+    look at the sessions which have actually expired, rather than every live session.
+
+    Entries in the heap are not removed when a session is deleted or replaced; they
+    are discarded when they reach the top of the heap instead.
+    """
+
+    def __init__(self, gettime: Callable[[], float] = time.time):
+        self._gettime = gettime
+        self._sessions: Dict[str, UsernameMappingSession] = {}
+        self._expiry_heap: List[Tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[UsernameMappingSession]:
+        session = self._sessions.get(session_id)
+        if session is not None and session.expiry_time_ms <= self._now_ms():
+            del self._sessions[session_id]
+            expired_sessions.inc()
+            if not record_audit_event(SessionsExpired(1)):
+                logger.info("Expiring mapping session %s", session_id)
+            return None
+        return session
+
+    def add(self, session_id: str, session: UsernameMappingSession):
+        self._sessions[session_id] = session
+        heapq.heappush(self._expiry_heap, (session.expiry_time_ms, session_id))
+
+    def add_many(self, sessions: Iterable[Tuple[str, UsernameMappingSession]]):
+        for session_id, session in sessions:
+            self.add(session_id, session)
+
+    def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def items(self) -> List[Tuple[str, UsernameMappingSession]]:
+        """Returns the stored sessions, which may include some which have expired"""
+        return list(self._sessions.items())
+
+    def expire(self, now_ms: Optional[int] = None) -> int:
+        if now_ms is None:
+            now_ms = self._now_ms()
+
+        expired = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now_ms:
+            expiry_time_ms, session_id = heapq.heappop(heap)
+            session = self._sessions.get(session_id)
+            # skip heap entries for sessions which have since been deleted or
+            # replaced by a session with a later expiry time
+            if session is None or session.expiry_time_ms > now_ms:
+                continue
+            del self._sessions[session_id]
+            expired += 1
+
+        return expired
+
+    def memory_usage(self) -> int:
+        seen: Set[int] = set()
+        return deep_sizeof(self._sessions, seen) + deep_sizeof(self._expiry_heap, seen)
+
+    def estimate_memory_usage(self) -> int:
+        size = sys.getsizeof(self._sessions) + sys.getsizeof(self._expiry_heap)
+
+        # measure a sample of the sessions and heap entries together, so that
+        # strings which they share are counted once, as they are in the whole store
+        seen: Set[int] = set()
+        sample = list(
+            itertools.islice(self._sessions.items(), MEMORY_ESTIMATE_SAMPLE_SIZE)
+        )
+        if sample:
+            sample_size = sum(
+                deep_sizeof(session_id, seen) + deep_sizeof(session, seen)
+                for session_id, session in sample
+            )
+            size += sample_size * len(self._sessions) // len(sample)
+
+        heap_sample = self._expiry_heap[:MEMORY_ESTIMATE_SAMPLE_SIZE]
+        if heap_sample:
+            # the session ids in the heap are mostly the keys of the dict, which
+            # have already been counted
+            sample_size = sum(
+                sys.getsizeof(entry) + deep_sizeof(entry[0], seen)
+                for entry in heap_sample
+            )
+            size += sample_size * len(self._expiry_heap) // len(heap_sample)
+        return size
+
+    def _now_ms(self) -> int:
+        return int(self._gettime() * 1000)
+
+
+# the store which holds the live sessions. Replaced by `set_session_store` if the
+# module is configured to use a shared backend.
+_session_store: SessionStore = InMemorySessionStore()
+
+
+def get_session_store() -> SessionStore:
+    """Returns the store which holds the live mapping sessions"""
+    return _session_store
+
+
+def set_session_store(store: SessionStore):
+    """Replace the store which holds the live mapping sessions"""
+    global _session_store
+    _session_store = store
+
+
+session_store_memory.set_function(lambda: _session_store.estimate_memory_usage() or 0)
+
+
+# how often the background reaper expires old sessions
+SESSION_REAPER_INTERVAL_SECONDS = 60
+
+_reaper: Optional[LoopingCall] = None
+
+# map from the id of each session which is being stored in the executor's thread pool
+# to the deferreds of the callers waiting for it to be stored
+_pending_creates: Dict[str, List[defer.Deferred]] = {}
+
+
+def _run_store_step(step: str, f: Callable[..., T], *args) -> "defer.Deferred[T]":
+    """Run a step which uses the session store, in the executor's thread pool if the
+    store does blocking IO
+
+    Args:
+        step: the name of the step, for metrics
+        f: the function to run
+        *args: the arguments to pass to `f`
+    """
+    if _session_store.blocking_io:
+        return get_executor().run(step, f, *args)
+    return defer.succeed(f(*args))
+
+
+def _expire_and_count(store: SessionStore, now_ms: int) -> Tuple[int, int]:
+    """Expire old sessions, and then count the live ones
+
+    Returns:
+        the number of sessions which expired, and the number which are left
+    """
+    return store.expire(now_ms), len(store)
+
+
+def expire_old_sessions(gettime=time.time) -> defer.Deferred:
+    """Delete any sessions which have passed their expiry_time, and update the
+    number of live sessions
+
+    Counting the sessions in a shared store means a query, or a scan of the whole
+    keyspace, so they are only counted here, rather than on each metrics scrape.
+    Stores which do blocking IO are expired and counted in the executor's thread
+    pool.
+    """
+    now_ms = int(gettime() * 1000)
+    d = _run_store_step("expire_sessions", _expire_and_count, _session_store, now_ms)
+
+    def expired(counts: Tuple[int, int]):
+        count, live = counts
+        expired_sessions.inc(count)
+        live_sessions.set(live)
+        if count and not record_audit_event(SessionsExpired(count)):
+            logger.info("Expired %i mapping sessions", count)
+
+    d.addCallback(expired)
+    return d
+
+
+async def _reap_sessions():
+    """Expire old sessions, logging any error so that the reaper keeps running"""
+    try:
+        await expire_old_sessions()
+    except Exception:
+        logger.exception("Error expiring mapping sessions")
+
+
+def start_session_reaper(clock: Optional[IReactorTime] = None):
+    """Start expiring old sessions periodically, off the request path
+
+    It is safe to call this more than once: the reaper is only started the first time.
+
+    Args:
+        clock: the reactor to schedule the reaper on. Defaults to the global reactor.
+    """
+    global _reaper
+    if _reaper is not None:
+        return
+
+    _reaper = LoopingCall(lambda: defer.ensureDeferred(_reap_sessions()))
+    if clock is not None:
+        _reaper.clock = clock
+    _reaper.start(SESSION_REAPER_INTERVAL_SECONDS, now=False)
+
+
+def create_mapping_session(session: UsernameMappingSession) -> str:
+    """Store a new session, without blocking the reactor
+
+    The mapping provider is called synchronously, so it cannot wait for a store which
+    does blocking IO. For such stores, the session id is generated here and returned
+    straight away, while the session is stored in the executor's thread pool.
+    `get_mapping_session` and `take_mapping_session` wait for the write if it is
+    still in progress in this process.
+
+    Returns:
+        the id of the new session
+    """
+    store = _session_store
+    if not store.blocking_create:
+        return store.create(session)
+
+    session_id = generate_session_id()
+    _pending_creates[session_id] = []
+
+    def stored(added: bool):
+        if not added:
+            # another session has this id, so this one cannot be stored under it
+            logger.error("Generated session id which was already in use")
+        for d in _pending_creates.pop(session_id):
+            d.callback(added)
+
+    def failed(failure):
+        logger.error(
+            "Error storing mapping session",
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+        )
+        stored(False)
+
+    d = get_executor().run("create_session", store.add_new, session_id, session)
+    d.addCallbacks(stored, failed)
+    return session_id
+
+
+async def _wait_for_create(session_id: str) -> bool:
+    """Wait for the given session to be stored, if `create_mapping_session` is
+    storing it in the background
+
+    Returns:
+        False if the session could not be stored, otherwise True
+    """
+    waiters = _pending_creates.get(session_id)
+    if waiters is None:
+        return True
+    d: defer.Deferred = defer.Deferred()
+    waiters.append(d)
+    return await make_deferred_yieldable(d)
 
 
-def expire_old_sessions(gettime=time.time):
-    """Delete any sessions which have passed their expiry_time"""
-    to_expire = []
-    now = int(gettime() * 1000)
+async def get_mapping_session(session_id: str) -> Optional[UsernameMappingSession]:
+    """Look up the given session id, ignoring it if it has expired"""
+    if not await _wait_for_create(session_id):
+        return None
+    return await _run_store_step("get_session", _session_store.get, session_id)
 
-    for session_id, session in username_mapping_sessions.items():
-        if session.expiry_time_ms <= now:
-            to_expire.append(session_id)
 
-    for session_id in to_expire:
-        logger.info("Expiring mapping session %s", session_id)
-        del username_mapping_sessions[session_id]
+async def take_mapping_session(session_id: str) -> Optional[UsernameMappingSession]:
+    """Look up and delete the given session id. See `SessionStore.take`."""
+    if not await _wait_for_create(session_id):
+        return None
+    return await _run_store_step("take_session", _session_store.take, session_id)
 
 
-def get_mapping_session(session_id: str) -> Optional[UsernameMappingSession]:
-    """Look up the given session id, first expiring any old sessions"""
-    expire_old_sessions()
-    return username_mapping_sessions.get(session_id, None)
+async def restore_mapping_session(session_id: str, session: UsernameMappingSession):
+    """Put back a session which was taken, so that it can be used again"""
+    await _run_store_step(
+        "restore_session", _session_store.restore, session_id, session
+    )
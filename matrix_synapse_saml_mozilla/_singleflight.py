@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, TypeVar
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from synapse.module_api import make_deferred_yieldable
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+
+class SingleFlight(Generic[KT, VT]):
+    """Runs at most one instance of an async operation for each key at a time
+
+    Callers which arrive while the operation for their key is in flight wait for it,
+    and receive its result (or exception), rather than starting another. Each key is
+    independent, so operations for different keys never wait for each other.
+    """
+
+    def __init__(self):
+        # map from the key of each operation in flight to the deferreds of the
+        # callers waiting for it
+        self._waiters: Dict[KT, List[defer.Deferred]] = {}
+
+    async def run(self, key: KT, operation: Callable[[], Awaitable[VT]]) -> VT:
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            d: defer.Deferred = defer.Deferred()
+            waiters.append(d)
+            return await make_deferred_yieldable(d)
+
+        self._waiters[key] = []
+        try:
+            result = await operation()
+        except Exception:
+            failure = Failure()
+            for d in self._waiters.pop(key):
+                d.errback(failure)
+            raise
+
+        for d in self._waiters.pop(key):
+            d.callback(result)
+        return result
+
+    def __contains__(self, key: KT) -> bool:
+        """Check if the operation for the given key is in flight"""
+        return key in self._waiters
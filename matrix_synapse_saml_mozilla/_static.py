@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Serves the files which the username picker generates at startup from memory.
+
+Each file is built once, along with gzip (and, if the `brotli` package is installed,
+brotli) compressed copies. Each copy has an ETag derived from a hash of the file's
+contents, so that clients can revalidate their cached copies cheaply.
+
+The picker page itself is rendered by _picker_page.py, which inlines the stylesheet
+and script, so they are not served separately.
+"""
+
+import gzip
+import hashlib
+import io
+import mimetypes
+from typing import List, Optional
+
+import attr
+from twisted.web.resource import Resource
+from twisted.web.server import Request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# files must be revalidated (with the ETag) on each use
+REVALIDATE_CACHE_CONTROL = b"no-cache"
+
+
+@attr.s(frozen=True, slots=True)
+class _Representation:
+    body = attr.ib(type=bytes)
+    etag = attr.ib(type=bytes)
+
+    # the Content-Encoding of the body, or None for the uncompressed file
+    encoding = attr.ib(type=Optional[bytes])
+
+
+@attr.s(frozen=True, slots=True)
+class StaticAsset:
+    content_type = attr.ib(type=bytes)
+
+    # the uncompressed file, followed by any compressed copies in order of
+    # preference. Compressed copies are only kept if they are smaller.
+    representations = attr.ib(type=List[_Representation])
+
+
+def _gzip(body: bytes) -> bytes:
+    # gzip.compress only takes an mtime from Python 3.8. Without a fixed mtime the
+    # compressed copy would differ on each restart, under the same ETag.
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0) as fh:
+        fh.write(body)
+    return buf.getvalue()
+
+
+def _make_asset(name: str, body: bytes) -> StaticAsset:
+    content_type, _ = mimetypes.guess_type(name)
+    if content_type is None:
+        content_type = "application/octet-stream"
+    if content_type.startswith("text/") or content_type.endswith("javascript"):
+        content_type += "; charset=utf-8"
+
+    content_hash = hashlib.sha256(body).hexdigest()[:16]
+
+    representations = [_Representation(body, b'"%s"' % (content_hash.encode(),), None)]
+    compressed = {b"gzip": _gzip(body)}
+    if brotli is not None:
+        compressed[b"br"] = brotli.compress(body)
+    for encoding in (b"br", b"gzip"):
+        if encoding in compressed and len(compressed[encoding]) < len(body):
+            etag = b'"%s-%s"' % (content_hash.encode(), encoding)
+            representations.append(
+                _Representation(compressed[encoding], etag, encoding)
+            )
+
+    return StaticAsset(
+        content_type=content_type.encode("ascii"), representations=representations,
+    )
+
+
+def accepted_encodings(request: Request) -> List[bytes]:
+    """Returns the content-codings which the client accepts"""
+    header = request.getHeader(b"Accept-Encoding")
+    if not header:
+        return []
+
+    accepted = []
+    for part in header.split(b","):
+        params = part.strip().split(b";")
+        coding = params[0].strip().lower()
+        q_values = [p.strip() for p in params[1:] if p.strip().startswith(b"q=")]
+        if q_values:
+            try:
+                if float(q_values[0][2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.append(coding)
+    return accepted
+
+
+class _AssetResource(Resource):
+    isLeaf = True
+
+    def __init__(self, asset: StaticAsset):
+        super().__init__()
+        self._asset = asset
+
+    def render_GET(self, request: Request) -> bytes:
+        accepted = accepted_encodings(request)
+        representation = self._asset.representations[0]
+        for candidate in self._asset.representations[1:]:
+            if candidate.encoding in accepted:
+                representation = candidate
+                break
+
+        request.setHeader(b"Content-Type", self._asset.content_type)
+        request.setHeader(b"Cache-Control", REVALIDATE_CACHE_CONTROL)
+        request.setHeader(b"Vary", b"Accept-Encoding")
+        request.setHeader(b"ETag", representation.etag)
+
+        if_none_match = request.getHeader(b"If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(b",")]
+            if b"*" in tags or representation.etag in tags:
+                request.setResponseCode(304)
+                return b""
+
+        if representation.encoding is not None:
+            request.setHeader(b"Content-Encoding", representation.encoding)
+        request.setHeader(b"Content-Length", b"%i" % (len(representation.body),))
+        return representation.body
+
+
+def generated_asset_resource(name: str, body: bytes) -> Resource:
+    """Serve a file which is generated at startup, rather than read from disk
+
+    The content type is guessed from `name`.
+    """
+    return _AssetResource(_make_asset(name, body))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+import unicodedata
+from typing import List, Optional
+
+from matrix_synapse_saml_mozilla._localpart_rules import ALLOWED_LOCALPART_CHARACTERS
+
+# runs of characters which are not allowed in localparts
+_DISALLOWED_CHARACTERS = re.compile("[^%s]+" % (ALLOWED_LOCALPART_CHARACTERS,))
+
+# separators between the words of a name
+_WORD_SEPARATORS = re.compile(r"[\s._=/-]+")
+
+
+def _words(name: str) -> List[str]:
+    """Split a name into lowercase ASCII words, with any other characters removed"""
+    # decompose accented characters, so that "é" becomes "e" plus a combining accent,
+    # which is then removed with everything else which is not ASCII.
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    words = _WORD_SEPARATORS.split(name.lower())
+    words = (_DISALLOWED_CHARACTERS.sub("", word) for word in words)
+    return [word for word in words if word]
+
+
+def suggest_localparts(
+    displayname: Optional[str], remote_user_id: Optional[str] = None, count: int = 10
+) -> List[str]:
+    """Suggest candidate localparts for a user, in order of preference
+
+    The candidates are derived from the displayname (for "Jane Doe": `jane.doe`,
+    `janedoe`, `jane_doe`, `jdoe`, `jane`), falling back to the part of the remote
+    user ID before any "@". These are followed by numbered variants (`jane.doe2`,
+    `jane.doe3`, ...) until there are `count` candidates.
+
+    Returns:
+        up to `count` distinct candidates. May be empty if there is nothing to
+        derive them from.
+    """
+    words = []
+    if displayname:
+        words = _words(displayname)
+    if not words and remote_user_id:
+        words = _words(str(remote_user_id).split("@", 1)[0])
+    if not words:
+        return []
+
+    bases = [".".join(words), "".join(words), "_".join(words)]
+    if len(words) > 1:
+        bases.append(words[0][0] + words[-1])
+        bases.append(words[0])
+
+    candidates: List[str] = []
+    for base in bases:
+        if base not in candidates:
+            candidates.append(base)
+
+    suffix = 2
+    while len(candidates) < count:
+        candidates.append("%s%i" % (bases[0], suffix))
+        suffix += 1
+
+    return candidates[:count]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compiles a text domain block list into the binary format which can be memory-mapped
+by the mapping provider. The compiled file can be used as the `bad_domain_file`.
+
+Usage: python -m matrix_synapse_saml_mozilla.compile_block_list INPUT OUTPUT
+"""
+
+import argparse
+import sys
+import time
+from typing import List, Optional
+
+from matrix_synapse_saml_mozilla._domains import DomainBlockList
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Compile a text domain block list, with one domain per line, "
+        "into a sorted, deduplicated binary file which can be memory-mapped."
+    )
+    parser.add_argument("input", help="the text block list")
+    parser.add_argument("output", help="where to write the compiled block list")
+    parsed_args = parser.parse_args(args)
+
+    start = time.time()
+    block_list = DomainBlockList()
+    try:
+        with open(parsed_args.input, encoding="ascii") as fh:
+            block_list.update(fh)
+        block_list.write_compiled(parsed_args.output)
+    except Exception as e:
+        print("Error compiling %s: %s" % (parsed_args.input, e), file=sys.stderr)
+        return 1
+
+    print(
+        "Compiled %i rules into %s in %.2fs"
+        % (len(block_list), parsed_args.output, time.time() - start)
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,42 +13,111 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-import random
-import string
 import time
-from typing import Set, Tuple
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
 
 import attr
-import saml2.response
 
 import synapse.module_api
 from synapse.api.errors import CodeMessageException
 from synapse.module_api.errors import RedirectException
 
+from matrix_synapse_saml_mozilla._attributes import (
+    AttributeExtractionPlan,
+    SamlUserAttributes,
+    parse_attribute_mapping,
+)
+from matrix_synapse_saml_mozilla._audit import (
+    AuditLogConfig,
+    DomainBlocked,
+    SessionCreated,
+    configure_audit_log,
+    parse_audit_log_config,
+    record_audit_event,
+)
+from matrix_synapse_saml_mozilla._block_list_reloader import (
+    DomainBlockListReloader,
+    stat_block_file,
+)
+from matrix_synapse_saml_mozilla._domains import (
+    DomainBlockList,
+    find_rejected_email,
+    load_domain_block_file,
+    to_domain_block_list,
+)
+from matrix_synapse_saml_mozilla._executor import (
+    configure_executor,
+    parse_thread_pool_size,
+)
+from matrix_synapse_saml_mozilla._metrics import (
+    block_list_rules,
+    rejected_saml_responses,
+    saml_response_duration,
+)
+from matrix_synapse_saml_mozilla._session_stores import (
+    SessionStoreConfig,
+    configure_session_store,
+    parse_session_store_config,
+)
 from matrix_synapse_saml_mozilla._sessions import (
     SESSION_COOKIE_NAME,
     UsernameMappingSession,
-    expire_old_sessions,
-    username_mapping_sessions,
+    create_mapping_session,
+    start_session_reaper,
 )
 
+if TYPE_CHECKING:
+    # pysaml2 is slow to import, and Synapse has already imported it by the time it
+    # passes us a response
+    import saml2.response
+
 logger = logging.getLogger(__name__)
 
 
 MAPPING_SESSION_VALIDITY_PERIOD_MS = 15 * 60 * 1000
 
-# names of attributes in the `ava` property we get from pysaml2
-UID_ATTRIBUTE_NAME = (
-    "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/nameidentifier"
-)
-EMAIL_ATTRIBUTE_NAME = "email"
-DISPLAYNAME_ATTRIBUTE_NAME = "displayName"
-
 
 @attr.s
 class SamlConfig(object):
     use_name_id_for_remote_uid = attr.ib(type=bool, default=True)
-    domain_block_list = attr.ib(type=Set[str], factory=set)
+    domain_block_list = attr.ib(
+        type=DomainBlockList, factory=DomainBlockList, converter=to_domain_block_list
+    )
+    session_store = attr.ib(type=Optional[SessionStoreConfig], default=None)
+
+    # the number of threads to run blocking steps in, or None for the default
+    thread_pool_size = attr.ib(type=Optional[int], default=None)
+
+    # where to write audit events, or None to disable auditing
+    audit_log = attr.ib(type=Optional[AuditLogConfig], default=None)
+
+    # how to find the user's attributes in a SAML response
+    attributes = attr.ib(type=AttributeExtractionPlan, factory=AttributeExtractionPlan)
+
+    # the sources of domain_block_list, so that it can be rebuilt
+    bad_domain_list = attr.ib(type=List[str], factory=list)
+    bad_domain_file = attr.ib(type=Optional[str], default=None)
+
+    # how often to check bad_domain_file for changes, in seconds. None to disable.
+    bad_domain_file_reload_interval = attr.ib(type=Optional[float], default=None)
+
+    # the status of bad_domain_file just before it was loaded
+    bad_domain_file_stat = attr.ib(type=Optional[Tuple[int, int, int]], default=None)
+
+
+def build_domain_block_list(
+    bad_domain_list: List[str], bad_domain_file: Optional[str]
+) -> DomainBlockList:
+    """Builds the domain block list from the inline list and the block file"""
+    block_list = DomainBlockList(bad_domain_list)
+    if bad_domain_file:
+        try:
+            load_domain_block_file(bad_domain_file, block_list)
+        except Exception as e:
+            raise Exception(
+                "Error reading domain block file %s: %s" % (bad_domain_file, e)
+            )
+    return block_list
 
 
 class SamlMappingProvider(object):
@@ -60,35 +129,75 @@ class SamlMappingProvider(object):
         Args:
             parsed_config: A configuration object. The result of self.parse_config
         """
-        self._random = random.SystemRandom()
         self._config = parsed_config
 
+        if self._config.session_store is not None:
+            configure_session_store(self._config.session_store)
+        if self._config.thread_pool_size is not None:
+            configure_executor(self._config.thread_pool_size)
+        if self._config.audit_log is not None:
+            configure_audit_log(self._config.audit_log)
+        start_session_reaper()
+
         logger.info("Domain block list: %s", self._config.domain_block_list)
+        block_list_rules.set(len(self._config.domain_block_list))
+
+        self._block_list_reloader = None
+        if (
+            self._config.bad_domain_file
+            and self._config.bad_domain_file_reload_interval
+        ):
+            self._block_list_reloader = DomainBlockListReloader(
+                self._config.bad_domain_file,
+                build=lambda: build_domain_block_list(
+                    self._config.bad_domain_list, self._config.bad_domain_file
+                ),
+                on_reload=self._on_block_list_reloaded,
+                interval=self._config.bad_domain_file_reload_interval,
+                last_stat=self._config.bad_domain_file_stat,
+            )
+            self._block_list_reloader.start()
+
+    def _on_block_list_reloaded(self, block_list: DomainBlockList):
+        # replacing the attribute is atomic, so requests see either the old or the
+        # new block list
+        self._config.domain_block_list = block_list
 
     def get_remote_user_id(
-        self, saml_response: saml2.response.AuthnResponse, client_redirect_url: str
+        self, saml_response: "saml2.response.AuthnResponse", client_redirect_url: str
     ):
         """Extracts the remote user id from the SAML response"""
+        if self._config.use_name_id_for_remote_uid:
+            return self._get_remote_user_id(saml_response, None)
+        attributes = self._config.attributes.extract(saml_response.ava)
+        return self._get_remote_user_id(saml_response, attributes)
+
+    def _get_remote_user_id(
+        self,
+        saml_response: "saml2.response.AuthnResponse",
+        attributes: Optional[SamlUserAttributes],
+    ):
+        """Extracts the remote user id from the NameID, or the extracted attributes
+
+        `attributes` may be None if the remote user id is taken from the NameID.
+        """
         if self._config.use_name_id_for_remote_uid:
             name_id = saml_response.name_id
             if not name_id:
                 logger.warning("SAML2 response lacks a NameID field")
                 raise CodeMessageException(400, "'NameID' not in SAML2 response")
             return name_id.text
-        else:
-            try:
-                return saml_response.ava[UID_ATTRIBUTE_NAME][0]
-            except KeyError:
-                logger.warning(
-                    "SAML2 response lacks a '%s' attribute", UID_ATTRIBUTE_NAME
-                )
-                raise CodeMessageException(
-                    400, "'%s' not in SAML2 response" % (UID_ATTRIBUTE_NAME,)
-                )
 
+        if attributes is None or attributes.remote_user_id is None:
+            names = self._config.attributes.mapping.remote_user_id
+            logger.warning("SAML2 response lacks a '%s' attribute", names[0])
+            raise CodeMessageException(400, "'%s' not in SAML2 response" % (names[0],))
+        return attributes.remote_user_id
+
+    @saml_response_duration.time()
     def saml_response_to_user_attributes(
         self,
-        saml_response: saml2.response.AuthnResponse,
+        saml_response: "saml2.response.AuthnResponse",
         failures: int,
         client_redirect_url: str,
     ) -> dict:
@@ -106,42 +215,33 @@ class SamlMappingProvider(object):
                 * mxid_localpart (str): Required. The localpart of the user's mxid
                 * displayname (str): The displayname of the user
         """
-        remote_user_id = self.get_remote_user_id(saml_response, client_redirect_url)
-        displayname = saml_response.ava.get(DISPLAYNAME_ATTRIBUTE_NAME, [None])[0]
-
-        expire_old_sessions()
+        attributes = self._config.attributes.extract(saml_response.ava)
+        remote_user_id = self._get_remote_user_id(saml_response, attributes)
+        displayname = attributes.displayname
 
         # check the user's emails against our block list
-        if EMAIL_ATTRIBUTE_NAME not in saml_response.ava:
-            logger.warning(
-                "SAML2 response lacks a '%s' attribute", EMAIL_ATTRIBUTE_NAME,
-            )
+        if attributes.emails is None:
+            email_attribute = self._config.attributes.mapping.email[0]
+            logger.warning("SAML2 response lacks a '%s' attribute", email_attribute)
+            rejected_saml_responses.labels("missing_email").inc()
             raise CodeMessageException(
-                400, "'%s' not in SAML2 response" % (EMAIL_ATTRIBUTE_NAME,)
+                400, "'%s' not in SAML2 response" % (email_attribute,)
             )
 
-        for email in saml_response.ava[EMAIL_ATTRIBUTE_NAME]:
-            parts = email.rsplit("@", 1)
-            if len(parts) != 2:
-                logger.warning(
-                    "Rejecting registration from remote user %s with unparsable email %s",
-                    remote_user_id,
-                    email,
-                )
-                raise CodeMessageException(403, "Forbidden")
-
-            if parts[1].lower() in self._config.domain_block_list:
+        rejected = find_rejected_email(
+            attributes.emails, self._config.domain_block_list
+        )
+        if rejected is not None:
+            reason, email = rejected
+            rejected_saml_responses.labels(reason).inc()
+            if not record_audit_event(DomainBlocked(remote_user_id, email, reason)):
                 logger.warning(
-                    "Rejecting registration from remote user %s with blacklisted email %s",
+                    "Rejecting registration from remote user %s with email %s: %s",
                     remote_user_id,
                     email,
+                    reason,
                 )
-                raise CodeMessageException(403, "Forbidden")
-
-        # make up a cryptorandom session id
-        session_id = "".join(
-            self._random.choice(string.ascii_letters) for _ in range(16)
-        )
+            raise CodeMessageException(403, "Forbidden")
 
         now = int(time.time() * 1000)
         session = UsernameMappingSession(
@@ -151,8 +251,9 @@ class SamlMappingProvider(object):
             expiry_time_ms=now + MAPPING_SESSION_VALIDITY_PERIOD_MS,
         )
 
-        username_mapping_sessions[session_id] = session
-        logger.info("Recorded registration session id %s", session_id)
+        session_id = create_mapping_session(session)
+        if not record_audit_event(SessionCreated(remote_user_id)):
+            logger.info("Recorded registration session id %s", session_id)
 
         # Redirect to the username picker
         e = RedirectException(b"/_matrix/saml2/pick_username/")
@@ -173,19 +274,42 @@ class SamlMappingProvider(object):
         if "use_name_id_for_remote_uid" in config:
             parsed.use_name_id_for_remote_uid = config["use_name_id_for_remote_uid"]
 
-        parsed.domain_block_list.update(config.get("bad_domain_list", []))
+        if "session_store" in config:
+            parsed.session_store = parse_session_store_config(config["session_store"])
+
+        if "thread_pool_size" in config:
+            parsed.thread_pool_size = parse_thread_pool_size(config["thread_pool_size"])
+
+        if "audit_log" in config:
+            parsed.audit_log = parse_audit_log_config(config["audit_log"])
 
-        domain_block_file = config.get("bad_domain_file")
-        if domain_block_file:
-            try:
-                with open(domain_block_file, encoding="ascii") as fh:
-                    parsed.domain_block_list.update(
-                        line.strip().lower() for line in fh.readlines()
-                    )
-            except Exception as e:
+        if "attribute_mapping" in config:
+            parsed.attributes = AttributeExtractionPlan(
+                parse_attribute_mapping(config["attribute_mapping"])
+            )
+
+        parsed.bad_domain_list = list(config.get("bad_domain_list", []))
+        parsed.bad_domain_file = config.get("bad_domain_file")
+        if config.get("bad_domain_file_reload_interval") is not None:
+            interval = config["bad_domain_file_reload_interval"]
+            if (
+                not isinstance(interval, (int, float))
+                or isinstance(interval, bool)
+                or interval <= 0
+            ):
                 raise Exception(
-                    "Error reading domain block file %s: %s" % (domain_block_file, e)
+                    "bad_domain_file_reload_interval must be a positive number of"
+                    " seconds"
                 )
+            parsed.bad_domain_file_reload_interval = interval
+
+        # take the file's status before loading it, so that a change made while it
+        # is being loaded is picked up by the first reload check
+        if parsed.bad_domain_file:
+            parsed.bad_domain_file_stat = stat_block_file(parsed.bad_domain_file)
+        parsed.domain_block_list = build_domain_block_list(
+            parsed.bad_domain_list, parsed.bad_domain_file
+        )
 
         return parsed
 
@@ -202,10 +326,18 @@ class SamlMappingProvider(object):
                 second set consists of those attributes which can be used if
                 available, but are not necessary
         """
-        required = {EMAIL_ATTRIBUTE_NAME}
-        optional = {UID_ATTRIBUTE_NAME, DISPLAYNAME_ATTRIBUTE_NAME}
-
+        mapping = config.attributes.mapping
+        required_attributes = [mapping.email]
         if not config.use_name_id_for_remote_uid:
-            required += UID_ATTRIBUTE_NAME
-
-        return required, optional
+            required_attributes.append(mapping.remote_user_id)
+
+        required: Set[str] = set()
+        optional = set(mapping.remote_user_id + mapping.displayname)
+        for names in required_attributes:
+            # if there are alternatives, none of them is required on its own
+            if len(names) == 1:
+                required.update(names)
+            else:
+                optional.update(names)
+
+        return required, optional - required
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Registers users in bulk, from a CSV or JSONL file of remote user ids, localparts,
+display names and emails, so that they can log in without picking a username.
+
+From inside Synapse, call `provision_users` with the module API. From outside, run:
+
+    python -m matrix_synapse_saml_mozilla.provision_users \\
+        --homeserver https://synapse.example.com INPUT
+
+with the access token of a server admin in the SYNAPSE_ACCESS_TOKEN environment
+variable, and the homeserver's `registration_shared_secret` in the
+SYNAPSE_REGISTRATION_SHARED_SECRET environment variable. The users are registered
+through the Admin API, which requires Synapse 1.68 or later. Progress is recorded in
+a checkpoint file, so that if the run fails, running the same command again carries
+on where it left off.
+"""
+
+import argparse
+import collections
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import secrets
+import sys
+import urllib.parse
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from twisted.internet import defer
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+import synapse.module_api
+
+from matrix_synapse_saml_mozilla._domains import DomainBlockList
+from matrix_synapse_saml_mozilla._external_ids import SAML_AUTH_PROVIDER_ID
+from matrix_synapse_saml_mozilla._provisioning import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    INPUT_FORMATS,
+    ModuleApiProvisioningBackend,
+    Provisioner,
+    ProvisioningBackend,
+    ProvisioningError,
+    ProvisioningRecord,
+    read_records,
+)
+from matrix_synapse_saml_mozilla.mapping_provider import build_domain_block_list
+
+logger = logging.getLogger(__name__)
+
+ACCESS_TOKEN_ENV_VAR = "SYNAPSE_ACCESS_TOKEN"
+REGISTRATION_SHARED_SECRET_ENV_VAR = "SYNAPSE_REGISTRATION_SHARED_SECRET"
+
+
+async def provision_users(
+    module_api: synapse.module_api.ModuleApi,
+    records: Iterable[ProvisioningRecord],
+    block_list: DomainBlockList,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> Dict[str, int]:
+    """Register users in bulk, from inside Synapse
+
+    Users whose remote user id already has a Matrix user are skipped, so this can be
+    called again with the same records if it fails.
+
+    Args:
+        module_api: the Synapse module API
+        records: the users to register. See `read_records` to read them from a file.
+        block_list: the domains to refuse users from, such as the mapping
+            provider's `domain_block_list`
+        batch_size: the number of records to look up together
+        concurrency: the maximum number of registrations in flight at once
+
+    Returns:
+        the number of records with each outcome
+    """
+    provisioner = Provisioner(
+        ModuleApiProvisioningBackend(module_api), block_list, batch_size, concurrency
+    )
+    return await provisioner.run(records)
+
+
+class AdminApiProvisioningBackend(ProvisioningBackend):
+    """Provisions users through the Synapse Admin API
+
+    Users are created with the shared-secret registration API, which fails rather
+    than modifying a user who already exists, and their remote user ids are then
+    recorded for them. Each user is registered with a random password, which is
+    thrown away, and the access token which registration creates is logged out.
+
+    Registration and recording the remote user id are separate requests, so the
+    users which have been registered are appended to a journal. If a later run finds
+    that a localpart is taken by a user in the journal who has no remote user id, it
+    records the remote user id rather than reporting the localpart as taken. Users
+    who are not in the journal are never modified.
+
+    Args:
+        agent: makes the HTTP requests
+        base_url: the homeserver's client-server API URL
+        access_token: the access token of a server admin
+        registration_shared_secret: the homeserver's `registration_shared_secret`
+        journal_path: the file to record registered users in, or None to record them
+            only in memory
+    """
+
+    def __init__(
+        self,
+        agent: Agent,
+        base_url: str,
+        access_token: str,
+        registration_shared_secret: str,
+        journal_path: Optional[str] = None,
+    ):
+        self._agent = agent
+        self._base_url = base_url.rstrip("/")
+        self._access_token = access_token
+        self._registration_shared_secret = registration_shared_secret.encode("utf-8")
+        self._journal_path = journal_path
+        self._server_name: Optional[str] = None
+
+        # map from the (lowercased) id of each user registered by this or an earlier
+        # run to its remote user id
+        self._registered: Dict[str, str] = {}
+        if journal_path is not None:
+            self._registered = load_registrations(journal_path)
+
+    async def _request(
+        self,
+        method: bytes,
+        path: str,
+        body: Optional[dict] = None,
+        access_token: Optional[str] = None,
+    ) -> Tuple[int, Any]:
+        token = access_token or self._access_token
+        headers = Headers({b"Authorization": [b"Bearer " + token.encode("ascii")]})
+        producer = None
+        if body is not None:
+            headers.addRawHeader(b"Content-Type", b"application/json")
+            producer = FileBodyProducer(io.BytesIO(json.dumps(body).encode("utf-8")))
+
+        response = await self._agent.request(
+            method, (self._base_url + path).encode("ascii"), headers, producer
+        )
+        content = await readBody(response)
+        try:
+            return response.code, json.loads(content)
+        except ValueError:
+            return response.code, {}
+
+    async def _get_user_id(self, localpart: str) -> str:
+        if self._server_name is None:
+            code, body = await self._request(
+                b"GET", "/_matrix/client/v3/account/whoami"
+            )
+            if code != 200:
+                raise Exception("Unable to check the access token: %s" % (body,))
+            self._server_name = body["user_id"].split(":", 1)[1]
+        return "@%s:%s" % (localpart, self._server_name)
+
+    async def _get_user(self, user_id: str) -> Optional[dict]:
+        code, body = await self._request(
+            b"GET", "/_synapse/admin/v2/users/%s" % (urllib.parse.quote(user_id),)
+        )
+        if code not in (200, 404):
+            raise Exception("Error looking up %s: %s" % (user_id, body))
+        return body if code == 200 else None
+
+    async def get_provisioned(self, remote_user_ids: List[str]) -> Dict[str, str]:
+        provisioned = {}
+        for remote_user_id in remote_user_ids:
+            code, body = await self._request(
+                b"GET",
+                "/_synapse/admin/v1/auth_providers/%s/users/%s"
+                % (
+                    urllib.parse.quote(SAML_AUTH_PROVIDER_ID),
+                    urllib.parse.quote(remote_user_id, safe=""),
+                ),
+            )
+            if code == 200:
+                provisioned[remote_user_id] = body["user_id"]
+            elif code != 404:
+                raise Exception("Error looking up %s: %s" % (remote_user_id, body))
+        return provisioned
+
+    async def check_available(self, localparts: List[str]) -> Dict[str, bool]:
+        return {
+            localpart: await self._get_user(await self._get_user_id(localpart)) is None
+            for localpart in localparts
+        }
+
+    async def provision(self, record: ProvisioningRecord) -> str:
+        code, body = await self._request(b"GET", "/_synapse/admin/v1/register")
+        if code != 200:
+            raise Exception("Unable to get a registration nonce: %s" % (body,))
+        nonce = body["nonce"]
+
+        password = secrets.token_urlsafe(32)
+        mac = hmac.new(self._registration_shared_secret, digestmod=hashlib.sha1)
+        for part in (nonce, record.localpart, password):
+            mac.update(part.encode("utf-8"))
+            mac.update(b"\x00")
+        mac.update(b"notadmin")
+
+        # unlike the user admin API, this fails if the user already exists
+        code, body = await self._request(
+            b"POST",
+            "/_synapse/admin/v1/register",
+            {
+                "nonce": nonce,
+                "username": record.localpart,
+                "password": password,
+                "displayname": record.displayname or record.localpart,
+                "admin": False,
+                "mac": mac.hexdigest(),
+            },
+        )
+        if code != 200:
+            raise ProvisioningError(
+                body.get("errcode", "M_UNKNOWN"), body.get("error", "HTTP %i" % code)
+            )
+        user_id = body["user_id"]
+        self._record_registration(user_id, record.remote_user_id)
+
+        if body.get("access_token"):
+            await self._request(
+                b"POST",
+                "/_matrix/client/v3/logout",
+                {},
+                access_token=body["access_token"],
+            )
+
+        await self._record_external_id(user_id, record)
+        return user_id
+
+    async def resume(self, record: ProvisioningRecord) -> Optional[str]:
+        user_id = await self._get_user_id(record.localpart)
+        if self._registered.get(user_id.lower()) != record.remote_user_id:
+            return None
+
+        user = await self._get_user(user_id)
+        if user is None or user.get("external_ids"):
+            return None
+
+        await self._record_external_id(user["name"], record)
+        return user["name"]
+
+    def _record_registration(self, user_id: str, remote_user_id: str):
+        self._registered[user_id.lower()] = remote_user_id
+        if self._journal_path is None:
+            return
+        with open(self._journal_path, "a") as fh:
+            fh.write(
+                json.dumps({"user_id": user_id, "remote_user_id": remote_user_id})
+                + "\n"
+            )
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    async def _record_external_id(self, user_id: str, record: ProvisioningRecord):
+        # the user was registered by this backend, so replacing its external ids
+        # cannot take over anyone else's account
+        code, body = await self._request(
+            b"PUT",
+            "/_synapse/admin/v2/users/%s" % (urllib.parse.quote(user_id),),
+            {
+                "external_ids": [
+                    {
+                        "auth_provider": SAML_AUTH_PROVIDER_ID,
+                        "external_id": record.remote_user_id,
+                    }
+                ],
+            },
+        )
+        if code not in (200, 201):
+            raise ProvisioningError(
+                body.get("errcode", "M_UNKNOWN"), body.get("error", "HTTP %i" % code)
+            )
+
+
+def load_registrations(path: str) -> Dict[str, str]:
+    """Read the journal of users registered by AdminApiProvisioningBackend
+
+    Returns:
+        a map from each (lowercased) user id to its remote user id
+    """
+    registered = {}
+    try:
+        with open(path) as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be partly written
+                    continue
+                registered[entry["user_id"].lower()] = entry["remote_user_id"]
+    except FileNotFoundError:
+        pass
+    return registered
+
+
+def load_checkpoint(path: str, input_path: str) -> int:
+    """Returns the number of records which a previous run processed, if any"""
+    try:
+        with open(path) as fh:
+            checkpoint = json.load(fh)
+    except FileNotFoundError:
+        return 0
+    if checkpoint.get("input") != os.path.abspath(input_path):
+        raise Exception(
+            "Checkpoint %s is for a different input file, %s"
+            % (path, checkpoint.get("input"))
+        )
+    return checkpoint["processed"]
+
+
+def save_checkpoint(path: str, input_path: str, processed: int):
+    """Record the number of records which have been processed"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump({"input": os.path.abspath(input_path), "processed": processed}, fh)
+    os.replace(tmp_path, path)
+
+
+def _input_format(path: str, input_format: Optional[str]) -> str:
+    if input_format is not None:
+        return input_format
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    raise Exception("Unable to tell the format of %s: use --format" % (path,))
+
+
+async def _run(
+    reactor,
+    args: argparse.Namespace,
+    access_token: str,
+    registration_shared_secret: str,
+) -> Dict[str, int]:
+    block_list = build_domain_block_list(args.bad_domain, args.bad_domain_file)
+    input_format = _input_format(args.input, args.format)
+    checkpoint = args.checkpoint or args.input + ".checkpoint"
+    skip = load_checkpoint(checkpoint, args.input)
+    if skip:
+        print("Resuming after %i records" % (skip,))
+
+    backend = AdminApiProvisioningBackend(
+        Agent(reactor),
+        args.homeserver,
+        access_token,
+        registration_shared_secret,
+        journal_path=checkpoint + ".registered",
+    )
+    provisioner = Provisioner(backend, block_list, args.batch_size, args.concurrency)
+
+    report = open(args.report, "a") if args.report else None
+
+    def on_outcome(outcome):
+        if report is not None:
+            report.write(
+                json.dumps(
+                    {
+                        "remote_user_id": outcome.record.remote_user_id,
+                        "localpart": outcome.record.localpart,
+                        "outcome": outcome.outcome,
+                        "user_id": outcome.user_id,
+                        "error": outcome.error,
+                    }
+                )
+                + "\n"
+            )
+
+    def on_batch(processed):
+        if report is not None:
+            report.flush()
+        save_checkpoint(checkpoint, args.input, processed)
+
+    try:
+        with open(args.input, encoding="utf-8", newline="") as fh:
+            return await provisioner.run(
+                read_records(fh, input_format), skip, on_outcome, on_batch
+            )
+    finally:
+        if report is not None:
+            report.close()
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Register users in bulk through the Synapse Admin API, with "
+        "the access token of a server admin in the %s environment variable, and "
+        "the homeserver's registration_shared_secret in %s."
+        % (ACCESS_TOKEN_ENV_VAR, REGISTRATION_SHARED_SECRET_ENV_VAR)
+    )
+    parser.add_argument("input", help="the CSV or JSONL file of users to register")
+    parser.add_argument(
+        "--homeserver", required=True, help="the URL of the homeserver's client API"
+    )
+    parser.add_argument(
+        "--format", choices=INPUT_FORMATS, help="default: from the file extension"
+    )
+    parser.add_argument(
+        "--bad-domain-file", help="refuse users with emails in these domains"
+    )
+    parser.add_argument(
+        "--bad-domain",
+        action="append",
+        default=[],
+        help="refuse users with emails in this domain. May be given more than once.",
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="the maximum number of registrations in flight at once",
+    )
+    parser.add_argument(
+        "--checkpoint", help="where to record progress. Default: INPUT.checkpoint"
+    )
+    parser.add_argument(
+        "--report", help="append the outcome for each user to this JSONL file"
+    )
+    parsed_args = parser.parse_args(args)
+
+    access_token = os.environ.get(ACCESS_TOKEN_ENV_VAR)
+    registration_shared_secret = os.environ.get(REGISTRATION_SHARED_SECRET_ENV_VAR)
+    if not access_token or not registration_shared_secret:
+        print(
+            "%s and %s must be set"
+            % (ACCESS_TOKEN_ENV_VAR, REGISTRATION_SHARED_SECRET_ENV_VAR),
+            file=sys.stderr,
+        )
+        return 1
+
+    from twisted.internet import reactor
+
+    results: List[Any] = []
+
+    async def run_and_stop():
+        try:
+            results.append(
+                await _run(
+                    reactor, parsed_args, access_token, registration_shared_secret
+                )
+            )
+        except Exception as e:
+            results.append(e)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(lambda: defer.ensureDeferred(run_and_stop()))
+    reactor.run()
+
+    if not results or isinstance(results[0], Exception):
+        print("Error provisioning users: %s" % (results[:1],), file=sys.stderr)
+        return 1
+
+    counts = collections.Counter(results[0])
+    for outcome, count in sorted(counts.items()):
+        print("%s: %i" % (outcome, count))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
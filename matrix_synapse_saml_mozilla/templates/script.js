@@ -0,0 +1,111 @@
+let inputField = document.getElementById("field-username");
+let inputForm = document.getElementById("form");
+let submitButton = document.getElementById("button-submit");
+let message = document.getElementById("message");
+
+// Remove input field placeholder if the text field is not empty
+let switchClass = function(input) {
+  if (input.value.length > 0) {
+    input.classList.add('has-contents');
+  }
+  else {
+    input.classList.remove('has-contents');
+  }
+};
+
+// Submit username and receive response
+let showMessage = function(messageText) {
+  // Unhide the message text
+  message.classList.remove("hidden");
+
+  message.innerHTML = messageText;
+};
+
+// The username rules, which the server also checks. Until they have been fetched
+// from the server, only the characters are checked.
+let rules = {
+  allowed_characters: "a-z0-9._=/-",
+  reserved: [],
+  prohibited_substrings: [],
+  messages: {},
+};
+let disallowedUsernameCharacters = RegExp("[^" + rules.allowed_characters + "]");
+let reservedUsernames = new Set();
+let allowedCharactersString = "" +
+"lowercase letters, " +
+"digits, " +
+"<code>.</code>, " +
+"<code>_</code>, " +
+"<code>-</code>, " +
+"<code>/</code>, " +
+"<code>=</code>";
+
+fetch("rules.json").then((response) => {
+  if (!response.ok) {
+    throw new Error("HTTP " + response.status);
+  }
+  return response.json();
+}).then((fetchedRules) => {
+  rules = fetchedRules;
+  disallowedUsernameCharacters = RegExp("[^" + rules.allowed_characters + "]");
+  reservedUsernames = new Set(rules.reserved);
+}).catch((error) => {
+  console.warn("Unable to fetch the username rules: " + error);
+});
+
+// Returns an error message if the username breaks the rules, or null
+let checkUsername = function(username) {
+  if (username.length == 0) {
+    return "Please enter a username.";
+  }
+  if (disallowedUsernameCharacters.test(username)) {
+    return "Invalid username. Only the following characters are allowed: " + allowedCharactersString;
+  }
+  if (reservedUsernames.has(username)) {
+    return rules.messages.reserved;
+  }
+  if (rules.prohibited_substrings.some((substring) => username.includes(substring))) {
+    return rules.messages.prohibited_substring;
+  }
+  return null;
+};
+
+// Check the username before submitting the form. The server checks the rules
+// again, and that the username is available, when the form is submitted, and
+// shows the form again if it is not.
+let onSubmit = function(event) {
+  let error = checkUsername(inputField.value);
+  if(error) {
+    event.preventDefault();
+    showMessage(error);
+    return;
+  }
+  if(submitButton.classList.contains('button--disabled')) {
+    event.preventDefault();
+    return;
+  }
+
+  // Disable submit button
+  submitButton.classList.add('button--disabled');
+  submitButton.value = "Registering...";
+};
+
+inputForm.addEventListener('submit', onSubmit);
+
+// Suggested usernames fill in the input field when clicked
+document.querySelectorAll("#message .suggestion").forEach((link) => {
+  link.addEventListener('click', function(event) {
+    event.preventDefault();
+    inputField.value = link.dataset.username;
+    switchClass(inputField);
+    inputField.focus();
+  });
+});
+
+// Listen for events on inputField
+inputField.addEventListener('keyup', function() {
+  switchClass(inputField);
+});
+inputField.addEventListener('change', function() {
+  switchClass(inputField);
+});
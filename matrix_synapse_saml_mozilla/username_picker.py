@@ -12,56 +12,290 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import gzip
 import html
 import json
 import logging
+import math
+import os
 import urllib.parse
-from typing import Any
+from typing import Any, List, Optional
 
-import pkg_resources
+import attr
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET, Request
-from twisted.web.static import File
 
 import synapse.module_api
 from synapse.module_api import run_in_background
 from synapse.module_api.errors import SynapseError
 
+from matrix_synapse_saml_mozilla._audit import (
+    AuditLogConfig,
+    UsernameChecked,
+    UserRegistered,
+    configure_audit_log,
+    parse_audit_log_config,
+    record_audit_event,
+)
+from matrix_synapse_saml_mozilla._availability import UsernameAvailabilityChecker
+from matrix_synapse_saml_mozilla._cache import TTLCache
+from matrix_synapse_saml_mozilla._executor import (
+    configure_executor,
+    parse_thread_pool_size,
+)
+from matrix_synapse_saml_mozilla._external_ids import (
+    SAML_AUTH_PROVIDER_ID,
+    lookup_external_id,
+)
+from matrix_synapse_saml_mozilla._localpart_rules import (
+    LocalpartValidator,
+    load_prohibited_substrings_file,
+)
+from matrix_synapse_saml_mozilla._metrics import (
+    check_batch_duration,
+    check_duration,
+    page_duration,
+    rate_limited_requests,
+    rejected_localparts,
+    submit_duration,
+    submit_step_duration,
+    time_async,
+)
+from matrix_synapse_saml_mozilla._picker_page import PickerPageTemplate
+from matrix_synapse_saml_mozilla._ratelimit import (
+    RateLimitConfig,
+    RequestRateLimiter,
+    parse_max_tracked_keys,
+    parse_rate_limit_config,
+)
+from matrix_synapse_saml_mozilla._registered_users import (
+    RegisteredUsersFilter,
+    RegisteredUsersFilterConfig,
+    parse_registered_users_filter_config,
+)
+from matrix_synapse_saml_mozilla._session_stores import (
+    SessionStoreConfig,
+    configure_session_store,
+    parse_session_store_config,
+)
 from matrix_synapse_saml_mozilla._sessions import (
     SESSION_COOKIE_NAME,
+    UsernameMappingSession,
     get_mapping_session,
-    username_mapping_sessions,
+    restore_mapping_session,
+    start_session_reaper,
+    take_mapping_session,
+)
+from matrix_synapse_saml_mozilla._singleflight import SingleFlight
+from matrix_synapse_saml_mozilla._static import (
+    accepted_encodings,
+    generated_asset_resource,
 )
+from matrix_synapse_saml_mozilla._suggestions import suggest_localparts
 
 """
 This file implements the "username picker" resource, which is mapped as an
 additional_resource into the synapse resource tree.
 
-The top-level resource is just a File resource which serves up the static files in the
-"res" directory, but it has a couple of children:
+The top-level resource only redirects to add a trailing slash, but it has a couple of
+children:
+
+   * "" (ie, the top-level URL, with a trailing slash), which renders the picker page,
+     with a suggested username filled in. If the user has in fact registered already,
+     it logs them in instead.
 
    * "submit", which does the mechanics of registering the new user, and redirects the
-     browser back to the client URL
+     browser back to the client URL. If the username is not available, it renders the
+     picker page again, with an error.
+
+   * "check": checks if a userid is free.
 
-    * "check" (TODO): checks if a userid is free.
+   * "check_batch": checks if each of several userids is free, and suggests some
+     free userids based on the user's displayname.
+
+   * "rules.json": the username rules, served from memory (see _static.py).
 """
 
 logger = logging.getLogger(__name__)
 
+# the templates are found relative to this module. The package is not zip-safe, so
+# they are always plain files.
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_RATE_LIMIT_PER_IP = RateLimitConfig(per_second=10, burst_count=100)
+DEFAULT_RATE_LIMIT_PER_SESSION = RateLimitConfig(per_second=1, burst_count=20)
+
+# the number of available usernames to offer when a username is not accepted
+PAGE_SUGGESTIONS = 3
+
+# the maximum number of sessions which registered a user to remember, and for how
+# long, in seconds, so that duplicate submissions log the user in again
+COMPLETED_SUBMISSIONS_CACHE_SIZE = 10000
+COMPLETED_SUBMISSIONS_CACHE_TTL = 60
+
+# the gzip compression level for rendered pages. Each page is compressed as it is
+# sent, so this trades a little size for less time on the reactor.
+HTML_GZIP_LEVEL = 6
+
+
+@attr.s
+class PickUsernameConfig:
+    session_store = attr.ib(type=Optional[SessionStoreConfig], default=None)
+
+    # the number of threads to run blocking steps in, or None for the default
+    thread_pool_size = attr.ib(type=Optional[int], default=None)
+
+    # where to write audit events, or None to disable auditing
+    audit_log = attr.ib(type=Optional[AuditLogConfig], default=None)
+
+    # the rules which usernames must follow, compiled from the reserved usernames
+    # and prohibited substrings
+    localpart_validator = attr.ib(type=LocalpartValidator, factory=LocalpartValidator)
+
+    # the maximum number of unavailable usernames to remember
+    availability_cache_size = attr.ib(type=int, default=10000)
+
+    # how long to remember that a username is unavailable, in seconds
+    availability_cache_ttl = attr.ib(type=float, default=60)
+
+    # how to build the filter of registered users, or None to check every username
+    # which is not in the cache against the database
+    registered_users_filter = attr.ib(
+        type=Optional[RegisteredUsersFilterConfig], default=None
+    )
+
+    # limits on the rate of requests to /check, /check_batch and /submit, or None
+    # for no limit. Rate limiting is off unless it is configured.
+    rate_limit_per_ip = attr.ib(type=Optional[RateLimitConfig], default=None)
+    rate_limit_per_session = attr.ib(type=Optional[RateLimitConfig], default=None)
+
+    # the maximum number of IPs and sessions to track rate limits for
+    rate_limit_max_tracked_keys = attr.ib(type=int, default=100000)
+
 
 def pick_username_resource(
-    parsed_config, module_api: synapse.module_api.ModuleApi
+    parsed_config: PickUsernameConfig, module_api: synapse.module_api.ModuleApi
 ) -> Resource:
     """Factory method to generate the top-level username picker resource"""
-    base_path = pkg_resources.resource_filename("matrix_synapse_saml_mozilla", "res")
-    res = File(base_path)
-    res.putChild(b"submit", SubmitResource(module_api))
-    res.putChild(b"check", AvailabilityCheckResource(module_api))
+    if parsed_config.session_store is not None:
+        configure_session_store(parsed_config.session_store)
+    if parsed_config.thread_pool_size is not None:
+        configure_executor(parsed_config.thread_pool_size)
+    if parsed_config.audit_log is not None:
+        configure_audit_log(parsed_config.audit_log)
+    start_session_reaper()
+
+    res = PickUsernameRootResource()
+    page = PickerPageTemplate(os.path.join(PACKAGE_DIR, "templates"))
+
+    registered_users = None
+    if parsed_config.registered_users_filter is not None:
+        registered_users = RegisteredUsersFilter(
+            module_api, parsed_config.registered_users_filter
+        )
+        registered_users.start()
+
+    # shared between the resources so that /submit can record newly-registered users
+    availability_checker = UsernameAvailabilityChecker(
+        module_api,
+        TTLCache(
+            parsed_config.availability_cache_size, parsed_config.availability_cache_ttl,
+        ),
+        parsed_config.localpart_validator,
+        registered_users,
+    )
+
+    # shared between the resources, so that they count against the same limits
+    rate_limiter = RequestRateLimiter(
+        per_ip=parsed_config.rate_limit_per_ip,
+        per_session=parsed_config.rate_limit_per_session,
+        max_keys=parsed_config.rate_limit_max_tracked_keys,
+    )
+
+    res.putChild(
+        b"",
+        PickUsernamePageResource(module_api, availability_checker, rate_limiter, page),
+    )
+    res.putChild(
+        b"submit",
+        SubmitResource(
+            module_api,
+            availability_checker,
+            rate_limiter,
+            page,
+            parsed_config.localpart_validator,
+        ),
+    )
+    res.putChild(
+        b"check",
+        AvailabilityCheckResource(
+            module_api,
+            availability_checker,
+            rate_limiter,
+            parsed_config.localpart_validator,
+        ),
+    )
+    res.putChild(
+        b"check_batch",
+        BatchAvailabilityCheckResource(module_api, availability_checker, rate_limiter),
+    )
+    # the username rules, for the page's script to check usernames with
+    res.putChild(
+        b"rules.json",
+        generated_asset_resource(
+            "rules.json", parsed_config.localpart_validator.to_json()
+        ),
+    )
     return res
 
 
-def parse_config(config: dict):
-    return None
+def parse_config(config: dict) -> PickUsernameConfig:
+    parsed = PickUsernameConfig()
+    if "session_store" in config:
+        parsed.session_store = parse_session_store_config(config["session_store"])
+    if "thread_pool_size" in config:
+        parsed.thread_pool_size = parse_thread_pool_size(config["thread_pool_size"])
+    if "audit_log" in config:
+        parsed.audit_log = parse_audit_log_config(config["audit_log"])
+
+    prohibited_substrings = list(config.get("prohibited_localpart_substrings", []))
+    if config.get("prohibited_localpart_substrings_file"):
+        prohibited_substrings.extend(
+            load_prohibited_substrings_file(
+                config["prohibited_localpart_substrings_file"]
+            )
+        )
+    parsed.localpart_validator = LocalpartValidator(
+        config.get("reserved_localparts", []), prohibited_substrings
+    )
+
+    if "availability_cache_size" in config:
+        parsed.availability_cache_size = config["availability_cache_size"]
+    if "availability_cache_ttl" in config:
+        parsed.availability_cache_ttl = config["availability_cache_ttl"]
+    if "registered_users_filter" in config:
+        parsed.registered_users_filter = parse_registered_users_filter_config(
+            config["registered_users_filter"] or {}
+        )
+
+    if "rate_limiting" in config:
+        rate_limiting = config["rate_limiting"] or {}
+        # each limit applies with its defaults unless it is set to null
+        per_ip = rate_limiting.get("per_ip", {})
+        if per_ip is not None:
+            parsed.rate_limit_per_ip = parse_rate_limit_config(
+                per_ip, DEFAULT_RATE_LIMIT_PER_IP
+            )
+        per_session = rate_limiting.get("per_session", {})
+        if per_session is not None:
+            parsed.rate_limit_per_session = parse_rate_limit_config(
+                per_session, DEFAULT_RATE_LIMIT_PER_SESSION
+            )
+        if "max_tracked_keys" in rate_limiting:
+            parsed.rate_limit_max_tracked_keys = parse_max_tracked_keys(
+                rate_limiting["max_tracked_keys"]
+            )
+    return parsed
 
 
 pick_username_resource.parse_config = parse_config
@@ -80,12 +314,22 @@ HTML_ERROR_TEMPLATE = """<!DOCTYPE html>
 """
 
 
+class PickUsernameRootResource(Resource):
+    """The top-level resource, which only has children"""
+
+    def render_GET(self, request: Request) -> bytes:
+        # we were requested without a trailing slash: redirect so that relative
+        # links from the picker page (which is the "" child) work.
+        request.redirect(request.path + b"/")
+        return b""
+
+
 def _wrap_for_html_exceptions(f):
     async def wrapped(self, request):
         try:
             return await f(self, request)
         except Exception:
-            logger.exception("Error handling request %s" % (request,))
+            logger.exception("Error handling request %s", request)
             _return_html_error(500, "Internal server error", request)
 
     return wrapped
@@ -96,7 +340,7 @@ def _wrap_for_text_exceptions(f):
         try:
             return await f(self, request)
         except Exception:
-            logger.exception("Error handling request %s" % (request,))
+            logger.exception("Error handling request %s", request)
             body = b"Internal server error"
             request.setResponseCode(500)
             request.setHeader(b"Content-Type", b"text/plain; charset=utf-8")
@@ -126,71 +370,276 @@ class AsyncResource(Resource):
         return NOT_DONE_YET
 
 
-class SubmitResource(AsyncResource):
-    def __init__(self, module_api: synapse.module_api.ModuleApi):
+class PickUsernamePageResource(AsyncResource):
+    """Renders the username picker page, with a suggested username filled in"""
+
+    def __init__(
+        self,
+        module_api: synapse.module_api.ModuleApi,
+        availability_checker: UsernameAvailabilityChecker,
+        rate_limiter: RequestRateLimiter,
+        page: PickerPageTemplate,
+    ):
         super().__init__()
         self._module_api = module_api
+        self._availability_checker = availability_checker
+        self._rate_limiter = rate_limiter
+        self._page = page
 
+    @time_async(page_duration)
     @_wrap_for_html_exceptions
-    async def async_render_POST(self, request: Request):
+    async def async_render_GET(self, request: Request):
         session_id = request.getCookie(SESSION_COOKIE_NAME)
         if not session_id:
             _return_html_error(400, "missing session_id", request)
             return
 
         session_id = session_id.decode("ascii", errors="replace")
-        session = get_mapping_session(session_id)
+        retry_after = self._rate_limiter.try_acquire(
+            _get_client_ip(request), session_id
+        )
+        if retry_after:
+            rate_limited_requests.labels("page").inc()
+            _set_retry_after(request, retry_after)
+            _return_html_error(429, "Too many requests", request)
+            return
+
+        session = await get_mapping_session(session_id)
         if not session:
             logger.info("Session ID %s not found", session_id)
             _return_html_error(403, "Unknown session", request)
             return
 
-        # we don't clear the session from the dict until the ID is successfully
-        # registered, so the user can go round and have another go if need be.
-        #
-        # this means there's theoretically a race where a single user can register
-        # two accounts. I'm going to assume that's not a dealbreaker.
+        suggestions = await _suggest_usernames(self._availability_checker, session, 1)
+        username = suggestions[0] if suggestions else ""
+        _return_html(200, self._page.render(username=username), request)
+
+
+@attr.s(frozen=True, slots=True)
+class _SubmitOutcome:
+    """The outcome of submitting a username for a session"""
+
+    # the session, or None if it was not found
+    session = attr.ib(type=Optional[UsernameMappingSession])
+
+    # the newly-registered user, if the username was accepted
+    user_id = attr.ib(type=Optional[str], default=None)
+
+    # otherwise, the response code and error to re-render the picker page with
+    error_code = attr.ib(type=int, default=0)
+    error = attr.ib(type=Optional[str], default=None)
+    username = attr.ib(type=str, default="")
+
+
+class SubmitResource(AsyncResource):
+    """Registers the user with the submitted username
+
+    Each session registers at most one user. Submissions for a session which arrive
+    while another is in progress (such as when the form is submitted twice) wait for
+    it and share its outcome, and sessions are taken from the store while they are
+    being used, so that other workers cannot use them at the same time. Sessions
+    which are used to register a user are remembered for a little while, so that
+    late duplicate submissions log the user in rather than failing. If the remote
+    user has been registered in another session, they are logged in as that user.
+    """
+
+    def __init__(
+        self,
+        module_api: synapse.module_api.ModuleApi,
+        availability_checker: UsernameAvailabilityChecker,
+        rate_limiter: RequestRateLimiter,
+        page: PickerPageTemplate,
+        localpart_validator: LocalpartValidator,
+    ):
+        super().__init__()
+        self._module_api = module_api
+        self._availability_checker = availability_checker
+        self._rate_limiter = rate_limiter
+        self._page = page
+        self._localpart_validator = localpart_validator
+        self._submissions: SingleFlight[str, _SubmitOutcome] = SingleFlight()
+        self._completed_submissions: TTLCache[str, _SubmitOutcome] = TTLCache(
+            COMPLETED_SUBMISSIONS_CACHE_SIZE, COMPLETED_SUBMISSIONS_CACHE_TTL
+        )
+
+    @time_async(submit_duration)
+    @_wrap_for_html_exceptions
+    async def async_render_POST(self, request: Request):
+        session_id = request.getCookie(SESSION_COOKIE_NAME)
+        if not session_id:
+            _return_html_error(400, "missing session_id", request)
+            return
+
+        session_id = session_id.decode("ascii", errors="replace")
+        retry_after = self._rate_limiter.try_acquire(
+            _get_client_ip(request), session_id
+        )
+        if retry_after:
+            rate_limited_requests.labels("submit").inc()
+            _set_retry_after(request, retry_after)
+            _return_html_error(429, "Too many requests", request)
+            return
 
         if b"username" not in request.args:
             _return_html_error(400, "missing username", request)
             return
         localpart = request.args[b"username"][0].decode("utf-8", errors="replace")
-        logger.info("Registering username %s", localpart)
+
+        outcome = await self._submissions.run(
+            session_id, lambda: self._submit(session_id, localpart)
+        )
+
+        session = outcome.session
+        if session is None:
+            _return_html_error(403, "Unknown session", request)
+            return
+
+        if outcome.user_id is None:
+            await self._render_error(
+                outcome.error_code, outcome.error, session, request, outcome.username
+            )
+            return
+
+        _delete_cookie(request, SESSION_COOKIE_NAME)
+        with submit_step_duration.labels("complete_sso_login").time():
+            await self._module_api.complete_sso_login_async(
+                outcome.user_id, request, session.client_redirect_url,
+            )
+
+    async def _submit(self, session_id: str, localpart: str) -> _SubmitOutcome:
+        """Try to register the username for the session
+
+        Only one call for each session runs at a time.
+        """
+        completed = self._completed_submissions.get(session_id)
+        if completed is not None:
+            logger.info(
+                "Session ID %s has already registered %s", session_id, completed.user_id
+            )
+            return completed
+
+        session = await take_mapping_session(session_id)
+        if session is None:
+            logger.info("Session ID %s not found", session_id)
+            return _SubmitOutcome(session=None)
+
+        # if the username is not accepted, the session is put back, so that the user
+        # can go round and have another go.
+        outcome = None
         try:
-            registered_user_id = await self._module_api.register_user(
-                localpart=localpart, displayname=localpart
+            outcome = await self._register(session, localpart)
+        finally:
+            if outcome is None or outcome.user_id is None:
+                await restore_mapping_session(session_id, session)
+
+        if outcome.user_id is not None:
+            self._completed_submissions.set(session_id, outcome)
+        return outcome
+
+    async def _register(
+        self, session: UsernameMappingSession, localpart: str
+    ) -> _SubmitOutcome:
+        # the user may have registered in another session since this one was
+        # created, in which case they are logged in as that user instead
+        with submit_step_duration.labels("lookup_external_id").time():
+            user_id = await lookup_external_id(self._module_api, session.remote_user_id)
+        if user_id is not None:
+            logger.info(
+                "Remote user %s is already registered as %s",
+                session.remote_user_id,
+                user_id,
+            )
+            return _SubmitOutcome(session, user_id=user_id)
+
+        rejection = self._localpart_validator.check(localpart)
+        if rejection is not None:
+            logger.info("Username %s is not allowed: %s", localpart, rejection.reason)
+            rejected_localparts.labels(rejection.reason).inc()
+            return _SubmitOutcome(
+                session, error_code=400, error=rejection.message, username=localpart
+            )
+
+        # usernames which are known to be taken are rejected without trying to
+        # register them. register_user checks again, atomically.
+        with submit_step_duration.labels("check_availability").time():
+            available = await self._availability_checker.is_available(localpart)
+        if not available:
+            logger.info("Username %s is not available", localpart)
+            return _SubmitOutcome(
+                session,
+                error_code=409,
+                error="This username is not available, please choose another.",
+                username=localpart,
             )
+
+        try:
+            with submit_step_duration.labels("register_user").time():
+                registered_user_id = await self._module_api.register_user(
+                    localpart=localpart, displayname=localpart
+                )
         except SynapseError as e:
             logger.warning("Error during registration: %s", e)
-            _return_html_error(e.code, e.msg, request)
-            return
+            return _SubmitOutcome(
+                session, error_code=e.code, error=e.msg, username=localpart
+            )
 
-        await self._module_api.record_user_external_id(
-            "saml", session.remote_user_id, registered_user_id
-        )
+        self._availability_checker.mark_unavailable(registered_user_id)
 
-        del username_mapping_sessions[session_id]
+        with submit_step_duration.labels("record_user_external_id").time():
+            await self._module_api.record_user_external_id(
+                SAML_AUTH_PROVIDER_ID, session.remote_user_id, registered_user_id
+            )
+        if not record_audit_event(
+            UserRegistered(session.remote_user_id, registered_user_id)
+        ):
+            logger.info(
+                "Registered %s for remote user %s",
+                registered_user_id,
+                session.remote_user_id,
+            )
 
-        # delete the cookie
-        request.addCookie(
-            SESSION_COOKIE_NAME,
-            b"",
-            expires=b"Thu, 01 Jan 1970 00:00:00 GMT",
-            path=b"/",
+        return _SubmitOutcome(session, user_id=registered_user_id)
+
+    async def _render_error(
+        self,
+        code: int,
+        error: str,
+        session: UsernameMappingSession,
+        request: Request,
+        username: str = "",
+    ):
+        """Renders the picker page again, explaining why the username was rejected"""
+        suggestions = await _suggest_usernames(
+            self._availability_checker, session, PAGE_SUGGESTIONS
         )
-
-        await self._module_api.complete_sso_login_async(
-            registered_user_id,
-            request,
-            session.client_redirect_url,
+        body = self._page.render(
+            username=username, error=error, suggestions=suggestions
         )
+        _return_html(code, body, request)
 
 
 class AvailabilityCheckResource(AsyncResource):
-    def __init__(self, module_api: synapse.module_api.ModuleApi):
+    """Checks if a username is available
+
+    Returns `{"available": true}` or `{"available": false}`. Usernames which break
+    the username rules are not available, and the response explains why in
+    `error`.
+    """
+
+    def __init__(
+        self,
+        module_api: synapse.module_api.ModuleApi,
+        availability_checker: UsernameAvailabilityChecker,
+        rate_limiter: RequestRateLimiter,
+        localpart_validator: LocalpartValidator,
+    ):
         super().__init__()
         self._module_api = module_api
+        self._availability_checker = availability_checker
+        self._rate_limiter = rate_limiter
+        self._localpart_validator = localpart_validator
 
+    @time_async(check_duration)
     @_wrap_for_text_exceptions
     async def async_render_GET(self, request: Request):
         # make sure that there is a valid mapping session, to stop people dictionary-
@@ -201,7 +650,16 @@ class AvailabilityCheckResource(AsyncResource):
             return
 
         session_id = session_id.decode("ascii", errors="replace")
-        session = get_mapping_session(session_id)
+        retry_after = self._rate_limiter.try_acquire(
+            _get_client_ip(request), session_id
+        )
+        if retry_after:
+            rate_limited_requests.labels("check").inc()
+            _set_retry_after(request, retry_after)
+            _return_json({"error": "too many requests"}, request, code=429)
+            return
+
+        session = await get_mapping_session(session_id)
         if not session:
             logger.info("Couldn't find session id %s", session_id)
             _return_json({"error": "unknown session"}, request)
@@ -211,20 +669,131 @@ class AvailabilityCheckResource(AsyncResource):
             _return_json({"error": "missing username"}, request)
             return
         localpart = request.args[b"username"][0].decode("utf-8", errors="replace")
-        logger.info("Checking for availability of username %s", localpart)
+        rejection = self._localpart_validator.check(localpart)
+        if rejection is not None:
+            rejected_localparts.labels(rejection.reason).inc()
+            record_audit_event(
+                UsernameChecked(session.remote_user_id, localpart, False)
+            )
+            _return_json({"available": False, "error": rejection.message}, request)
+            return
+
         try:
-            user_id = self._module_api.get_qualified_user_id(localpart)
-            registered_id = await self._module_api.check_user_exists(user_id)
-            available = registered_id is None
+            available = await self._availability_checker.is_available(localpart)
         except Exception as e:
             logger.warning(
-                "Error checking for availability of %s: %s %s" % (localpart, type(e), e)
+                "Error checking for availability of %s: %s %s", localpart, type(e), e
             )
             available = False
+        if not record_audit_event(
+            UsernameChecked(session.remote_user_id, localpart, available)
+        ):
+            logger.info("Username %s is available: %s", localpart, available)
         response = {"available": available}
         _return_json(response, request)
 
 
+# the maximum number of usernames which can be checked in one /check_batch request
+MAX_BATCH_CHECK_USERNAMES = 20
+
+# the maximum number of suggestions which can be requested from /check_batch
+MAX_SUGGESTIONS = 10
+
+
+class BatchAvailabilityCheckResource(AsyncResource):
+    """Checks several usernames at once, and suggests free usernames
+
+    Takes any number of `username` query parameters, and an optional `suggestions`
+    parameter giving the number of free usernames to suggest. The usernames and the
+    suggestion candidates are checked with a single database query. Returns:
+
+        {"available": {"<username>": true, ...}, "suggestions": ["jane.doe", ...]}
+    """
+
+    def __init__(
+        self,
+        module_api: synapse.module_api.ModuleApi,
+        availability_checker: UsernameAvailabilityChecker,
+        rate_limiter: RequestRateLimiter,
+    ):
+        super().__init__()
+        self._module_api = module_api
+        self._availability_checker = availability_checker
+        self._rate_limiter = rate_limiter
+
+    @time_async(check_batch_duration)
+    @_wrap_for_text_exceptions
+    async def async_render_GET(self, request: Request):
+        # as for /check, require a valid mapping session
+        session_id = request.getCookie(SESSION_COOKIE_NAME)
+        if not session_id:
+            _return_json({"error": "missing session_id"}, request)
+            return
+
+        session_id = session_id.decode("ascii", errors="replace")
+        retry_after = self._rate_limiter.try_acquire(
+            _get_client_ip(request), session_id
+        )
+        if retry_after:
+            rate_limited_requests.labels("check_batch").inc()
+            _set_retry_after(request, retry_after)
+            _return_json({"error": "too many requests"}, request, code=429)
+            return
+
+        session = await get_mapping_session(session_id)
+        if not session:
+            logger.info("Couldn't find session id %s", session_id)
+            _return_json({"error": "unknown session"}, request)
+            return
+
+        localparts = [
+            arg.decode("utf-8", errors="replace")
+            for arg in request.args.get(b"username", [])
+        ]
+        if len(localparts) > MAX_BATCH_CHECK_USERNAMES:
+            _return_json({"error": "too many usernames"}, request)
+            return
+
+        try:
+            suggestion_count = int(request.args.get(b"suggestions", [b"0"])[0])
+        except ValueError:
+            _return_json({"error": "invalid suggestions"}, request)
+            return
+        suggestion_count = max(0, min(suggestion_count, MAX_SUGGESTIONS))
+
+        # check more candidates than we need, in case some of them are taken
+        candidates: List[str] = []
+        if suggestion_count:
+            candidates = suggest_localparts(
+                session.displayname, session.remote_user_id, suggestion_count * 3
+            )
+
+        try:
+            results = await self._availability_checker.check_many(
+                localparts + candidates
+            )
+        except Exception as e:
+            logger.warning(
+                "Error checking for availability of %s: %s %s", localparts, type(e), e
+            )
+            results = {}
+
+        available = {lp: results.get(lp, False) for lp in localparts}
+        audited = False
+        for localpart, is_available in available.items():
+            audited = record_audit_event(
+                UsernameChecked(session.remote_user_id, localpart, is_available)
+            )
+        if not audited:
+            logger.info("Usernames available: %s", available)
+        suggestions = [c for c in candidates if results.get(c, False)]
+        response = {
+            "available": available,
+            "suggestions": suggestions[:suggestion_count],
+        }
+        _return_json(response, request)
+
+
 def _add_login_token_to_redirect_url(url, token):
     url_parts = list(urllib.parse.urlparse(url))
     query = dict(urllib.parse.parse_qsl(url_parts[4]))
@@ -233,12 +802,51 @@ def _add_login_token_to_redirect_url(url, token):
     return urllib.parse.urlunparse(url_parts)
 
 
+async def _suggest_usernames(
+    availability_checker: UsernameAvailabilityChecker,
+    session: UsernameMappingSession,
+    count: int,
+) -> List[str]:
+    """Suggest available usernames for the session's user
+
+    Failures are logged rather than raised, since the suggestions are optional.
+    """
+    try:
+        return await availability_checker.suggest_available(
+            session.displayname, session.remote_user_id, count
+        )
+    except Exception as e:
+        logger.warning(
+            "Error suggesting usernames for %s: %s %s",
+            session.remote_user_id,
+            type(e),
+            e,
+        )
+        return []
+
+
 def _return_html_error(code: int, msg: str, request: Request):
     """Sends an HTML error page"""
     body = HTML_ERROR_TEMPLATE.format(code=code, msg=html.escape(msg)).encode("utf-8")
+    _return_html(code, body, request)
+
+
+def _return_html(code: int, body: bytes, request: Request):
+    """Sends an HTML page, which is not to be cached
+
+    Since the picker page inlines its stylesheet and script, it is gzipped for
+    clients which accept that, if it comes out smaller.
+    """
     request.setResponseCode(code)
     request.setHeader(b"Content-Type", b"text/html; charset=utf-8")
+    request.setHeader(b"Vary", b"Accept-Encoding")
+    if b"gzip" in accepted_encodings(request):
+        compressed = gzip.compress(body, compresslevel=HTML_GZIP_LEVEL)
+        if len(compressed) < len(body):
+            request.setHeader(b"Content-Encoding", b"gzip")
+            body = compressed
     request.setHeader(b"Content-Length", b"%i" % (len(body),))
+    request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
     request.write(body)
     try:
         request.finish()
@@ -246,9 +854,27 @@ def _return_html_error(code: int, msg: str, request: Request):
         logger.info("Connection disconnected before response was written: %r", e)
 
 
-def _return_json(json_obj: Any, request: Request):
+def _delete_cookie(request: Request, name: bytes):
+    request.addCookie(
+        name, b"", expires=b"Thu, 01 Jan 1970 00:00:00 GMT", path=b"/",
+    )
+
+
+def _get_client_ip(request: Request) -> str:
+    """Returns the IP address of the client, as reported by Synapse"""
+    address = request.getClientAddress()
+    return getattr(address, "host", str(address))
+
+
+def _set_retry_after(request: Request, retry_after: float):
+    """Tells the client how long to wait before retrying, in whole seconds"""
+    request.setHeader(b"Retry-After", b"%i" % (math.ceil(retry_after),))
+
+
+def _return_json(json_obj: Any, request: Request, code: int = 200):
     json_bytes = json.dumps(json_obj).encode("utf-8")
 
+    request.setResponseCode(code)
     request.setHeader(b"Content-Type", b"application/json")
     request.setHeader(b"Content-Length", b"%d" % (len(json_bytes),))
     request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
@@ -43,10 +43,24 @@ setup(
     name="matrix-synapse-saml-mozilla",
     packages=["matrix_synapse_saml_mozilla"],
     include_package_data=True,
+    # the templates and static assets are read from the package directory
+    zip_safe=False,
     description="An Mozilla-flavoured SAML MXID mapper for Synapse",
     use_scm_version=True,
     setup_requires=["setuptools_scm"],
-    install_requires=["attr>=0.3.1", "pysaml2>=4.5.0"],
+    install_requires=[
+        "attr>=0.3.1",
+        "pysaml2>=4.5.0",
+        'importlib_metadata; python_version < "3.8"',
+    ],
+    extras_require={"redis": ["redis>=3.0"]},
+    entry_points={
+        "console_scripts": [
+            "compile_saml_block_list = "
+            "matrix_synapse_saml_mozilla.compile_block_list:main",
+            "provision_saml_users = matrix_synapse_saml_mozilla.provision_users:main",
+        ]
+    },
     long_description=read_file(("README.md",)),
     long_description_content_type="text/markdown",
     classifiers=[
@@ -24,7 +24,7 @@ from saml2.sigver import CryptoBackend, SecurityContext
 
 from synapse.api.errors import CodeMessageException, RedirectException
 
-from matrix_synapse_saml_mozilla._sessions import username_mapping_sessions
+from matrix_synapse_saml_mozilla._sessions import get_session_store
 from matrix_synapse_saml_mozilla.mapping_provider import SamlConfig, SamlMappingProvider
 
 from . import create_mapping_provider
@@ -33,7 +33,9 @@ from . import create_mapping_provider
 class FakeResponse:
     def __init__(self, source_uid, display_name):
         self.ava = {
-            "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/nameidentifier": [source_uid],
+            "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/nameidentifier": [
+                source_uid
+            ],
             "email": [],
         }
 
@@ -86,16 +88,14 @@ class SamlUserAttributeTestCase(unittest.TestCase):
         self.assertEqual(cm.exception.location, b"/_matrix/saml2/pick_username/")
 
         cookieheader = cm.exception.cookies[0]
-        regex = re.compile(b"^username_mapping_session=([a-zA-Z]+);")
+        regex = re.compile(b"^username_mapping_session=([A-Za-z0-9_-]+);")
         m = regex.search(cookieheader)
         if not m:
             self.fail("cookie header %s does not match %s" % (cookieheader, regex))
 
         session_id = m.group(1).decode("ascii")
-        self.assertIn(
-            session_id, username_mapping_sessions, "session id not found in map"
-        )
-        session = username_mapping_sessions[session_id]
+        self.assertIn(session_id, get_session_store(), "session id not found in map")
+        session = get_session_store()[session_id]
         self.assertEqual(session.remote_user_id, 123435)
         self.assertEqual(session.displayname, "Jonny")
         self.assertEqual(session.client_redirect_url, "http://client/")
@@ -116,3 +116,77 @@ class SamlUserAttributeTestCase(unittest.TestCase):
             provider.saml_response_to_user_attributes(resp, 0, "http://client/")
 
         self.assertEqual(e.exception.code, 403)
+
+    def test_attribute_mapping(self):
+        provider = create_mapping_provider(
+            {
+                "use_name_id_for_remote_uid": False,
+                "bad_domain_list": ["other.com"],
+                "attribute_mapping": {
+                    "remote_user_id": "uid",
+                    "email": ["urn:oid:0.9.2342.19200300.100.1.3", "mail"],
+                    "displayname": "cn",
+                },
+            }
+        )
+        response = FakeResponse(123435, "Jonny")
+        response.ava = {
+            "uid": ["remote"],
+            "mail": ["jonny@example.org"],
+            "urn:oid:0.9.2342.19200300.100.1.3": ["jonny@example.com"],
+            "cn": ["Jonny Mapped"],
+        }
+
+        with self.assertRaises(RedirectException) as cm:
+            provider.saml_response_to_user_attributes(response, 0, "http://client/")
+        session_id = cm.exception.cookies[0].split(b";")[0].split(b"=")[1]
+        session = get_session_store()[session_id.decode("ascii")]
+        self.assertEqual(session.remote_user_id, "remote")
+        self.assertEqual(session.displayname, "Jonny Mapped")
+
+        # an email in any of the email attributes is checked, not only the first
+        response.ava["mail"] = ["jonny@other.com"]
+        with self.assertRaises(CodeMessageException) as e:
+            provider.saml_response_to_user_attributes(response, 0, "http://client/")
+        self.assertEqual(e.exception.code, 403)
+
+    def test_missing_email(self):
+        provider = create_mapping_provider({"use_name_id_for_remote_uid": False})
+        response = FakeResponse(123435, "Jonny")
+        del response.ava["email"]
+
+        with self.assertRaises(CodeMessageException) as e:
+            provider.saml_response_to_user_attributes(response, 0, "http://client/")
+        self.assertEqual(e.exception.code, 400)
+
+
+class GetSamlAttributesTestCase(unittest.TestCase):
+    def test_defaults(self):
+        config = SamlMappingProvider.parse_config({})
+        required, optional = SamlMappingProvider.get_saml_attributes(config)
+        self.assertEqual(required, {"email"})
+        self.assertIn("displayName", optional)
+
+    def test_remote_user_id_from_attribute(self):
+        config = SamlMappingProvider.parse_config({"use_name_id_for_remote_uid": False})
+        required, optional = SamlMappingProvider.get_saml_attributes(config)
+        self.assertEqual(
+            required,
+            {
+                "email",
+                "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/nameidentifier",
+            },
+        )
+        self.assertEqual(optional, {"displayName"})
+
+    def test_alternative_names_are_optional(self):
+        config = SamlMappingProvider.parse_config(
+            {"attribute_mapping": {"email": ["mail", "email"], "displayname": "cn"}}
+        )
+        required, optional = SamlMappingProvider.get_saml_attributes(config)
+        self.assertEqual(required, set())
+        self.assertTrue({"mail", "email", "cn"} <= optional)
+
+    def test_unknown_mapping(self):
+        with self.assertRaises(Exception):
+            SamlMappingProvider.parse_config({"attribute_mapping": {"phone": "tel"}})
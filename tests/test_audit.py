@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from twisted.internet.task import Clock
+
+from matrix_synapse_saml_mozilla._audit import (
+    AuditLog,
+    AuditSink,
+    DomainBlocked,
+    JsonlAuditSink,
+    SessionCreated,
+    SessionsExpired,
+    parse_audit_log_config,
+    set_audit_log,
+)
+from matrix_synapse_saml_mozilla._executor import Executor
+from matrix_synapse_saml_mozilla._metrics import audit_events_dropped
+from matrix_synapse_saml_mozilla._sessions import expire_old_sessions
+from matrix_synapse_saml_mozilla.mapping_provider import SamlConfig, SamlMappingProvider
+
+from .test_attributes import FakeResponse
+from .test_session_stores import PausedExecutor
+from .test_username_picker import FakeRequest, PickUsernameTestBase
+
+
+class ListAuditSink(AuditSink):
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+        self.fail = False
+
+    def write(self, events):
+        if self.fail:
+            raise Exception("sink is broken")
+        self.batches.append(list(events))
+
+    def close(self):
+        self.closed = True
+
+    @property
+    def events(self):
+        return [event for batch in self.batches for event in batch]
+
+
+def _dropped(reason):
+    return audit_events_dropped.labels(reason)._value.get()
+
+
+class AuditLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sink = ListAuditSink()
+        self.clock = Clock()
+        self.audit_log = self._open(Executor(pool_size=0))
+
+    def _open(self, executor):
+        audit_log = AuditLog(
+            self.sink,
+            max_queue_size=5,
+            batch_size=3,
+            flush_interval=1,
+            clock=self.clock,
+            executor=executor,
+        )
+        self.addCleanup(audit_log.close)
+        return audit_log
+
+    def test_flushes_periodically(self):
+        self.audit_log.record(SessionCreated("remote1"))
+        self.audit_log.record(SessionCreated("remote2"))
+        self.assertEqual(self.sink.batches, [])
+        self.assertEqual(len(self.audit_log), 2)
+
+        self.clock.advance(1)
+        self.assertEqual(
+            [e.remote_user_id for e in self.sink.events], ["remote1", "remote2"]
+        )
+        self.assertEqual(len(self.audit_log), 0)
+
+    def test_flushes_full_batch_early(self):
+        for i in range(3):
+            self.audit_log.record(SessionCreated("remote%i" % (i,)))
+        self.assertEqual(len(self.sink.batches), 1)
+        self.assertEqual(len(self.sink.batches[0]), 3)
+
+    def test_drops_events_when_queue_is_full(self):
+        executor = PausedExecutor()
+        audit_log = self._open(executor)
+
+        # the first batch is being written, and the sink is slow
+        dropped = _dropped("queue_full")
+        for i in range(10):
+            audit_log.record(SessionCreated("remote%i" % (i,)))
+        self.assertEqual(len(audit_log), 5)
+        self.assertEqual(_dropped("queue_full") - dropped, 2)
+
+        # once it has written the first batch, it carries on with the next
+        executor.release()
+        self.assertEqual(len(self.sink.events), 3)
+        self.assertEqual(len(audit_log), 2)
+
+    def test_sink_errors_are_counted(self):
+        self.sink.fail = True
+        dropped = _dropped("sink_error")
+        self.audit_log.record(SessionCreated("remote"))
+        with self.assertLogs("matrix_synapse_saml_mozilla._audit", "ERROR"):
+            self.clock.advance(1)
+        self.assertEqual(_dropped("sink_error") - dropped, 1)
+
+        # later batches are still written
+        self.sink.fail = False
+        self.audit_log.record(SessionCreated("remote"))
+        self.clock.advance(1)
+        self.assertEqual(len(self.sink.events), 1)
+
+    def test_close_writes_queued_events(self):
+        for i in range(5):
+            self.audit_log.record(SessionCreated("remote%i" % (i,)))
+        self.audit_log.close()
+        self.assertEqual(len(self.sink.events), 5)
+        self.assertTrue(self.sink.closed)
+
+
+class JsonlAuditSinkTestCase(unittest.TestCase):
+    def test_appends_json_lines(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        path = os.path.join(tempdir.name, "audit.jsonl")
+
+        sink = JsonlAuditSink(path)
+        sink.write([DomainBlocked("remote", "a@b.com", "blocked_domain", time_ms=1)])
+        sink.close()
+        sink = JsonlAuditSink(path)
+        sink.write([SessionsExpired(2, time_ms=2)])
+        sink.close()
+
+        with open(path) as fh:
+            lines = [json.loads(line) for line in fh]
+        self.assertEqual(
+            lines,
+            [
+                {
+                    "type": "domain_blocked",
+                    "time_ms": 1,
+                    "remote_user_id": "remote",
+                    "email": "a@b.com",
+                    "reason": "blocked_domain",
+                },
+                {"type": "session_expired", "time_ms": 2, "count": 2},
+            ],
+        )
+
+
+class ParseAuditLogConfigTestCase(unittest.TestCase):
+    def test_jsonl_requires_path(self):
+        with self.assertRaises(Exception):
+            parse_audit_log_config({"type": "jsonl"})
+        config = parse_audit_log_config({"path": "/tmp/audit.jsonl"})
+        self.assertEqual(config.type, "jsonl")
+
+    def test_class_sink(self):
+        config = parse_audit_log_config(
+            {"type": "class", "class": "tests.test_audit.ListAuditSink"}
+        )
+        self.assertEqual(config.sink_class, "tests.test_audit.ListAuditSink")
+        with self.assertRaises(Exception):
+            parse_audit_log_config({"type": "class"})
+
+    def test_unknown_type(self):
+        with self.assertRaises(Exception):
+            parse_audit_log_config({"type": "syslog"})
+
+
+class AuditEventsTestCase(PickUsernameTestBase):
+    def setUp(self):
+        super().setUp()
+        self.sink = ListAuditSink()
+        self.audit_log = AuditLog(
+            self.sink, clock=Clock(), executor=Executor(pool_size=0)
+        )
+        set_audit_log(self.audit_log)
+        self.addCleanup(set_audit_log, None)
+
+    def _events(self):
+        self.audit_log.close()
+        return [
+            {k: v for k, v in event.to_dict().items() if k != "time_ms"}
+            for event in self.sink.events
+        ]
+
+    def test_check_and_register(self):
+        request = FakeRequest([b"check"], self.session_id)
+        request.args = {b"username": [b"bobby"]}
+        self._render(request)
+        self._submit("bobby")
+
+        self.assertEqual(
+            self._events(),
+            [
+                {
+                    "type": "username_checked",
+                    "remote_user_id": "remote",
+                    "username": "bobby",
+                    "available": True,
+                },
+                {
+                    "type": "user_registered",
+                    "remote_user_id": "remote",
+                    "user_id": "@bobby:test",
+                },
+            ],
+        )
+
+    def test_audited_decisions_are_not_logged(self):
+        request = FakeRequest([b"check"], self.session_id)
+        request.args = {b"username": [b"bobby"]}
+        with mock.patch("matrix_synapse_saml_mozilla.username_picker.logger") as logger:
+            self._render(request)
+        logger.info.assert_not_called()
+
+        # without an audit log, the decision is logged instead
+        set_audit_log(None)
+        request = FakeRequest([b"check"], self.session_id)
+        request.args = {b"username": [b"bobby"]}
+        with self.assertLogs("matrix_synapse_saml_mozilla.username_picker", "INFO"):
+            self._render(request)
+
+    def test_saml_responses(self):
+        provider = SamlMappingProvider(
+            SamlConfig(
+                use_name_id_for_remote_uid=False, domain_block_list=["blocked.com"]
+            ),
+            None,
+        )
+        for remote_user_id, email in (
+            ("blocked", "jane@blocked.com"),
+            ("allowed", "jane@allowed.com"),
+        ):
+            response = FakeResponse(remote_user_id, "Jane Doe")
+            response.ava["email"] = [email]
+            with self.assertRaises(Exception):
+                provider.saml_response_to_user_attributes(
+                    response, 0, "https://client/"
+                )
+
+        self.assertEqual(
+            self._events(),
+            [
+                {
+                    "type": "domain_blocked",
+                    "remote_user_id": "blocked",
+                    "email": "jane@blocked.com",
+                    "reason": "blocked_domain",
+                },
+                {"type": "session_created", "remote_user_id": "allowed"},
+            ],
+        )
+
+    def test_expired_sessions(self):
+        self.store.expire = lambda now_ms: 3
+        with mock.patch("matrix_synapse_saml_mozilla._sessions.logger") as logger:
+            expire_old_sessions()
+        logger.info.assert_not_called()
+        self.assertEqual(self._events(), [{"type": "session_expired", "count": 3}])
+
+        # without an audit log, the expiry is logged instead
+        set_audit_log(None)
+        with self.assertLogs("matrix_synapse_saml_mozilla._sessions", "INFO"):
+            expire_old_sessions()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import unittest
+
+from twisted.internet import defer
+
+from matrix_synapse_saml_mozilla._availability import UsernameAvailabilityChecker
+from matrix_synapse_saml_mozilla._cache import TTLCache
+from matrix_synapse_saml_mozilla._localpart_rules import LocalpartValidator
+from matrix_synapse_saml_mozilla._suggestions import suggest_localparts
+
+
+class FakeModuleApi:
+    """Implements the parts of ModuleApi used for checking availability, on top of
+    an SQLite users table"""
+
+    def __init__(self, registered):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE users (name TEXT)")
+        self.db.executemany("INSERT INTO users VALUES (?)", [(u,) for u in registered])
+        self.db_interactions = 0
+
+    def get_qualified_user_id(self, localpart):
+        return "@%s:test" % (localpart,)
+
+    def check_user_exists(self, user_id):
+        row = self.db.execute(
+            "SELECT name FROM users WHERE LOWER(name) = ?", (user_id.lower(),)
+        ).fetchone()
+        return defer.succeed(row[0] if row else None)
+
+    def run_db_interaction(self, desc, func, *args):
+        self.db_interactions += 1
+        return defer.succeed(func(self.db.cursor(), *args))
+
+
+class UsernameAvailabilityCheckerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.module_api = FakeModuleApi(["@alex:test", "@Admin:test"])
+        self.checker = UsernameAvailabilityChecker(
+            self.module_api, TTLCache(max_size=100, ttl=60)
+        )
+
+    def _run(self, coro):
+        results = []
+        defer.ensureDeferred(coro).addBoth(results.append)
+        return results[0]
+
+    def test_is_available(self):
+        self.assertFalse(self._run(self.checker.is_available("alex")))
+        self.assertTrue(self._run(self.checker.is_available("jane")))
+
+    def test_check_many_uses_one_query(self):
+        results = self._run(self.checker.check_many(["alex", "admin", "jane"]))
+        self.assertEqual(results, {"alex": False, "admin": False, "jane": True})
+        self.assertEqual(self.module_api.db_interactions, 1)
+
+        # the taken usernames are now cached, so only "jane" needs checking again
+        self._run(self.checker.check_many(["alex", "admin", "jane"]))
+        self.assertEqual(self.module_api.db_interactions, 2)
+
+        self._run(self.checker.check_many(["alex", "admin"]))
+        self.assertEqual(self.module_api.db_interactions, 2)
+
+    def test_invalid_usernames_skip_database(self):
+        checker = UsernameAvailabilityChecker(
+            self.module_api,
+            TTLCache(max_size=100, ttl=60),
+            LocalpartValidator(reserved=["root"]),
+        )
+        self.assertFalse(self._run(checker.is_available("root")))
+        results = self._run(checker.check_many(["root", "Jane", "jane"]))
+        self.assertEqual(results, {"root": False, "Jane": False, "jane": True})
+        self.assertEqual(self.module_api.db_interactions, 1)
+
+
+class SuggestLocalpartsTestCase(unittest.TestCase):
+    def test_from_displayname(self):
+        self.assertEqual(
+            suggest_localparts("Jane Doe", count=7),
+            [
+                "jane.doe",
+                "janedoe",
+                "jane_doe",
+                "jdoe",
+                "jane",
+                "jane.doe2",
+                "jane.doe3",
+            ],
+        )
+
+    def test_strips_accents_and_punctuation(self):
+        self.assertEqual(suggest_localparts("Zoë O'Brien!", count=1), ["zoe.obrien"])
+
+    def test_falls_back_to_remote_user_id(self):
+        self.assertEqual(
+            suggest_localparts(None, "jdoe@example.com", count=2), ["jdoe", "jdoe2"]
+        )
+
+    def test_no_usable_name(self):
+        self.assertEqual(suggest_localparts("李", None), [])
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from matrix_synapse_saml_mozilla._block_list_reloader import (
+    DomainBlockListReloader,
+    stat_block_file,
+)
+from matrix_synapse_saml_mozilla.mapping_provider import (
+    SamlMappingProvider,
+    build_domain_block_list,
+)
+
+
+class DomainBlockListReloaderTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = os.path.join(tempdir.name, "domains.txt")
+        self._write("example.com\n")
+
+        self.block_list = build_domain_block_list(["inline.com"], self.path)
+        self.clock = Clock()
+        self.reloader = DomainBlockListReloader(
+            self.path,
+            build=lambda: build_domain_block_list(["inline.com"], self.path),
+            on_reload=self._on_reload,
+            interval=10,
+            clock=self.clock,
+            run_in_thread=defer.maybeDeferred,
+        )
+        self.reloader.start()
+        self.addCleanup(self.reloader.stop)
+
+    def _write(self, contents: str):
+        with open(self.path, "w") as fh:
+            fh.write(contents)
+
+    def _on_reload(self, block_list):
+        self.block_list = block_list
+
+    def test_reload_on_change(self):
+        self.assertIn("example.com", self.block_list)
+
+        self._write("example.com\nexample.org\n")
+        self.clock.advance(10)
+
+        self.assertIn("example.org", self.block_list)
+        self.assertIn("inline.com", self.block_list)
+
+    def test_no_reload_without_change(self):
+        old_block_list = self.block_list
+        self.clock.advance(10)
+        self.assertIs(self.block_list, old_block_list)
+
+    def test_keeps_old_list_on_failure(self):
+        old_block_list = self.block_list
+        with open(self.path, "wb") as fh:
+            fh.write(b"\xff\xfe not ascii\n")
+        self.clock.advance(10)
+        self.assertIs(self.block_list, old_block_list)
+
+    def test_reload_on_change_during_initial_load(self):
+        # the file changes after it was statted but before the reloader is built
+        last_stat = stat_block_file(self.path)
+        block_list = build_domain_block_list([], self.path)
+        self._write("example.com\nexample.net\n")
+
+        reloaded = []
+        reloader = DomainBlockListReloader(
+            self.path,
+            build=lambda: build_domain_block_list([], self.path),
+            on_reload=reloaded.append,
+            interval=10,
+            clock=self.clock,
+            run_in_thread=defer.maybeDeferred,
+            last_stat=last_stat,
+        )
+        reloader.start()
+        self.addCleanup(reloader.stop)
+        self.assertNotIn("example.net", block_list)
+
+        self.clock.advance(10)
+        self.assertEqual(len(reloaded), 1)
+        self.assertIn("example.net", reloaded[0])
+
+
+class ReloadIntervalConfigTestCase(unittest.TestCase):
+    def test_default(self):
+        config = SamlMappingProvider.parse_config({})
+        self.assertIsNone(config.bad_domain_file_reload_interval)
+
+    def test_valid(self):
+        config = SamlMappingProvider.parse_config(
+            {"bad_domain_file_reload_interval": 0.5}
+        )
+        self.assertEqual(config.bad_domain_file_reload_interval, 0.5)
+
+    def test_rejects_invalid(self):
+        for value in (0, -10, "60", True):
+            with self.assertRaises(Exception, msg=repr(value)):
+                SamlMappingProvider.parse_config(
+                    {"bad_domain_file_reload_interval": value}
+                )
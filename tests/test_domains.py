@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from matrix_synapse_saml_mozilla._domains import (
+    CompiledDomainBlockList,
+    DomainBlockList,
+    is_compiled_block_list,
+    load_domain_block_file,
+)
+from matrix_synapse_saml_mozilla.compile_block_list import main as compile_main
+
+
+class DomainBlockListTestCase(unittest.TestCase):
+    def test_domain_rule(self):
+        block_list = DomainBlockList(["Example.com"])
+        self.assertIn("example.com", block_list)
+        self.assertIn("EXAMPLE.COM", block_list)
+        self.assertIn("mail.example.com", block_list)
+        self.assertIn("a.b.example.com", block_list)
+        self.assertNotIn("notexample.com", block_list)
+        self.assertNotIn("example.com.au", block_list)
+        self.assertNotIn("com", block_list)
+
+    def test_wildcard_rule(self):
+        block_list = DomainBlockList(["*.example.com"])
+        self.assertIn("mail.example.com", block_list)
+        self.assertIn("a.b.example.com", block_list)
+        self.assertNotIn("example.com", block_list)
+
+    def test_ignores_blank_lines_and_comments(self):
+        block_list = DomainBlockList(["example.com\n", "\n", "# a comment\n"])
+        self.assertEqual(len(block_list), 1)
+        self.assertNotIn("", block_list)
+
+
+class CompiledBlockListTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.text_path = os.path.join(tempdir.name, "domains.txt")
+        self.compiled_path = os.path.join(tempdir.name, "domains.bin")
+
+        with open(self.text_path, "w") as fh:
+            fh.write("b.com\na.com\nB.com\n*.wild.net\n\n# comment\nc.org\n")
+
+    def test_compile_and_load(self):
+        self.assertEqual(compile_main([self.text_path, self.compiled_path]), 0)
+        self.assertTrue(is_compiled_block_list(self.compiled_path))
+        self.assertFalse(is_compiled_block_list(self.text_path))
+
+        block_list = DomainBlockList()
+        load_domain_block_file(self.compiled_path, block_list)
+        self.assertEqual(len(block_list), 4)
+
+        for domain in ("a.com", "b.com", "mail.b.com", "c.org", "x.wild.net"):
+            self.assertIn(domain, block_list)
+        for domain in ("d.com", "com", "wild.net", "aa.com"):
+            self.assertNotIn(domain, block_list)
+
+    def test_load_text_file(self):
+        block_list = DomainBlockList()
+        load_domain_block_file(self.text_path, block_list)
+        self.assertEqual(len(block_list), 4)
+        self.assertIn("mail.b.com", block_list)
+
+    def test_domain_and_wildcard_rule(self):
+        DomainBlockList(["*.example.com", "example.com"]).write_compiled(
+            self.compiled_path
+        )
+        compiled = CompiledDomainBlockList(self.compiled_path)
+        self.assertEqual(len(compiled), 2)
+        self.assertIn(b"example.com", compiled)
+        self.assertIn(b"mail.example.com", compiled)
+
+    def test_many_domains(self):
+        # enough domains that lookups have to probe past colliding slots
+        domains = ["domain%i.com" % (i,) for i in range(5000)]
+        DomainBlockList(domains).write_compiled(self.compiled_path)
+
+        block_list = DomainBlockList()
+        load_domain_block_file(self.compiled_path, block_list)
+        for domain in domains:
+            self.assertIn("mail." + domain, block_list)
+        for i in range(5000, 10000):
+            self.assertNotIn("domain%i.com" % (i,), block_list)
+
+    def test_refuses_old_format(self):
+        with open(self.compiled_path, "wb") as fh:
+            fh.write(b"SAMLDBL1" + bytes(16))
+
+        self.assertTrue(is_compiled_block_list(self.compiled_path))
+        with self.assertRaisesRegex(ValueError, "compile it again"):
+            CompiledDomainBlockList(self.compiled_path)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import threading
+import unittest
+
+from matrix_synapse_saml_mozilla._executor import Executor, parse_thread_pool_size
+
+
+class FakeReactor:
+    """Implements the parts of the reactor used by Executor"""
+
+    def __init__(self):
+        self.when_running = []
+        self.shutdown_triggers = []
+        self.from_thread = queue.Queue()
+
+    def callWhenRunning(self, f):
+        self.when_running.append(f)
+
+    def addSystemEventTrigger(self, phase, event, f):
+        self.shutdown_triggers.append(f)
+
+    def callFromThread(self, f, *args):
+        self.from_thread.put((f, args))
+
+
+class ExecutorTestCase(unittest.TestCase):
+    def test_runs_inline_without_pool(self):
+        results = []
+        Executor(pool_size=0).run("test", threading.get_ident).addCallback(
+            results.append
+        )
+        self.assertEqual(results, [threading.get_ident()])
+
+    def test_runs_in_thread_pool(self):
+        reactor = FakeReactor()
+        executor = Executor(pool_size=2, reactor=reactor)
+        for f in reactor.when_running:
+            f()
+        self.addCleanup(lambda: [f() for f in reactor.shutdown_triggers])
+
+        results = []
+        executor.run("test", threading.get_ident).addCallback(results.append)
+
+        # the result is delivered on the reactor thread
+        f, args = reactor.from_thread.get(timeout=10)
+        self.assertEqual(results, [])
+        f(*args)
+        self.assertEqual(len(results), 1)
+        self.assertNotEqual(results[0], threading.get_ident())
+
+    def test_failures_are_returned(self):
+        failures = []
+        Executor(pool_size=0).run("test", lambda: 1 / 0).addErrback(failures.append)
+        self.assertTrue(failures[0].check(ZeroDivisionError))
+
+    def test_parse_thread_pool_size(self):
+        self.assertEqual(parse_thread_pool_size(0), 0)
+        self.assertEqual(parse_thread_pool_size(8), 8)
+        for value in (-1, "4", 2.5, True):
+            with self.assertRaises(Exception):
+                parse_thread_pool_size(value)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+
+from benchmarks.import_time import SYNAPSE_PRELOAD, measure, parse_import_times
+
+# generous, so as not to be flaky on slow machines: before the entry points were
+# loaded lazily, each of these took around a second
+PACKAGE_IMPORT_BUDGET_MS = 50
+ENTRY_POINT_IMPORT_BUDGET_MS = 200
+
+
+def _imported(modules, prefix):
+    return [m for m in modules if m == prefix or m.startswith(prefix + ".")]
+
+
+class ParseImportTimesTestCase(TestCase):
+    def test_parse(self):
+        stderr = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       100 |        100 |   synapse\n"
+            "-- target --\n"
+            "import time:        20 |         20 |   matrix_synapse_saml_mozilla._a\n"
+            "import time:         5 |         25 | matrix_synapse_saml_mozilla\n"
+        )
+        self.assertEqual(
+            parse_import_times(stderr),
+            [
+                ("matrix_synapse_saml_mozilla._a", 20, 20),
+                ("matrix_synapse_saml_mozilla", 5, 25),
+            ],
+        )
+
+
+class ImportTimeTestCase(TestCase):
+    def test_package(self):
+        result = measure("package")
+        for heavy in ("saml2", "synapse", "twisted"):
+            self.assertEqual(_imported(result["modules"], heavy), [])
+        self.assertLess(result["total_ms"], PACKAGE_IMPORT_BUDGET_MS)
+
+    def test_mapping_provider(self):
+        result = measure("mapping_provider", SYNAPSE_PRELOAD)
+        self.assertEqual(_imported(result["modules"], "saml2"), [])
+        self.assertNotIn(
+            "matrix_synapse_saml_mozilla.username_picker", result["modules"]
+        )
+        self.assertLess(result["total_ms"], ENTRY_POINT_IMPORT_BUDGET_MS)
+
+    def test_username_picker(self):
+        result = measure("username_picker", SYNAPSE_PRELOAD)
+        self.assertEqual(_imported(result["modules"], "saml2"), [])
+        self.assertNotIn(
+            "matrix_synapse_saml_mozilla.mapping_provider", result["modules"]
+        )
+        self.assertLess(result["total_ms"], ENTRY_POINT_IMPORT_BUDGET_MS)
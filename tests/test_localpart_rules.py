@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from twisted.web.resource import getChildForRequest
+
+from matrix_synapse_saml_mozilla._localpart_rules import (
+    EMPTY,
+    INVALID_CHARACTERS,
+    PROHIBITED_SUBSTRING,
+    RESERVED,
+    LocalpartValidator,
+    SubstringMatcher,
+    load_prohibited_substrings_file,
+)
+from matrix_synapse_saml_mozilla.username_picker import (
+    parse_config,
+    pick_username_resource,
+)
+
+from .test_username_picker import FakeRequest, PickUsernameTestBase
+
+
+class SubstringMatcherTestCase(unittest.TestCase):
+    def test_overlapping_patterns(self):
+        matcher = SubstringMatcher(["he", "she", "his", "hers"])
+        self.assertEqual(matcher.find("ushers"), "she")
+        self.assertEqual(matcher.find("ahis"), "his")
+        self.assertIsNone(matcher.find("hxs"))
+        self.assertIsNone(matcher.find(""))
+
+    def test_suffix_of_longer_pattern(self):
+        # "bcd" is only found by following the failure link from "abc"
+        matcher = SubstringMatcher(["abce", "bcd"])
+        self.assertEqual(matcher.find("abcd"), "bcd")
+
+    def test_matches_brute_force(self):
+        rand = random.Random(1)
+        patterns = [
+            "".join(rand.choice("abc") for _ in range(rand.randint(1, 4)))
+            for _ in range(20)
+        ]
+        matcher = SubstringMatcher(patterns)
+        for _ in range(500):
+            text = "".join(rand.choice("abcd") for _ in range(rand.randint(0, 10)))
+            found = matcher.find(text)
+            if any(p in text for p in patterns):
+                self.assertIn(found, patterns)
+                self.assertIn(found, text)
+            else:
+                self.assertIsNone(found)
+
+    def test_rejects_wide_characters(self):
+        with self.assertRaises(ValueError):
+            SubstringMatcher(["☺"])
+
+
+class LocalpartValidatorTestCase(unittest.TestCase):
+    def setUp(self):
+        with self.assertLogs("matrix_synapse_saml_mozilla._localpart_rules"):
+            self.validator = LocalpartValidator(
+                reserved=["Admin", "root"], prohibited_substrings=["badword", "x y"]
+            )
+
+    def _reason(self, localpart):
+        rejection = self.validator.check(localpart)
+        return rejection.reason if rejection else None
+
+    def test_check(self):
+        self.assertEqual(self._reason(""), EMPTY)
+        self.assertEqual(self._reason("Jane"), INVALID_CHARACTERS)
+        self.assertEqual(self._reason("jane doe"), INVALID_CHARACTERS)
+        self.assertEqual(self._reason("admin"), RESERVED)
+        self.assertEqual(self._reason("the.badword.1"), PROHIBITED_SUBSTRING)
+        self.assertIsNone(self._reason("jane.doe"))
+        self.assertIsNone(self._reason("administrator"))
+
+    def test_to_json(self):
+        rules = json.loads(self.validator.to_json())
+        self.assertEqual(rules["reserved"], ["admin", "root"])
+        # "x y" could never match, so it is left out
+        self.assertEqual(rules["prohibited_substrings"], ["badword"])
+        self.assertEqual(rules["messages"][EMPTY], "Please enter a username.")
+
+    def test_load_prohibited_substrings_file(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        path = os.path.join(tempdir.name, "substrings.txt")
+        with open(path, "w") as fh:
+            fh.write("# offensive words\nbadword\n\n  worse  \n")
+
+        self.assertEqual(load_prohibited_substrings_file(path), ["badword", "worse"])
+        with self.assertRaises(Exception):
+            load_prohibited_substrings_file(os.path.join(tempdir.name, "missing"))
+
+
+class LocalpartRulesResourceTestCase(PickUsernameTestBase):
+    def setUp(self):
+        super().setUp()
+        config = parse_config(
+            {
+                "reserved_localparts": ["admin"],
+                "prohibited_localpart_substrings": ["badword"],
+            }
+        )
+        self.resource = pick_username_resource(config, self.module_api)
+
+    def test_submit_prohibited_username(self):
+        request = self._submit("my.badword")
+        self.assertEqual(request.responseCode, 400)
+        self.assertIn(b"not allowed", b"".join(request.written))
+        self.assertEqual(self.module_api.logins, [])
+        self.assertIsNotNone(self.store.get(self.session_id))
+
+    def test_check_reserved_username(self):
+        request = FakeRequest([b"check"], self.session_id)
+        request.args = {b"username": [b"admin"]}
+        body = json.loads(self._render(request))
+        self.assertFalse(body["available"])
+        self.assertIn("reserved", body["error"])
+
+    def test_rules_are_served(self):
+        request = FakeRequest([b"rules.json"])
+        resource = getChildForRequest(self.resource, request)
+        rules = json.loads(resource.render(request))
+        self.assertEqual(rules["reserved"], ["admin"])
+        self.assertEqual(rules["prohibited_substrings"], ["badword"])
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+
+import attr
+
+from matrix_synapse_saml_mozilla._memory import InternTable, deep_sizeof
+
+
+@attr.s(slots=True)
+class Slotted:
+    a = attr.ib()
+    b = attr.ib()
+
+
+class InternTableTestCase(unittest.TestCase):
+    def test_intern(self):
+        table = InternTable(max_size=10)
+        first = "".join(["a", "b"])
+        second = "".join(["a", "b"])
+        self.assertIsNot(first, second)
+        self.assertIs(table.intern(first), first)
+        self.assertIs(table.intern(second), first)
+        self.assertIsNone(table.intern(None))
+
+    def test_bounded(self):
+        table = InternTable(max_size=2)
+        table.intern("a")
+        table.intern("b")
+        table.intern("c")
+        self.assertEqual(len(table), 2)
+
+        # "a" was forgotten, so a new copy of it is not shared
+        copy = "".join(["", "a"])
+        self.assertIs(table.intern(copy), copy)
+
+
+class DeepSizeofTestCase(unittest.TestCase):
+    def test_counts_shared_objects_once(self):
+        value = "x" * 100
+        self.assertEqual(
+            deep_sizeof([value, value]),
+            sys.getsizeof([value, value]) + sys.getsizeof(value),
+        )
+
+    def test_slotted_objects(self):
+        obj = Slotted("x" * 100, {"key": 1000})
+        self.assertEqual(
+            deep_sizeof(obj),
+            sys.getsizeof(obj)
+            + sys.getsizeof(obj.a)
+            + sys.getsizeof(obj.b)
+            + sys.getsizeof("key")
+            + sys.getsizeof(1000),
+        )
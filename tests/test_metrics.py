@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from typing import Dict, Optional
+
+from prometheus_client import REGISTRY
+
+from matrix_synapse_saml_mozilla._sessions import (
+    InMemorySessionStore,
+    UsernameMappingSession,
+    expire_old_sessions,
+    set_session_store,
+)
+from matrix_synapse_saml_mozilla.mapping_provider import SamlConfig, SamlMappingProvider
+
+from .test_attributes import FakeResponse
+
+
+def _sample(name: str, labels: Optional[Dict[str, str]] = None) -> float:
+    """Read a sample from the default registry, as Synapse would export it"""
+    return REGISTRY.get_sample_value(name, labels or {}) or 0.0
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.store = InMemorySessionStore(gettime=lambda: self.now)
+        set_session_store(self.store)
+        self.addCleanup(set_session_store, InMemorySessionStore())
+
+        self.provider = SamlMappingProvider(
+            SamlConfig(
+                use_name_id_for_remote_uid=False, domain_block_list=["blocked.com"]
+            ),
+            None,
+        )
+
+    def _map(self, remote_user_id: str, email: Optional[str]):
+        response = FakeResponse(remote_user_id, "Jane Doe")
+        if email is not None:
+            response.ava["email"] = [email]
+        else:
+            del response.ava["email"]
+        # rejected responses raise errors, and accepted ones redirect to the picker
+        with self.assertRaises(Exception):
+            self.provider.saml_response_to_user_attributes(
+                response, 0, "https://client/"
+            )
+
+    def test_mapping(self):
+        responses = _sample("synapse_saml_mozilla_saml_response_seconds_count")
+        rejected = _sample(
+            "synapse_saml_mozilla_rejected_saml_responses_total",
+            {"reason": "blocked_domain"},
+        )
+
+        self._map("allowed", "jane@allowed.com")
+
+        self.assertEqual(
+            _sample("synapse_saml_mozilla_saml_response_seconds_count"), responses + 1
+        )
+        self.assertEqual(
+            _sample(
+                "synapse_saml_mozilla_rejected_saml_responses_total",
+                {"reason": "blocked_domain"},
+            ),
+            rejected,
+        )
+        self.assertEqual(len(self.store), 1)
+
+    def test_rejections(self):
+        responses = _sample("synapse_saml_mozilla_saml_response_seconds_count")
+        blocked = _sample(
+            "synapse_saml_mozilla_rejected_saml_responses_total",
+            {"reason": "blocked_domain"},
+        )
+        missing_email = _sample(
+            "synapse_saml_mozilla_rejected_saml_responses_total",
+            {"reason": "missing_email"},
+        )
+
+        self._map("blocked", "jane@blocked.com")
+        self._map("no_email", None)
+
+        # rejected responses are timed too
+        self.assertEqual(
+            _sample("synapse_saml_mozilla_saml_response_seconds_count"), responses + 2
+        )
+        self.assertEqual(
+            _sample(
+                "synapse_saml_mozilla_rejected_saml_responses_total",
+                {"reason": "blocked_domain"},
+            ),
+            blocked + 1,
+        )
+        self.assertEqual(
+            _sample(
+                "synapse_saml_mozilla_rejected_saml_responses_total",
+                {"reason": "missing_email"},
+            ),
+            missing_email + 1,
+        )
+        self.assertEqual(len(self.store), 0)
+
+    def test_reap(self):
+        expired = _sample("synapse_saml_mozilla_expired_sessions_total")
+        for i, expiry_time in enumerate((1001, 1002, 5000)):
+            self.store["s%i" % (i,)] = UsernameMappingSession(
+                remote_user_id="remote%i" % (i,),
+                displayname=None,
+                client_redirect_url="https://client/",
+                expiry_time_ms=expiry_time * 1000,
+            )
+
+        expire_old_sessions(gettime=lambda: 2000.0)
+
+        self.assertEqual(
+            _sample("synapse_saml_mozilla_expired_sessions_total"), expired + 2
+        )
+        self.assertEqual(_sample("synapse_saml_mozilla_sessions"), 1)
+        self.assertEqual(
+            _sample("synapse_saml_mozilla_session_store_bytes"),
+            self.store.estimate_memory_usage(),
+        )
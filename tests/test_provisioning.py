@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import hmac
+import io
+import os
+import tempfile
+import unittest
+import urllib.parse
+
+from twisted.internet import defer
+
+from matrix_synapse_saml_mozilla._domains import DomainBlockList
+from matrix_synapse_saml_mozilla._provisioning import (
+    ModuleApiProvisioningBackend,
+    Provisioner,
+    ProvisioningRecord,
+    read_records,
+)
+from matrix_synapse_saml_mozilla.provision_users import (
+    AdminApiProvisioningBackend,
+    load_checkpoint,
+    save_checkpoint,
+)
+
+from .test_username_picker import FakeRegistrationModuleApi
+
+
+def _record(remote_user_id, localpart, emails=("user@example.com",)):
+    return ProvisioningRecord(remote_user_id, localpart, emails=emails)
+
+
+class ReadRecordsTestCase(unittest.TestCase):
+    def test_csv(self):
+        fh = io.StringIO(
+            "remote_user_id,localpart,displayname,emails\n"
+            "r1,alice,Alice,a@example.com b@example.org\n"
+            "r2,bob,,\n"
+        )
+        self.assertEqual(
+            list(read_records(fh, "csv")),
+            [
+                ProvisioningRecord(
+                    "r1", "alice", "Alice", ("a@example.com", "b@example.org")
+                ),
+                ProvisioningRecord("r2", "bob", None, ()),
+            ],
+        )
+
+    def test_jsonl(self):
+        fh = io.StringIO(
+            '{"remote_user_id": "r1", "localpart": "alice", "emails": ["a@x.com"]}\n'
+            "\n"
+            '{"remote_user_id": "r2", "localpart": "bob", "displayname": "Bob"}\n'
+        )
+        self.assertEqual(
+            list(read_records(fh, "jsonl")),
+            [
+                ProvisioningRecord("r1", "alice", None, ("a@x.com",)),
+                ProvisioningRecord("r2", "bob", "Bob", ()),
+            ],
+        )
+
+    def test_invalid_record(self):
+        fh = io.StringIO('{"remote_user_id": "r1"}\n')
+        with self.assertRaisesRegex(Exception, "Line 1"):
+            list(read_records(fh, "jsonl"))
+
+
+class ProvisionerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.module_api = FakeRegistrationModuleApi(["@taken:test"])
+        self.provisioner = Provisioner(
+            ModuleApiProvisioningBackend(self.module_api),
+            DomainBlockList(["blocked.com"]),
+            batch_size=2,
+        )
+
+    def _run(self, records, **kwargs):
+        results = []
+        outcomes = []
+        defer.ensureDeferred(
+            self.provisioner.run(records, on_outcome=outcomes.append, **kwargs)
+        ).addBoth(results.append)
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0], outcomes
+
+    def _registered(self):
+        return self.module_api.db.execute(
+            "SELECT external_id, user_id FROM user_external_ids ORDER BY external_id"
+        ).fetchall()
+
+    def test_provisions_users(self):
+        counts, outcomes = self._run(
+            [
+                _record("r1", "alice"),
+                _record("r2", "bob"),
+                _record("r3", "carol", emails=("carol@blocked.com",)),
+                _record("r4", "dave", emails=()),
+                _record("r5", "taken"),
+                _record("r6", "Bob"),
+                _record("r6", "frank"),
+            ]
+        )
+        self.assertEqual(
+            [o.outcome for o in outcomes],
+            [
+                "registered",
+                "registered",
+                "blocked_domain",
+                "missing_email",
+                "localpart_taken",
+                "localpart_taken",
+                "registered",
+            ],
+        )
+        self.assertEqual(
+            counts,
+            {
+                "registered": 3,
+                "blocked_domain": 1,
+                "missing_email": 1,
+                "localpart_taken": 2,
+            },
+        )
+        self.assertEqual(
+            self._registered(),
+            [("r1", "@alice:test"), ("r2", "@bob:test"), ("r6", "@frank:test")],
+        )
+
+    def test_duplicates_in_batch(self):
+        counts, _ = self._run([_record("r1", "alice"), _record("r1", "alice2")])
+        self.assertEqual(counts, {"registered": 1, "duplicate": 1})
+
+    def test_rerun_skips_provisioned_users(self):
+        records = [_record("r1", "alice"), _record("r2", "bob")]
+        self._run(records[:1])
+
+        counts, outcomes = self._run(records)
+        self.assertEqual(counts, {"already_provisioned": 1, "registered": 1})
+        self.assertEqual(outcomes[0].user_id, "@alice:test")
+
+    def test_skip_and_progress(self):
+        progress = []
+        records = [_record("r%i" % (i,), "user%i" % (i,)) for i in range(5)]
+        counts, _ = self._run(records, skip=2, on_batch=progress.append)
+        self.assertEqual(counts, {"registered": 3})
+        self.assertEqual(progress, [4, 5])
+        self.assertEqual(len(self._registered()), 3)
+
+    def test_concurrency_is_bounded(self):
+        self.provisioner = Provisioner(
+            ModuleApiProvisioningBackend(self.module_api),
+            DomainBlockList(),
+            batch_size=10,
+            concurrency=2,
+        )
+        registrations = []
+        register_user = self.module_api.register_user
+
+        def paused_register_user(localpart, displayname=None):
+            d = defer.Deferred()
+            d.addCallback(lambda _: register_user(localpart, displayname))
+            registrations.append(d)
+            return d
+
+        self.module_api.register_user = paused_register_user
+
+        results = []
+        records = [_record("r%i" % (i,), "user%i" % (i,)) for i in range(5)]
+        defer.ensureDeferred(self.provisioner.run(records)).addBoth(results.append)
+        self.assertEqual(len(registrations), 2)
+
+        while len(registrations) < 5:
+            registrations[len(registrations) - 2].callback(None)
+        for d in registrations[-2:]:
+            d.callback(None)
+        self.assertEqual(results, [{"registered": 5}])
+
+
+class FakeAdminApi:
+    """Implements the parts of the Synapse Admin API which the provisioning script
+    uses, in memory"""
+
+    def __init__(self, secret: bytes):
+        self._secret = secret
+        self._nonces = set()
+        # map from user id to the user's external ids
+        self.users = {}
+        self.tokens = set()
+        self.fail_external_ids = False
+        # called just before each registration
+        self.before_register = lambda localpart: None
+
+    def request(self, method, path, body=None, access_token=None):
+        path = urllib.parse.unquote(path)
+        if path == "/_matrix/client/v3/account/whoami":
+            return 200, {"user_id": "@admin:test"}
+        if path == "/_matrix/client/v3/logout":
+            self.tokens.discard(access_token)
+            return 200, {}
+        if path == "/_synapse/admin/v1/register":
+            if method == b"GET":
+                nonce = "nonce%i" % (len(self._nonces),)
+                self._nonces.add(nonce)
+                return 200, {"nonce": nonce}
+            return self._register(body)
+        if path.startswith("/_synapse/admin/v1/auth_providers/saml/users/"):
+            remote_user_id = path.rsplit("/", 1)[1]
+            for user_id, external_ids in self.users.items():
+                if remote_user_id in external_ids:
+                    return 200, {"user_id": user_id}
+            return 404, {}
+        if path.startswith("/_synapse/admin/v2/users/"):
+            user_id = path.rsplit("/", 1)[1]
+            if method == b"GET":
+                if user_id not in self.users:
+                    return 404, {}
+                external_ids = [
+                    {"auth_provider": "saml", "external_id": external_id}
+                    for external_id in self.users[user_id]
+                ]
+                return 200, {"name": user_id, "external_ids": external_ids}
+            if self.fail_external_ids:
+                return 500, {"errcode": "M_UNKNOWN", "error": "Internal error"}
+            # like Synapse, this creates the user if they do not exist
+            self.users[user_id] = [e["external_id"] for e in body["external_ids"]]
+            return 200, {}
+        raise AssertionError("Unexpected request %s %s" % (method, path))
+
+    def _register(self, body):
+        self._nonces.remove(body["nonce"])
+        mac = hmac.new(self._secret, digestmod=hashlib.sha1)
+        mac.update(
+            b"\x00".join(
+                (
+                    body["nonce"].encode("utf-8"),
+                    body["username"].encode("utf-8"),
+                    body["password"].encode("utf-8"),
+                    b"admin" if body["admin"] else b"notadmin",
+                )
+            )
+        )
+        if not hmac.compare_digest(mac.hexdigest(), body["mac"]):
+            return 403, {"errcode": "M_FORBIDDEN", "error": "HMAC incorrect"}
+
+        self.before_register(body["username"])
+        user_id = "@%s:test" % (body["username"],)
+        if user_id in self.users:
+            return 400, {"errcode": "M_USER_IN_USE", "error": "User ID already taken."}
+        self.users[user_id] = []
+        token = "token_" + body["username"]
+        self.tokens.add(token)
+        return 200, {"user_id": user_id, "access_token": token}
+
+
+class AdminApiProvisioningBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.journal_path = os.path.join(tempdir.name, "users.csv.registered")
+        self.admin_api = FakeAdminApi(b"shared secret")
+
+    def _run(self, records):
+        backend = AdminApiProvisioningBackend(
+            None, "https://synapse/", "admin_token", "shared secret", self.journal_path
+        )
+
+        async def request(method, path, body=None, access_token=None):
+            return self.admin_api.request(method, path, body, access_token)
+
+        backend._request = request
+        provisioner = Provisioner(backend, DomainBlockList())
+
+        results = []
+        outcomes = []
+        defer.ensureDeferred(
+            provisioner.run(records, on_outcome=outcomes.append)
+        ).addBoth(results.append)
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return outcomes
+
+    def test_provisions_users(self):
+        outcomes = self._run([_record("r1", "alice")])
+        self.assertEqual(
+            [(o.outcome, o.user_id) for o in outcomes], [("registered", "@alice:test")]
+        )
+        self.assertEqual(self.admin_api.users, {"@alice:test": ["r1"]})
+
+        # the access token which registration created was logged out
+        self.assertEqual(self.admin_api.tokens, set())
+
+    def test_does_not_modify_user_registered_concurrently(self):
+        # someone else registers the localpart after it was checked
+        def before_register(localpart):
+            self.admin_api.users.setdefault("@%s:test" % (localpart,), [])
+
+        self.admin_api.before_register = before_register
+
+        outcomes = self._run([_record("r1", "alice")])
+        self.assertEqual([o.outcome for o in outcomes], ["localpart_taken"])
+        self.assertEqual(self.admin_api.users, {"@alice:test": []})
+
+        # a later run does not take the user over either
+        self.admin_api.before_register = lambda localpart: None
+        outcomes = self._run([_record("r1", "alice")])
+        self.assertEqual([o.outcome for o in outcomes], ["localpart_taken"])
+        self.assertEqual(self.admin_api.users, {"@alice:test": []})
+
+    def test_completes_partly_provisioned_user(self):
+        self.admin_api.fail_external_ids = True
+        outcomes = self._run([_record("r1", "alice")])
+        self.assertEqual([o.outcome for o in outcomes], ["failed"])
+        self.assertEqual(self.admin_api.users, {"@alice:test": []})
+
+        self.admin_api.fail_external_ids = False
+        outcomes = self._run([_record("r1", "alice")])
+        self.assertEqual(
+            [(o.outcome, o.user_id) for o in outcomes], [("registered", "@alice:test")]
+        )
+        self.assertEqual(self.admin_api.users, {"@alice:test": ["r1"]})
+
+    def test_partly_provisioned_user_is_not_given_to_another_record(self):
+        self.admin_api.fail_external_ids = True
+        self._run([_record("r1", "alice")])
+
+        self.admin_api.fail_external_ids = False
+        outcomes = self._run([_record("r2", "alice")])
+        self.assertEqual([o.outcome for o in outcomes], ["localpart_taken"])
+        self.assertEqual(self.admin_api.users, {"@alice:test": []})
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = os.path.join(tempdir.name, "users.csv.checkpoint")
+
+    def test_round_trip(self):
+        self.assertEqual(load_checkpoint(self.path, "users.csv"), 0)
+        save_checkpoint(self.path, "users.csv", 200)
+        self.assertEqual(load_checkpoint(self.path, "users.csv"), 200)
+
+    def test_different_input(self):
+        save_checkpoint(self.path, "users.csv", 200)
+        with self.assertRaises(Exception):
+            load_checkpoint(self.path, "other.csv")
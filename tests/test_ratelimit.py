@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from matrix_synapse_saml_mozilla._ratelimit import (
+    RateLimitConfig,
+    RequestRateLimiter,
+    TokenBucketRateLimiter,
+    parse_max_tracked_keys,
+    parse_rate_limit_config,
+)
+
+
+class TokenBucketRateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = TokenBucketRateLimiter(
+            RateLimitConfig(per_second=0.5, burst_count=2),
+            max_keys=2,
+            gettime=lambda: self.now,
+        )
+
+    def test_burst_then_limit(self):
+        self.assertEqual(self.limiter.try_acquire("a"), 0)
+        self.assertEqual(self.limiter.try_acquire("a"), 0)
+        self.assertAlmostEqual(self.limiter.try_acquire("a"), 2)
+
+        # other keys have their own buckets
+        self.assertEqual(self.limiter.try_acquire("b"), 0)
+
+    def test_refill(self):
+        self.limiter.try_acquire("a")
+        self.limiter.try_acquire("a")
+        self.now += 1
+        self.assertAlmostEqual(self.limiter.try_acquire("a"), 1)
+        self.now += 1
+        self.assertEqual(self.limiter.try_acquire("a"), 0)
+
+    def test_bounded_number_of_keys(self):
+        for key in ("a", "b", "c"):
+            self.limiter.try_acquire(key)
+        self.assertEqual(len(self.limiter), 2)
+
+
+class RequestRateLimiterTestCase(unittest.TestCase):
+    def test_limits_ip_and_session(self):
+        limiter = RequestRateLimiter(
+            per_ip=RateLimitConfig(per_second=1, burst_count=3),
+            per_session=RateLimitConfig(per_second=1, burst_count=1),
+            max_keys=100,
+            gettime=lambda: 1000.0,
+        )
+        self.assertEqual(limiter.try_acquire("1.2.3.4", "session1"), 0)
+        self.assertGreater(limiter.try_acquire("1.2.3.4", "session1"), 0)
+        self.assertEqual(limiter.try_acquire("1.2.3.4", "session2"), 0)
+        # the request refused for session1 did not count against the IP
+        self.assertEqual(limiter.try_acquire("1.2.3.4", "session3"), 0)
+        self.assertGreater(limiter.try_acquire("1.2.3.4", "session4"), 0)
+
+        # nor did the one refused for the IP count against session4
+        self.assertEqual(limiter.try_acquire("5.6.7.8", "session4"), 0)
+
+    def test_disabled_limits(self):
+        limiter = RequestRateLimiter(
+            per_ip=None,
+            per_session=RateLimitConfig(per_second=1, burst_count=1),
+            max_keys=100,
+            gettime=lambda: 1000.0,
+        )
+        self.assertEqual(limiter.try_acquire("1.2.3.4", "session1"), 0)
+        self.assertEqual(limiter.try_acquire("1.2.3.4", "session2"), 0)
+        self.assertGreater(limiter.try_acquire("1.2.3.4", "session1"), 0)
+
+
+class ParseRateLimitConfigTestCase(unittest.TestCase):
+    def test_rejects_invalid_limits(self):
+        default = RateLimitConfig(per_second=1, burst_count=1)
+        self.assertEqual(
+            parse_rate_limit_config({"per_second": 0.5}, default),
+            RateLimitConfig(per_second=0.5, burst_count=1),
+        )
+        for bad in ({"per_second": 0}, {"per_second": -1}, {"burst_count": 0}):
+            with self.assertRaises(Exception):
+                parse_rate_limit_config(bad, default)
+
+    def test_rejects_invalid_max_tracked_keys(self):
+        self.assertEqual(parse_max_tracked_keys(10), 10)
+        for bad in (0, -1, 1.5, True, "10"):
+            with self.assertRaises(Exception):
+                parse_max_tracked_keys(bad)
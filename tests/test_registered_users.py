@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from matrix_synapse_saml_mozilla._availability import UsernameAvailabilityChecker
+from matrix_synapse_saml_mozilla._bloom import BloomFilter, bloom_filter_parameters
+from matrix_synapse_saml_mozilla._cache import TTLCache
+from matrix_synapse_saml_mozilla._registered_users import (
+    RegisteredUsersFilter,
+    RegisteredUsersFilterConfig,
+    parse_registered_users_filter_config,
+)
+
+from .test_availability import FakeModuleApi
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        bloom.update("@user%i:test" % (i,) for i in range(1000))
+        self.assertEqual(len(bloom), 1000)
+        for i in range(1000):
+            self.assertIn("@user%i:test" % (i,), bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter.for_capacity(10000, 0.01)
+        bloom.update("@user%i:test" % (i,) for i in range(10000))
+        false_positives = sum("@other%i:test" % (i,) in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.002)
+
+    def test_max_size(self):
+        bits, hashes = bloom_filter_parameters(1000000, 0.01)
+        self.assertEqual(hashes, 7)
+        self.assertGreater(bits, 8 * 1000000)
+
+        bits, _ = bloom_filter_parameters(1000000, 0.01, max_size=1024)
+        self.assertEqual(bits, 8 * 1024)
+
+
+class PausedModuleApi(FakeModuleApi):
+    """Holds up database interactions until the test releases them"""
+
+    def __init__(self, registered):
+        super().__init__(registered)
+        self.paused = False
+        self.waiting = []
+
+    def run_db_interaction(self, desc, func, *args):
+        if not self.paused:
+            return super().run_db_interaction(desc, func, *args)
+        d = defer.Deferred()
+        self.waiting.append((d, desc, func, args))
+        return d
+
+    def release(self):
+        self.paused = False
+        while self.waiting:
+            d, desc, func, args = self.waiting.pop(0)
+            super().run_db_interaction(desc, func, *args).chainDeferred(d)
+
+
+class RegisteredUsersFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.module_api = PausedModuleApi(
+            ["@user%i:test" % (i,) for i in range(25)] + ["@Admin:test"]
+        )
+        self.clock = Clock()
+        self.filter = RegisteredUsersFilter(
+            self.module_api,
+            RegisteredUsersFilterConfig(page_size=10, rebuild_interval=60),
+            clock=self.clock,
+        )
+
+    def test_builds_in_pages(self):
+        self.assertTrue(self.filter.may_be_registered("@anyone:test"))
+        self.filter.start()
+        self.addCleanup(self.filter.stop)
+        self.assertTrue(self.filter.ready)
+
+        # a count, and four pages of users
+        self.assertEqual(self.module_api.db_interactions, 5)
+        for i in range(25):
+            self.assertTrue(self.filter.may_be_registered("@user%i:test" % (i,)))
+        self.assertTrue(self.filter.may_be_registered("@admin:test"))
+        self.assertFalse(self.filter.may_be_registered("@jane:test"))
+
+        # users registered since are picked up by the next rebuild
+        self.module_api.db.execute("INSERT INTO users VALUES ('@jane:test')")
+        self.clock.advance(60)
+        self.assertTrue(self.filter.may_be_registered("@jane:test"))
+
+    def test_registrations_during_build(self):
+        self.filter.start()
+        self.addCleanup(self.filter.stop)
+        self.filter.add("@jane:test")
+        self.assertTrue(self.filter.may_be_registered("@jane:test"))
+
+        # the rebuild reads the table before bob is registered
+        self.module_api.paused = True
+        self.clock.advance(60)
+        self.filter.add("@Bob:test")
+        self.module_api.release()
+        self.assertTrue(self.filter.may_be_registered("@bob:test"))
+
+    def test_failed_build_keeps_old_filter(self):
+        self.filter.start()
+        self.addCleanup(self.filter.stop)
+
+        self.module_api.db.execute("DROP TABLE users")
+        with self.assertLogs("matrix_synapse_saml_mozilla._registered_users", "ERROR"):
+            self.clock.advance(60)
+        self.assertTrue(self.filter.may_be_registered("@user1:test"))
+        self.assertFalse(self.filter.may_be_registered("@jane:test"))
+
+    def test_checker_skips_database(self):
+        self.filter.start()
+        self.addCleanup(self.filter.stop)
+        checker = UsernameAvailabilityChecker(
+            self.module_api,
+            TTLCache(max_size=100, ttl=60),
+            registered_users=self.filter,
+        )
+        interactions = self.module_api.db_interactions
+
+        results = []
+        d = checker.check_many(["jane", "bob", "admin"])
+        defer.ensureDeferred(d).addCallback(results.append)
+        self.assertEqual(results, [{"jane": True, "bob": True, "admin": False}])
+        self.assertEqual(self.module_api.db_interactions, interactions + 1)
+
+        # once registered, jane is looked up in the database again
+        checker.mark_unavailable("@jane:test")
+        self.assertTrue(self.filter.may_be_registered("@jane:test"))
+
+    def test_parse_config(self):
+        config = parse_registered_users_filter_config({"false_positive_rate": 0.001})
+        self.assertEqual(config.false_positive_rate, 0.001)
+        for bad in ({"false_positive_rate": 1}, {"max_size": 0}):
+            with self.assertRaises(Exception):
+                parse_registered_users_filter_config(bad)
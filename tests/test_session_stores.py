@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fnmatch
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from matrix_synapse_saml_mozilla._executor import Executor
+from matrix_synapse_saml_mozilla._session_stores import (
+    JOURNAL_COMPACTION_MIN_RECORDS,
+    JournalSessionStore,
+    RedisSessionStore,
+    SignedTokenSessionStore,
+    SqliteSessionStore,
+    parse_session_store_config,
+)
+from matrix_synapse_saml_mozilla._sessions import UsernameMappingSession
+
+
+def _make_session(expiry_time_ms: int) -> UsernameMappingSession:
+    return UsernameMappingSession(
+        remote_user_id="remote",
+        displayname="Jonny",
+        client_redirect_url="http://client/",
+        expiry_time_ms=expiry_time_ms,
+    )
+
+
+class FakeRedis:
+    """A stand-in for `redis.Redis`, implementing just what RedisSessionStore uses"""
+
+    def __init__(self, clock):
+        self._clock = clock
+        # map from key to (value, expiry time in ms)
+        self._data = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= self._clock() * 1000:
+            return None
+        return entry[0].encode("utf-8")
+
+    def set(self, key, value, px, nx=False):
+        if nx and self.get(key) is not None:
+            return None
+        self._data[key] = (value, self._clock() * 1000 + px)
+        return True
+
+    def delete(self, key):
+        return 1 if self._data.pop(key, None) is not None else 0
+
+    def scan_iter(self, match):
+        return (
+            k for k in list(self._data) if fnmatch.fnmatch(k, match) and self.get(k)
+        )
+
+    def pipeline(self, transaction):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def set(self, key, value, px):
+        self._commands.append((self._client.set, (key, value, px)))
+
+    def get(self, key):
+        self._commands.append((self._client.get, (key,)))
+
+    def delete(self, key):
+        self._commands.append((self._client.delete, (key,)))
+
+    def execute(self):
+        return [method(*args) for method, args in self._commands]
+
+
+class PausedExecutor:
+    """An executor which runs each step when the test releases it"""
+
+    def __init__(self):
+        self._steps = []
+
+    def run(self, step, f, *args):
+        d = defer.Deferred()
+        self._steps.append((d, f, args))
+        return d
+
+    def release(self):
+        steps, self._steps = self._steps, []
+        for d, f, args in steps:
+            try:
+                result = f(*args)
+            except Exception:
+                d.errback()
+            else:
+                d.callback(result)
+
+
+class SessionStoreTestMixin:
+    def make_store(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.now = 1000.0
+        self.store = self.make_store()
+
+    def test_add_and_get(self):
+        session = _make_session(2000 * 1000)
+        self.store.add("a", session)
+        self.assertEqual(self.store.get("a"), session)
+        self.assertIsNone(self.store.get("b"))
+        self.assertEqual(len(self.store), 1)
+
+    def test_add_many(self):
+        self.store.add_many(
+            [("a", _make_session(2000 * 1000)), ("b", _make_session(3000 * 1000))]
+        )
+        self.assertIn("a", self.store)
+        self.assertIn("b", self.store)
+        self.assertEqual(len(self.store), 2)
+
+    def test_delete(self):
+        self.store.add("a", _make_session(2000 * 1000))
+        self.store.delete("a")
+        self.assertIsNone(self.store.get("a"))
+
+        # deleting a missing session is not an error
+        self.store.delete("a")
+
+    def test_add_new(self):
+        self.assertTrue(self.store.add_new("a", _make_session(2000 * 1000)))
+        self.assertFalse(self.store.add_new("a", _make_session(3000 * 1000)))
+        self.assertEqual(self.store.get("a").expiry_time_ms, 2000 * 1000)
+
+        # the id of an expired session can be reused
+        self.now = 2500.0
+        self.assertTrue(self.store.add_new("a", _make_session(3000 * 1000)))
+        self.assertEqual(self.store.get("a").expiry_time_ms, 3000 * 1000)
+
+    def test_take_and_restore(self):
+        session = _make_session(2000 * 1000)
+        self.store.add("a", session)
+        self.assertEqual(self.store.take("a"), session)
+        self.assertIsNone(self.store.take("a"))
+        self.assertIsNone(self.store.get("a"))
+
+        self.store.restore("a", session)
+        self.assertEqual(self.store.take("a"), session)
+
+        # expired sessions cannot be taken
+        self.store.add("b", _make_session(1500 * 1000))
+        self.now = 2000.0
+        self.assertIsNone(self.store.take("b"))
+
+    def test_expiry(self):
+        self.store.add("a", _make_session(1500 * 1000))
+        self.store.add("b", _make_session(2500 * 1000))
+
+        self.now = 2000.0
+        self.store.expire()
+        self.assertIsNone(self.store.get("a"))
+        self.assertIsNotNone(self.store.get("b"))
+        self.assertEqual(len(self.store), 1)
+
+
+class SqliteSessionStoreTestCase(SessionStoreTestMixin, unittest.TestCase):
+    def make_store(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        return SqliteSessionStore(
+            os.path.join(tempdir.name, "sessions.db"), gettime=lambda: self.now
+        )
+
+    def test_shared_between_stores(self):
+        """Sessions written by one worker are visible to another"""
+        self.store.add("a", _make_session(2000 * 1000))
+        path = self.store._conn.execute("PRAGMA database_list").fetchone()[2]
+        other = SqliteSessionStore(path, gettime=lambda: self.now)
+        self.assertIsNotNone(other.get("a"))
+
+        # only one worker can take a session
+        self.assertIsNotNone(other.take("a"))
+        self.assertIsNone(self.store.take("a"))
+
+
+class JournalSessionStoreTestCase(SessionStoreTestMixin, unittest.TestCase):
+    def make_store(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = os.path.join(tempdir.name, "sessions.journal")
+        self.clock = Clock()
+        return self._open()
+
+    def _open(self, executor=None):
+        store = JournalSessionStore(
+            self.path,
+            flush_interval=1,
+            gettime=lambda: self.now,
+            clock=self.clock,
+            executor=executor or Executor(pool_size=0),
+        )
+        self.addCleanup(store.close)
+        return store
+
+    def _journal_lines(self):
+        with open(self.path) as fh:
+            return fh.readlines()
+
+    def test_flushes_in_batches(self):
+        self.store.add("a", _make_session(2000 * 1000))
+        self.store.add("b", _make_session(2000 * 1000))
+        self.assertEqual(self._journal_lines(), [])
+
+        self.clock.advance(1)
+        self.assertEqual(len(self._journal_lines()), 2)
+
+    def test_close_waits_for_background_flush(self):
+        executor = PausedExecutor()
+        store = self._open(executor)
+        store.add("a", _make_session(2000 * 1000))
+        self.clock.advance(1)
+        store.add("b", _make_session(2000 * 1000))
+
+        closed = []
+        store.close().addCallback(closed.append)
+        self.assertEqual(closed, [])
+
+        # once the background flush has written "a", close writes "b"
+        executor.release()
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(len(self._journal_lines()), 2)
+
+    def test_survives_restart(self):
+        self.store.add("a", _make_session(2000 * 1000))
+        self.store.add("b", _make_session(3000 * 1000))
+        self.store.add("c", _make_session(3000 * 1000))
+        self.store.delete("c")
+        self.store.close()
+
+        # "a" expires while the store is closed
+        self.now = 2500.0
+        store = self._open()
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("b"), _make_session(3000 * 1000))
+        self.assertIsNone(store.get("c"))
+
+        # the journal was compacted to just the live session
+        self.assertEqual(len(self._journal_lines()), 1)
+
+    def test_ignores_partly_written_record(self):
+        self.store.add("a", _make_session(2000 * 1000))
+        self.store.close()
+        with open(self.path, "a") as fh:
+            fh.write('["c","b",{"remote_us')
+
+        store = self._open()
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(len(store), 1)
+
+    def test_compaction(self):
+        for i in range(JOURNAL_COMPACTION_MIN_RECORDS):
+            self.store.add("s%i" % (i,), _make_session(2000 * 1000))
+            self.store.delete("s%i" % (i,))
+        self.store.add("live", _make_session(2000 * 1000))
+
+        self.clock.advance(1)
+        self.assertEqual(len(self._journal_lines()), 1)
+        self.assertIsNotNone(self.store.get("live"))
+
+
+class RedisSessionStoreTestCase(SessionStoreTestMixin, unittest.TestCase):
+    def make_store(self):
+        clock = lambda: self.now  # noqa: E731
+        return RedisSessionStore(FakeRedis(clock), "sessions:", gettime=clock)
+
+    def test_add_new_refuses_expired_session(self):
+        with self.assertRaises(Exception):
+            self.store.add_new("a", _make_session(999 * 1000))
+        self.assertIsNone(self.store.get("a"))
+
+
+class SignedTokenSessionStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.store = SignedTokenSessionStore(
+            b"secret", replay_cache_size=2, gettime=lambda: self.now
+        )
+
+    def test_round_trip(self):
+        session = _make_session(2000 * 1000)
+        session_id = self.store.create(session)
+        self.assertEqual(self.store.get(session_id), session)
+
+        # another store with the same secret can verify the session
+        other = SignedTokenSessionStore(b"secret", gettime=lambda: self.now)
+        self.assertEqual(other.get(session_id), session)
+
+    def test_tampered_token(self):
+        session_id = self.store.create(_make_session(2000 * 1000))
+        payload, signature = session_id.split(".")
+        forged = self.store.create(_make_session(3000 * 1000)).split(".")[0]
+
+        self.assertIsNone(self.store.get(forged + "." + signature))
+        self.assertIsNone(self.store.get(payload))
+        self.assertIsNone(self.store.get("not a token"))
+
+        other = SignedTokenSessionStore(b"other secret", gettime=lambda: self.now)
+        self.assertIsNone(other.get(session_id))
+
+    def test_expired_token(self):
+        session_id = self.store.create(_make_session(1500 * 1000))
+        self.now = 1500.0
+        self.assertIsNone(self.store.get(session_id))
+
+    def test_deleted_token_cannot_be_replayed(self):
+        session_id = self.store.create(_make_session(2000 * 1000))
+        self.store.delete(session_id)
+        self.assertIsNone(self.store.get(session_id))
+
+    def test_take_and_restore(self):
+        session = _make_session(2000 * 1000)
+        session_id = self.store.create(session)
+        self.assertEqual(self.store.take(session_id), session)
+        self.assertIsNone(self.store.take(session_id))
+
+        self.store.restore(session_id, session)
+        self.assertEqual(self.store.get(session_id), session)
+
+    def test_replay_cache_is_bounded(self):
+        session_ids = [
+            self.store.create(_make_session((2000 + i) * 1000)) for i in range(3)
+        ]
+        for session_id in session_ids:
+            self.store.delete(session_id)
+        self.assertEqual(len(self.store._replay_cache), 2)
+
+        self.now = 2001.0
+        self.assertEqual(self.store.expire(), 1)
+
+    def test_invalid_token_is_not_logged(self):
+        session_id = self.store.create(_make_session(2000 * 1000))
+        forged = session_id[:-2] + ("AA" if not session_id.endswith("AA") else "BB")
+
+        with self.assertLogs(
+            "matrix_synapse_saml_mozilla._session_stores", "DEBUG"
+        ) as logs:
+            self.assertIsNone(self.store.get(forged))
+        self.assertEqual([r.levelname for r in logs.records], ["DEBUG"])
+        self.assertNotIn(forged, logs.output[0])
+
+
+class SharedReplayCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        path = os.path.join(tempdir.name, "replay.db")
+
+        # two workers sharing a replay cache
+        self.stores = [
+            SignedTokenSessionStore(
+                b"secret", gettime=lambda: self.now, replay_cache_path=path
+            )
+            for _ in range(2)
+        ]
+
+    def test_blocking_io(self):
+        self.assertTrue(self.stores[0].blocking_io)
+        self.assertFalse(SignedTokenSessionStore(b"secret").blocking_io)
+
+    def test_take_is_single_use_across_workers(self):
+        session = _make_session(2000 * 1000)
+        session_id = self.stores[0].create(session)
+
+        self.assertEqual(self.stores[1].take(session_id), session)
+        self.assertIsNone(self.stores[0].take(session_id))
+        self.assertIsNone(self.stores[0].get(session_id))
+
+        self.stores[1].restore(session_id, session)
+        self.assertEqual(self.stores[0].take(session_id), session)
+
+    def test_expire(self):
+        session_id = self.stores[0].create(_make_session(1500 * 1000))
+        self.stores[0].delete(session_id)
+        self.assertEqual(self.stores[1].expire(1400 * 1000), 0)
+        self.assertEqual(self.stores[1].expire(1500 * 1000), 1)
+
+
+class ParseSessionStoreConfigTestCase(unittest.TestCase):
+    def test_defaults(self):
+        config = parse_session_store_config({})
+        self.assertEqual(config.type, "memory")
+
+    def test_bad_type(self):
+        with self.assertRaises(Exception):
+            parse_session_store_config({"type": "memcached"})
+
+    def test_sqlite_requires_path(self):
+        with self.assertRaises(Exception):
+            parse_session_store_config({"type": "sqlite"})
+
+    def test_redis_requires_package(self):
+        with mock.patch.dict(sys.modules, {"redis": None}):
+            with self.assertRaisesRegex(Exception, "redis"):
+                parse_session_store_config({"type": "redis", "url": "redis://x"})
+
+        with mock.patch.dict(sys.modules, {"redis": types.ModuleType("redis")}):
+            config = parse_session_store_config({"type": "redis", "url": "redis://x"})
+        self.assertEqual(config.url, "redis://x")
+
+    def test_signed_token_replay_cache_path(self):
+        config = parse_session_store_config(
+            {"type": "signed_token", "secret": "s", "replay_cache_path": "/tmp/r.db"}
+        )
+        self.assertEqual(config.replay_cache_path, "/tmp/r.db")
+
+    def test_signed_token_requires_secret(self):
+        with self.assertRaises(Exception):
+            parse_session_store_config({"type": "signed_token"})
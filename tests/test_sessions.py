@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from matrix_synapse_saml_mozilla import _sessions
+from matrix_synapse_saml_mozilla._executor import get_executor, set_executor
+from matrix_synapse_saml_mozilla._metrics import live_sessions
+from matrix_synapse_saml_mozilla._session_stores import (
+    SignedTokenSessionStore,
+    SqliteSessionStore,
+)
+from matrix_synapse_saml_mozilla._sessions import (
+    SESSION_REAPER_INTERVAL_SECONDS,
+    InMemorySessionStore,
+    UsernameMappingSession,
+    create_mapping_session,
+    expire_old_sessions,
+    generate_session_id,
+    get_mapping_session,
+    set_session_store,
+    start_session_reaper,
+    take_mapping_session,
+)
+
+from .test_session_stores import PausedExecutor
+
+
+def _make_session(expiry_time_ms: int) -> UsernameMappingSession:
+    return UsernameMappingSession(
+        remote_user_id="remote",
+        displayname=None,
+        client_redirect_url="http://client/",
+        expiry_time_ms=expiry_time_ms,
+    )
+
+
+class InMemorySessionStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.store = InMemorySessionStore(gettime=lambda: self.now)
+
+    def test_expire_in_order(self):
+        self.store["c"] = _make_session(3000 * 1000)
+        self.store["a"] = _make_session(1001 * 1000)
+        self.store["b"] = _make_session(2000 * 1000)
+
+        self.assertEqual(self.store.expire(1500 * 1000), 1)
+        self.assertNotIn("a", self.store)
+        self.assertIn("b", self.store)
+
+        self.assertEqual(self.store.expire(2500 * 1000), 1)
+        self.assertEqual(len(self.store), 1)
+        self.assertIn("c", self.store)
+
+    def test_get_ignores_expired_session(self):
+        self.store["a"] = _make_session(1001 * 1000)
+        self.assertIsNotNone(self.store.get("a"))
+
+        self.now = 1002.0
+        self.assertIsNone(self.store.get("a"))
+        self.assertNotIn("a", self.store)
+
+    def test_deleted_and_replaced_sessions(self):
+        self.store["a"] = _make_session(1001 * 1000)
+        del self.store["a"]
+        self.store["b"] = _make_session(1001 * 1000)
+        self.store["b"] = _make_session(5000 * 1000)
+
+        # neither the deleted session nor the replaced one should be counted
+        self.assertEqual(self.store.expire(2000 * 1000), 0)
+        self.assertIn("b", self.store)
+
+    def test_reaper_counts_live_sessions(self):
+        set_session_store(self.store)
+        self.addCleanup(set_session_store, InMemorySessionStore())
+        self.store["a"] = _make_session(1001 * 1000)
+        self.store["b"] = _make_session(2000 * 1000)
+
+        # the gauge is only updated by the reaper, not by each change
+        expire_old_sessions(gettime=lambda: 1500.0)
+        self.assertEqual(live_sessions._value.get(), 1)
+        self.store["c"] = _make_session(3000 * 1000)
+        self.assertEqual(live_sessions._value.get(), 1)
+
+    def test_reaper_survives_errors(self):
+        set_session_store(self.store)
+        self.addCleanup(set_session_store, InMemorySessionStore())
+        self.store.expire = mock.Mock(side_effect=Exception("database is locked"))
+
+        clock = Clock()
+        with mock.patch.object(_sessions, "_reaper", None):
+            start_session_reaper(clock)
+            self.addCleanup(_sessions._reaper.stop)
+
+            with self.assertLogs("matrix_synapse_saml_mozilla._sessions", "ERROR"):
+                clock.advance(SESSION_REAPER_INTERVAL_SECONDS)
+            self.assertTrue(_sessions._reaper.running)
+
+            self.store.expire = mock.Mock(return_value=0)
+            clock.advance(SESSION_REAPER_INTERVAL_SECONDS)
+            self.store.expire.assert_called_once()
+
+
+class SessionRecordTestCase(unittest.TestCase):
+    def test_sessions_share_strings(self):
+        # build the strings at runtime, so that they are distinct objects
+        url = "".join(["http://", "client/"])
+        other_url = "".join(["http://", "client/"])
+        self.assertIsNot(url, other_url)
+
+        a = UsernameMappingSession("remote1", "Jane " + "Doe", url, 0)
+        b = UsernameMappingSession("remote2", "Jane " + "Doe", other_url, 0)
+        self.assertIs(a.client_redirect_url, b.client_redirect_url)
+        self.assertIs(a.displayname, b.displayname)
+        self.assertFalse(hasattr(a, "__dict__"))
+
+    def test_memory_usage(self):
+        store = InMemorySessionStore(gettime=lambda: 1000.0)
+        self.assertEqual(store.memory_usage(), store.estimate_memory_usage())
+
+        for i in range(1000):
+            store["s%i" % (i,)] = UsernameMappingSession(
+                "remote%i" % (i,), "User %i" % (i,), "http://client/", 2000 * 1000
+            )
+        exact = store.memory_usage()
+        self.assertGreater(exact, 1000 * 100)
+        self.assertAlmostEqual(store.estimate_memory_usage() / exact, 1, delta=0.05)
+
+
+class SessionIdTestCase(unittest.TestCase):
+    def test_generate_session_id(self):
+        session_id = generate_session_id()
+        # 128 bits of base64url
+        self.assertRegex(session_id, re.compile("^[A-Za-z0-9_-]{22}$"))
+        self.assertNotEqual(session_id, generate_session_id())
+
+    def test_create_avoids_collisions(self):
+        store = InMemorySessionStore(gettime=lambda: 1000.0)
+        store["a"] = _make_session(2000 * 1000)
+
+        with mock.patch(
+            "matrix_synapse_saml_mozilla._sessions.generate_session_id",
+            side_effect=["a", "b"],
+        ):
+            self.assertEqual(store.create(_make_session(3000 * 1000)), "b")
+        self.assertEqual(store["a"].expiry_time_ms, 2000 * 1000)
+
+    def test_create_gives_up(self):
+        store = InMemorySessionStore(gettime=lambda: 1000.0)
+        store["a"] = _make_session(2000 * 1000)
+
+        with mock.patch(
+            "matrix_synapse_saml_mozilla._sessions.generate_session_id",
+            return_value="a",
+        ):
+            with self.assertRaises(Exception):
+                store.create(_make_session(3000 * 1000))
+
+
+class CreateMappingSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = os.path.join(tempdir.name, "sessions.db")
+        self.store = SqliteSessionStore(self.path)
+        set_session_store(self.store)
+        self.addCleanup(set_session_store, InMemorySessionStore())
+
+        self.addCleanup(set_executor, get_executor())
+        self.executor = PausedExecutor()
+        set_executor(self.executor)
+
+        self.session = _make_session(int(time.time() * 1000) + 60000)
+
+    def test_stored_in_background(self):
+        session_id = create_mapping_session(self.session)
+        self.assertIsNone(self.store.get(session_id))
+
+        # lookups wait for the session to be stored
+        d = defer.ensureDeferred(get_mapping_session(session_id))
+        self.assertFalse(d.called)
+        self.executor.release()
+        self.assertFalse(d.called)
+        self.executor.release()
+        self.assertEqual(d.result, self.session)
+
+        d = defer.ensureDeferred(take_mapping_session(session_id))
+        self.executor.release()
+        self.assertEqual(d.result, self.session)
+        self.assertIsNone(self.store.get(session_id))
+
+    def test_failed_write(self):
+        with mock.patch.object(self.store, "add_new", side_effect=OSError("disk full")):
+            session_id = create_mapping_session(self.session)
+            d = defer.ensureDeferred(take_mapping_session(session_id))
+            with self.assertLogs(_sessions.logger, "ERROR"):
+                self.executor.release()
+        self.assertTrue(d.called)
+        self.assertIsNone(d.result)
+
+    def test_signed_token_created_directly(self):
+        store = SignedTokenSessionStore(
+            b"secret", replay_cache_path=self.path + ".replay"
+        )
+        self.assertTrue(store.blocking_io)
+        set_session_store(store)
+
+        session_id = create_mapping_session(self.session)
+        self.assertEqual(store.get(session_id), self.session)
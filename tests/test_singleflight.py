@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from twisted.internet import defer
+
+from matrix_synapse_saml_mozilla._singleflight import SingleFlight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = []
+
+    def _operation(self, key):
+        async def operation():
+            d = defer.Deferred()
+            self.calls.append((key, d))
+            return await d
+
+        return operation
+
+    def _run(self, key):
+        """Start the operation for the key, returning a list which gets its result"""
+        results = []
+        defer.ensureDeferred(self.flight.run(key, self._operation(key))).addErrback(
+            lambda f: f.value
+        ).addCallback(results.append)
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        first = self._run("a")
+        second = self._run("a")
+        self.assertIn("a", self.flight)
+        self.assertEqual(len(self.calls), 1)
+
+        self.calls[0][1].callback(1)
+        self.assertEqual(first, [1])
+        self.assertEqual(second, [1])
+        self.assertNotIn("a", self.flight)
+
+        # once the operation has finished, it runs again
+        third = self._run("a")
+        self.assertEqual(len(self.calls), 2)
+        self.calls[1][1].callback(2)
+        self.assertEqual(third, [2])
+
+    def test_keys_are_independent(self):
+        a = self._run("a")
+        b = self._run("b")
+        self.assertEqual(len(self.calls), 2)
+
+        self.calls[1][1].callback("b")
+        self.assertEqual(b, ["b"])
+        self.assertEqual(a, [])
+
+    def test_concurrent_calls_share_failure(self):
+        first = self._run("a")
+        second = self._run("a")
+        self.calls[0][1].errback(ValueError("oops"))
+        self.assertIsInstance(first[0], ValueError)
+        self.assertIsInstance(second[0], ValueError)
+        self.assertNotIn("a", self.flight)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import unittest
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from matrix_synapse_saml_mozilla._static import (
+    REVALIDATE_CACHE_CONTROL,
+    generated_asset_resource,
+)
+
+STYLE = b"body { margin: 0; }\n"
+SCRIPT = b"console.log('hello');\n" * 50
+
+
+class StaticAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.resources = {
+            name: generated_asset_resource(name, body)
+            for name, body in (("style.css", STYLE), ("script.js", SCRIPT))
+        }
+
+    def _get(self, name: str, headers=None) -> DummyRequest:
+        request = DummyRequest([])
+        for header, value in (headers or {}).items():
+            request.requestHeaders.setRawHeaders(header, [value])
+        request.write(self.resources[name].render(request))
+        return request
+
+    def _header(self, request: DummyRequest, name: bytes):
+        values = request.responseHeaders.getRawHeaders(name)
+        return values[0] if values else None
+
+    def test_uncompressed(self):
+        request = self._get("script.js")
+        self.assertEqual(b"".join(request.written), SCRIPT)
+        self.assertEqual(
+            self._header(request, b"Cache-Control"), REVALIDATE_CACHE_CONTROL
+        )
+        self.assertTrue(
+            self._header(request, b"Content-Type").endswith(
+                b"javascript; charset=utf-8"
+            )
+        )
+        self.assertIsNone(self._header(request, b"Content-Encoding"))
+
+    def test_compressed_copy_only_kept_if_smaller(self):
+        request = self._get("style.css", {b"Accept-Encoding": b"gzip"})
+        self.assertIsNone(self._header(request, b"Content-Encoding"))
+        self.assertEqual(b"".join(request.written), STYLE)
+
+    def test_gzip(self):
+        request = self._get("script.js", {b"Accept-Encoding": b"gzip, deflate"})
+        self.assertEqual(self._header(request, b"Content-Encoding"), b"gzip")
+        self.assertEqual(self._header(request, b"Vary"), b"Accept-Encoding")
+        self.assertEqual(gzip.decompress(b"".join(request.written)), SCRIPT)
+
+        # the gzip header's timestamp is zeroed, so the body is the same each time
+        self.assertEqual(b"".join(request.written)[4:8], b"\0\0\0\0")
+
+    def test_gzip_refused(self):
+        request = self._get("script.js", {b"Accept-Encoding": b"gzip;q=0"})
+        self.assertIsNone(self._header(request, b"Content-Encoding"))
+        self.assertEqual(b"".join(request.written), SCRIPT)
+
+    def test_not_modified(self):
+        etag = self._header(self._get("script.js"), b"ETag")
+        request = self._get("script.js", {b"If-None-Match": etag})
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(b"".join(request.written), b"")
+
+        # the compressed copy has a different ETag
+        request = self._get(
+            "script.js", {b"If-None-Match": etag, b"Accept-Encoding": b"gzip"}
+        )
+        self.assertNotEqual(request.responseCode, 304)
+        self.assertEqual(gzip.decompress(b"".join(request.written)), SCRIPT)
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import gzip
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.resource import getChildForRequest
+from twisted.web.test.requesthelper import DummyRequest
+
+from synapse.module_api.errors import SynapseError
+
+from matrix_synapse_saml_mozilla import username_picker
+from matrix_synapse_saml_mozilla._executor import get_executor, set_executor
+from matrix_synapse_saml_mozilla._registered_users import RegisteredUsersFilter
+from matrix_synapse_saml_mozilla._session_stores import SqliteSessionStore
+from matrix_synapse_saml_mozilla._sessions import (
+    SESSION_COOKIE_NAME,
+    InMemorySessionStore,
+    UsernameMappingSession,
+    set_session_store,
+)
+from matrix_synapse_saml_mozilla.username_picker import (
+    MAX_BATCH_CHECK_USERNAMES,
+    MAX_SUGGESTIONS,
+    PickUsernameConfig,
+    parse_config,
+    pick_username_resource,
+)
+
+from .test_availability import FakeModuleApi
+from .test_session_stores import PausedExecutor
+
+
+class FakeRegistrationModuleApi(FakeModuleApi):
+    """Adds registration and login to FakeModuleApi"""
+
+    def __init__(self, registered):
+        super().__init__(registered)
+        self.db.execute(
+            "CREATE TABLE user_external_ids"
+            " (auth_provider TEXT, external_id TEXT, user_id TEXT)"
+        )
+        self.logins = []
+
+    def register_user(self, localpart, displayname=None):
+        user_id = self.get_qualified_user_id(localpart)
+        taken = self.db.execute(
+            "SELECT 1 FROM users WHERE LOWER(name) = ?", (user_id.lower(),)
+        ).fetchone()
+        if taken:
+            return defer.fail(
+                SynapseError(400, "User ID already taken.", errcode="M_USER_IN_USE")
+            )
+        self.db.execute("INSERT INTO users VALUES (?)", (user_id,))
+        return defer.succeed(user_id)
+
+    def record_user_external_id(self, auth_provider_id, remote_user_id, user_id):
+        self.db.execute(
+            "INSERT INTO user_external_ids VALUES (?, ?, ?)",
+            (auth_provider_id, remote_user_id, user_id),
+        )
+        return defer.succeed(None)
+
+    def complete_sso_login_async(self, user_id, request, client_redirect_url):
+        self.logins.append((user_id, client_redirect_url))
+        request.redirect(client_redirect_url.encode("utf-8"))
+        request.finish()
+        return defer.succeed(None)
+
+
+class FakeRequest(DummyRequest):
+    def __init__(self, postpath, session_id=None):
+        super().__init__(postpath)
+        self.cookies = []
+        self.received_cookies = {}
+        if session_id is not None:
+            self.received_cookies[SESSION_COOKIE_NAME] = session_id.encode("ascii")
+
+    def getCookie(self, name):
+        return self.received_cookies.get(name)
+
+    def addCookie(self, name, value, **kwargs):
+        self.cookies.append((name, value))
+
+    @contextlib.contextmanager
+    def processing(self):
+        yield
+
+
+class PickUsernameTestBase(unittest.TestCase):
+    def setUp(self):
+        self.store = InMemorySessionStore()
+        set_session_store(self.store)
+        self.addCleanup(set_session_store, InMemorySessionStore())
+
+        self.module_api = FakeRegistrationModuleApi(["@jane.doe:test"])
+        self.resource = pick_username_resource(PickUsernameConfig(), self.module_api)
+        self.session_id = self.store.create(
+            UsernameMappingSession(
+                remote_user_id="remote",
+                displayname="Jane Doe",
+                client_redirect_url="https://client/",
+                expiry_time_ms=int(time.time() * 1000) + 60000,
+            )
+        )
+
+    def _render(self, request: FakeRequest) -> bytes:
+        resource = getChildForRequest(self.resource, request)
+        resource.render(request)
+        self.assertTrue(request.finished)
+        return b"".join(request.written)
+
+    def _submit(self, username: str) -> FakeRequest:
+        request = FakeRequest([b"submit"], self.session_id)
+        request.method = b"POST"
+        request.args = {b"username": [username.encode("utf-8")]}
+        self._render(request)
+        return request
+
+
+class PickUsernameResourceTestCase(PickUsernameTestBase):
+    def test_page_suggests_available_username(self):
+        request = FakeRequest([b""], self.session_id)
+        body = self._render(request)
+        self.assertEqual(request.responseCode, 200)
+
+        # jane.doe is taken, so the next candidate is filled in
+        self.assertIn(b'value="janedoe"', body)
+
+        # the stylesheet and script are inlined
+        self.assertIn(b"<style>", body)
+        self.assertNotIn(b'src="script.js"', body)
+
+    def test_page_is_gzipped(self):
+        request = FakeRequest([b""], self.session_id)
+        request.requestHeaders.setRawHeaders(b"Accept-Encoding", [b"gzip, br"])
+        body = self._render(request)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"Content-Encoding"), [b"gzip"]
+        )
+        self.assertIn(b'value="janedoe"', gzip.decompress(body))
+
+        # clients which don't accept gzip get the page as it is
+        request = FakeRequest([b""], self.session_id)
+        self.assertIn(b'value="janedoe"', self._render(request))
+        self.assertIsNone(request.responseHeaders.getRawHeaders(b"Content-Encoding"))
+
+    def test_static_files_are_not_served(self):
+        # the stylesheet and script are only inlined into the page
+        for name in (b"script.js", b"style.css"):
+            request = FakeRequest([name], self.session_id)
+            getChildForRequest(self.resource, request).render(request)
+            self.assertEqual(request.responseCode, 404)
+
+    def test_page_requires_session(self):
+        request = FakeRequest([b""], "unknown")
+        self._render(request)
+        self.assertEqual(request.responseCode, 403)
+
+    def test_submit_unavailable_username(self):
+        request = self._submit("jane.doe")
+        body = b"".join(request.written)
+        self.assertEqual(request.responseCode, 409)
+        self.assertIn(b"not available", body)
+        self.assertIn(b'value="jane.doe"', body)
+        self.assertIn(b'data-username="janedoe"', body)
+        self.assertEqual(self.module_api.logins, [])
+
+        # the session can still be used
+        self.assertIsNotNone(self.store.get(self.session_id))
+
+    def test_submit_registers_user(self):
+        self._submit("jane")
+        self.assertEqual(self.module_api.logins, [("@jane:test", "https://client/")])
+        self.assertIsNone(self.store.get(self.session_id))
+
+    def test_submit_registration_error(self):
+        # the availability cache doesn't know that this username is taken, so
+        # register_user rejects it
+        self.module_api.db.execute("INSERT INTO users VALUES ('@jdoe:test')")
+        self.module_api.check_user_exists = lambda user_id: defer.succeed(None)
+
+        request = self._submit("jdoe")
+        self.assertEqual(request.responseCode, 400)
+        self.assertIn(b"User ID already taken.", b"".join(request.written))
+
+    def test_submit_empty_username(self):
+        request = self._submit("")
+        self.assertEqual(request.responseCode, 400)
+        self.assertIn(b"Please enter a username.", b"".join(request.written))
+
+
+class BatchCheckTestCase(PickUsernameTestBase):
+    def _check_batch(self, usernames, suggestions=None, session_id=None):
+        request = FakeRequest([b"check_batch"], session_id or self.session_id)
+        request.args = {b"username": [u.encode("utf-8") for u in usernames]}
+        if suggestions is not None:
+            request.args[b"suggestions"] = [suggestions.encode("ascii")]
+        body = self._render(request)
+        return request, json.loads(body)
+
+    def test_checks_usernames(self):
+        request, response = self._check_batch(["jane.doe", "bobby"])
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(
+            response,
+            {"available": {"jane.doe": False, "bobby": True}, "suggestions": []},
+        )
+
+    def test_invalid_usernames_are_unavailable(self):
+        _, response = self._check_batch(["Bobby Tables", "", "bobby"])
+        self.assertEqual(
+            response["available"], {"Bobby Tables": False, "": False, "bobby": True}
+        )
+
+    def test_suggestions(self):
+        _, response = self._check_batch([], suggestions="3")
+        self.assertEqual(response["available"], {})
+        self.assertEqual(len(response["suggestions"]), 3)
+        self.assertNotIn("jane.doe", response["suggestions"])
+        self.assertEqual(response["suggestions"][0], "janedoe")
+
+    def test_suggestions_are_capped(self):
+        _, response = self._check_batch([], suggestions="1000")
+        self.assertEqual(len(response["suggestions"]), MAX_SUGGESTIONS)
+
+        _, response = self._check_batch([], suggestions="-5")
+        self.assertEqual(response["suggestions"], [])
+
+    def test_invalid_suggestions(self):
+        _, response = self._check_batch(["bobby"], suggestions="lots")
+        self.assertEqual(response, {"error": "invalid suggestions"})
+
+    def test_batch_size_is_capped(self):
+        usernames = ["bobby%i" % (i,) for i in range(MAX_BATCH_CHECK_USERNAMES + 1)]
+        _, response = self._check_batch(usernames)
+        self.assertEqual(response, {"error": "too many usernames"})
+
+        _, response = self._check_batch(usernames[:-1])
+        self.assertEqual(len(response["available"]), MAX_BATCH_CHECK_USERNAMES)
+
+    def test_requires_session(self):
+        _, response = self._check_batch(["bobby"], session_id="unknown")
+        self.assertEqual(response, {"error": "unknown session"})
+
+
+class ConcurrentSubmitTestCase(PickUsernameTestBase):
+    def setUp(self):
+        super().setUp()
+
+        # hold up registrations until the test releases them
+        self.registrations = []
+        register_user = self.module_api.register_user
+
+        def paused_register_user(localpart, displayname=None):
+            d = defer.Deferred()
+            d.addCallback(lambda _: register_user(localpart, displayname))
+            self.registrations.append(d)
+            return d
+
+        self.module_api.register_user = paused_register_user
+
+    def _start_submit(self, username: str) -> FakeRequest:
+        request = FakeRequest([b"submit"], self.session_id)
+        request.method = b"POST"
+        request.args = {b"username": [username.encode("utf-8")]}
+        getChildForRequest(self.resource, request).render(request)
+        return request
+
+    def test_concurrent_submits_register_once(self):
+        first = self._start_submit("jane")
+        second = self._start_submit("jane")
+        self.assertEqual(len(self.registrations), 1)
+        self.assertFalse(first.finished)
+        self.assertFalse(second.finished)
+
+        self.registrations[0].callback(None)
+        for request in (first, second):
+            self.assertTrue(request.finished)
+            self.assertEqual(request.responseCode, 302)
+        self.assertEqual(
+            self.module_api.logins, [("@jane:test", "https://client/")] * 2
+        )
+
+    def test_concurrent_submits_share_rejection(self):
+        self.module_api.db.execute("INSERT INTO users VALUES ('@jdoe:test')")
+        self.module_api.check_user_exists = lambda user_id: defer.succeed(None)
+
+        first = self._start_submit("jdoe")
+        second = self._start_submit("jdoe")
+        self.registrations[0].callback(None)
+        self.assertEqual(len(self.registrations), 1)
+        for request in (first, second):
+            self.assertEqual(request.responseCode, 400)
+
+        # the session was put back, so the user can have another go
+        self.assertIsNotNone(self.store.get(self.session_id))
+        request = self._start_submit("jane")
+        self.registrations[1].callback(None)
+        self.assertEqual(request.responseCode, 302)
+
+    def test_session_is_taken_while_registering(self):
+        self._start_submit("jane")
+        self.assertIsNone(self.store.get(self.session_id))
+
+    def test_duplicate_submit_after_registration(self):
+        self._start_submit("jane")
+        self.registrations[0].callback(None)
+
+        # a late duplicate logs the user in again, without registering
+        request = self._start_submit("jane")
+        self.assertTrue(request.finished)
+        self.assertEqual(request.responseCode, 302)
+        self.assertEqual(len(self.registrations), 1)
+        self.assertEqual(len(self.module_api.logins), 2)
+
+
+class RateLimitTestCase(PickUsernameTestBase):
+    def setUp(self):
+        super().setUp()
+        config = parse_config(
+            {
+                "rate_limiting": {
+                    "per_ip": None,
+                    "per_session": {"per_second": 0.01, "burst_count": 2},
+                }
+            }
+        )
+        self.resource = pick_username_resource(config, self.module_api)
+
+    def _check(self) -> FakeRequest:
+        request = FakeRequest([b"check"], self.session_id)
+        request.args = {b"username": [b"bobby"]}
+        self._render(request)
+        return request
+
+    def _assert_rate_limited(self, request: FakeRequest):
+        self.assertEqual(request.responseCode, 429)
+        retry_after = request.responseHeaders.getRawHeaders(b"Retry-After")
+        self.assertEqual(retry_after, [b"100"])
+
+    def test_check_is_rate_limited(self):
+        self.assertEqual(self._check().responseCode, 200)
+        self.assertEqual(self._check().responseCode, 200)
+        self._assert_rate_limited(self._check())
+
+    def test_submit_is_rate_limited(self):
+        self._check()
+        self._check()
+        request = self._submit("jane")
+        self._assert_rate_limited(request)
+        self.assertEqual(self.module_api.logins, [])
+
+    def test_off_by_default(self):
+        self.resource = pick_username_resource(PickUsernameConfig(), self.module_api)
+        for _ in range(30):
+            self.assertEqual(self._check().responseCode, 200)
+
+
+class RegisteredUsersFilterTestCase(PickUsernameTestBase):
+    def test_submit_adds_user_to_filter(self):
+        filters = []
+
+        def build_filter(module_api, config):
+            registered_users = RegisteredUsersFilter(module_api, config, Clock())
+            self.addCleanup(registered_users.stop)
+            filters.append(registered_users)
+            return registered_users
+
+        config = parse_config({"registered_users_filter": {}})
+        with mock.patch.object(username_picker, "RegisteredUsersFilter", build_filter):
+            self.resource = pick_username_resource(config, self.module_api)
+        (registered_users,) = filters
+        self.assertFalse(registered_users.may_be_registered("@bobby:test"))
+
+        # the filter is not rebuilt, so bobby can only have been added by /submit
+        self.assertEqual(self._submit("bobby").responseCode, 302)
+        self.assertTrue(registered_users.may_be_registered("@bobby:test"))
+
+
+class RegisteredUserTestCase(PickUsernameTestBase):
+    def test_submit_logs_in_registered_user(self):
+        # the user has a second session, and registers in the first one
+        second_session_id = self.store.create(
+            UsernameMappingSession(
+                remote_user_id="remote",
+                displayname="Jane Doe",
+                client_redirect_url="https://client/",
+                expiry_time_ms=int(time.time() * 1000) + 60000,
+            )
+        )
+        self._submit("jane")
+
+        # the page does not look the user up...
+        request = FakeRequest([b""], second_session_id)
+        self._render(request)
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(len(self.module_api.logins), 1)
+
+        # ... but submitting a username does, and logs them in as the user they
+        # registered
+        self.session_id = second_session_id
+        request = self._submit("jane.smith")
+        self.assertEqual(request.responseCode, 302)
+        self.assertEqual(
+            self.module_api.logins,
+            [("@jane:test", "https://client/"), ("@jane:test", "https://client/")],
+        )
+        self.assertIsNone(self.store.get(second_session_id))
+        registered = self.module_api.db.execute(
+            "SELECT 1 FROM users WHERE name = ?", ("@jane.smith:test",)
+        ).fetchone()
+        self.assertIsNone(registered)
+
+
+class BlockingSessionStoreTestCase(PickUsernameTestBase):
+    def setUp(self):
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.store = SqliteSessionStore(os.path.join(tempdir.name, "sessions.db"))
+        set_session_store(self.store)
+        self.session_id = self.store.create(
+            UsernameMappingSession(
+                remote_user_id="remote",
+                displayname="Jane Doe",
+                client_redirect_url="https://client/",
+                expiry_time_ms=int(time.time() * 1000) + 60000,
+            )
+        )
+
+        self.addCleanup(set_executor, get_executor())
+        self.executor = PausedExecutor()
+        set_executor(self.executor)
+
+    def _start(self, request: FakeRequest):
+        getChildForRequest(self.resource, request).render(request)
+
+    def test_page_looks_up_session_in_executor(self):
+        request = FakeRequest([b""], self.session_id)
+        self._start(request)
+        self.assertFalse(request.finished)
+
+        self.executor.release()
+        self.assertTrue(request.finished)
+        self.assertEqual(request.responseCode, 200)
+
+    def test_submit_takes_session_in_executor(self):
+        request = FakeRequest([b"submit"], self.session_id)
+        request.method = b"POST"
+        request.args = {b"username": [b"bobby"]}
+        self._start(request)
+        self.assertFalse(request.finished)
+
+        self.executor.release()
+        self.assertTrue(request.finished)
+        self.assertEqual(self.module_api.logins, [("@bobby:test", "https://client/")])
+        self.assertIsNone(self.store.get(self.session_id))